@@ -0,0 +1,228 @@
+"""Load test for the economy cog, fully offline.
+
+Runs a scripted workload against the real ``Economy`` cog on a temporary database,
+with a number of commands in flight at once, and reports throughput, latency
+percentiles, commits per second and peak memory. Run it from the repository root::
+
+    python -m benchmarks.economy --users 10000 --ops 20000 --concurrency 50
+    python -m benchmarks.economy --workload pay --write-behind --json results.json
+
+The JSON output is meant to be compared between commits.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, DefaultDict, Dict, List, Tuple
+
+# Sets up the environment main.py needs, so it has to come first.
+from benchmarks.harness import FakeUser, Harness, peak_rss_kib  # isort: skip
+
+from discord.ext import commands
+
+from cogs.economy import Economy
+from cogs.economy.wallet import LeaderboardFlags
+
+Operation = Callable[[Economy, Harness, FakeUser, random.Random], Awaitable[Any]]
+
+
+async def work(cog: Economy, harness: Harness, user: FakeUser, rng: random.Random) -> None:
+    await cog.work.callback(cog, harness.context(user, cog))  # type: ignore
+
+
+async def pay(cog: Economy, harness: Harness, user: FakeUser, rng: random.Random) -> None:
+    other = harness.users[rng.choice(harness.user_ids)]
+    await cog.pay.callback(cog, harness.context(user, cog), other, rng.randint(1, 100))  # type: ignore
+
+
+async def buy(cog: Economy, harness: Harness, user: FakeUser, rng: random.Random) -> None:
+    item = rng.choice([item.name for item in cog.items.values() if item.price * 100 <= harness.balance])
+    await cog.buy.callback(cog, harness.context(user, cog), 1, item_name=item)  # type: ignore
+
+
+async def leaderboard(cog: Economy, harness: Harness, user: FakeUser, rng: random.Random) -> None:
+    scope = LeaderboardFlags.__new__(LeaderboardFlags)
+    scope.guild = False
+    await cog.leaderboard.callback(cog, harness.context(user, cog), scope=scope)  # type: ignore
+
+
+async def enter(cog: Economy, harness: Harness, user: FakeUser, rng: random.Random) -> None:
+    await cog.enter.callback(cog, harness.context(user, cog), 1)  # type: ignore
+
+
+OPERATIONS: Dict[str, Operation] = {
+    'work': work,
+    'pay': pay,
+    'buy': buy,
+    'leaderboard': leaderboard,
+    'enter': enter,
+}
+
+# name: weights of the operations above
+WORKLOADS: Dict[str, Dict[str, int]] = {
+    'mixed': {'work': 30, 'pay': 30, 'buy': 20, 'leaderboard': 10, 'enter': 10},
+    **{name: {name: 1} for name in OPERATIONS},
+}
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    cuts = statistics.quantiles(ordered, n=100, method='inclusive') if len(ordered) > 1 else [ordered[0]] * 99
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.write_behind:
+        os.environ['WRITE_BEHIND'] = 'True'
+    rng = random.Random(args.seed)
+    weights = WORKLOADS[args.workload]
+    names = list(weights)
+    script = rng.choices(names, weights=[weights[name] for name in names], k=args.ops)
+
+    async with Harness(users=args.users) as harness:
+
+        def create(bot: Any) -> Economy:
+            economy = Economy(bot)
+            economy.trivia_provider.start = lambda: None  # offline
+            return economy
+
+        cog: Economy = await harness.add_cog(create)
+        await asyncio.gather(cog._registered_users_task, cog._ranking_task, cog.warmed_up('catalog'))
+        async with harness.bot.pool.acquire() as conn:
+            now = int(time.time())
+            lottery = await conn.fetchone(
+                'INSERT INTO lottery (bal, start_time, end_time) VALUES (0, ?, ?) RETURNING lot_id', (now - 1, now + 3600)
+            )
+        cog.lottery_scheduler.schedule(lottery['lot_id'], now + 3600)
+        harness.bot.metrics.reset()
+
+        latencies: DefaultDict[str, List[float]] = defaultdict(list)
+        rejected: DefaultDict[str, int] = defaultdict(int)
+        errors: DefaultDict[str, int] = defaultdict(int)
+        queue = iter(script)
+        commits_before = harness.commits.commits
+
+        async def worker() -> None:
+            for name in queue:
+                user = harness.users[harness.user_ids[rng.randrange(len(harness.user_ids))]]
+                started = time.perf_counter()
+                try:
+                    await OPERATIONS[name](cog, harness, user, rng)
+                except commands.BadArgument:
+                    # Not enough money and such, that's a normal outcome.
+                    rejected[name] += 1
+                except Exception as e:
+                    errors[name] += 1
+                    if errors[name] == 1:
+                        print(f'{name} failed: {e!r}', file=sys.stderr)
+                latencies[name].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        if cog.balance_journal:
+            await cog.balance_journal.flush()
+        elapsed = time.perf_counter() - started
+        commits = harness.commits.commits - commits_before
+
+        all_latencies = [sample for samples in latencies.values() for sample in samples]
+        queries = harness.bot.metrics.summary('query_seconds')[:10]
+        acquire = harness.bot.metrics.summary('pool_acquire_seconds')
+        return {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'workload': args.workload,
+            'users': args.users,
+            'ops': args.ops,
+            'concurrency': args.concurrency,
+            'write_behind': args.write_behind,
+            'seed': args.seed,
+            'elapsed_s': elapsed,
+            'throughput_ops_s': args.ops / elapsed,
+            'commits': commits,
+            'commits_per_s': commits / elapsed,
+            'commits_per_op': commits / args.ops,
+            'peak_rss_kib': peak_rss_kib(),
+            'latency': {'all': percentiles(all_latencies), **{name: percentiles(latencies[name]) for name in names}},
+            'rejected': dict(rejected),
+            'errors': dict(errors),
+            'pool_acquire': acquire[0] if acquire else None,
+            'slowest_queries': [
+                {'query': row['labels']['query'], 'count': row['count'], 'total_s': row['sum'], 'p99_ms': row['p99'] * 1000}
+                for row in queries
+            ],
+        }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(
+        f"{report['workload']}: {report['ops']} ops by {report['users']} users, {report['concurrency']} at a time"
+        f"{' (write-behind)' if report['write_behind'] else ''}"
+    )
+    print(
+        f"  {report['throughput_ops_s']:.0f} ops/s, {report['commits_per_s']:.0f} commits/s "
+        f"({report['commits_per_op']:.2f} per op), peak RSS {report['peak_rss_kib'] / 1024:.1f} MiB"
+    )
+    rows: List[Tuple[str, Dict[str, float]]] = list(report['latency'].items())
+    print(f"  {'':<12} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, stats in rows:
+        if stats['count']:
+            print(
+                f"  {name:<12} {stats['count']:>7} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f}"
+                f" {stats['p99_ms']:>8.2f} {stats['max_ms']:>8.2f}"
+            )
+    if report['errors']:
+        print(f"  errors: {report['errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--ops', type=int, default=20_000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--write-behind', action='store_true', help='buffer balance changes in the journal')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help='also write the results to this file')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
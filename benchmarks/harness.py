@@ -0,0 +1,188 @@
+"""A fake Discord for running the real cogs offline.
+
+:class:`BenchBot` is a :class:`BotChallenge` that never connects. Its users are
+:class:`FakeUser` objects, and commands are run by calling their callbacks with a
+:class:`FakeContext`, which skips the checks and cooldowns but nothing else.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+os.environ.setdefault('PREFIX', '!')
+
+import aiohttp  # noqa: E402
+import asqlite  # noqa: E402
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+
+from components.gateway import peak_rss_kib  # noqa: E402,F401
+from components.migrations import migrate  # noqa: E402
+from components.storage import StorageProfile  # noqa: E402
+from main import BotChallenge  # noqa: E402
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
+
+
+class CommitCounter:
+    """Counts the transactions SQLite commits, explicit ones and autocommitted statements."""
+
+    def __init__(self) -> None:
+        self.commits = 0
+        self._lock = threading.Lock()
+
+    def install(self, connection: sqlite3.Connection) -> None:
+        last = None
+
+        def trace(statement: str) -> None:
+            nonlocal last
+            # Trigger programs are traced as the statement that fired them, right after it.
+            repeated, last = statement == last, statement
+            keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+            if keyword in ('COMMIT', 'END') or (keyword in WRITES and not connection.in_transaction and not repeated):
+                with self._lock:
+                    self.commits += 1
+
+        connection.set_trace_callback(trace)
+
+
+class FakeUser:
+    def __init__(self, user_id: int) -> None:
+        self.id = user_id
+        self.name = f'user{user_id}'
+        self.bot = False
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+    async def send(self, *args: Any, **kwargs: Any) -> FakeMessage:
+        return FakeMessage()
+
+
+class FakeMessage:
+    attachments: List[Any] = []
+
+    async def edit(self, *args: Any, **kwargs: Any) -> FakeMessage:
+        return self
+
+
+class FakeContext:
+    def __init__(self, bot: BenchBot, author: FakeUser, cog: commands.Cog) -> None:
+        self.bot = bot
+        self.author = author
+        self.cog = cog
+        self.guild = None
+        self.message = FakeMessage()
+        self.sent = 0
+
+    async def send(self, *args: Any, **kwargs: Any) -> FakeMessage:
+        self.sent += 1
+        view = kwargs.get('view')
+        if isinstance(view, discord.ui.View):
+            # Nothing will ever click it, don't let its timeout linger.
+            view.stop()
+        return FakeMessage()
+
+
+class BenchBot(BotChallenge):
+    """A bot that knows a fixed set of fake users, and never talks to Discord."""
+
+    def __init__(self, pool: asqlite.Pool, users: Dict[int, FakeUser]) -> None:
+        super().__init__(pool)
+        self.users_by_id = users
+        self.session = aiohttp.ClientSession()
+
+    def get_user(self, id: int, /) -> Any:
+        return self.users_by_id.get(id)
+
+    async def fetch_user(self, user_id: int, /) -> Any:
+        user = self.users_by_id.get(user_id)
+        if user is None:
+            raise discord.NotFound(_FakeResponse(), 'Unknown User')  # type: ignore
+        return user
+
+
+class _FakeResponse:
+    status = 404
+    reason = 'Not Found'
+
+
+class Harness:
+    """A temporary database with migrations applied, and a :class:`BenchBot` on top of it.
+
+    Use it as an async context manager::
+
+        async with Harness(users=1000) as harness:
+            cog = await harness.add_cog(Economy)
+    """
+
+    def __init__(self, *, users: int, balance: int = 1_000_000, profile: Optional[StorageProfile] = None) -> None:
+        self.user_count = users
+        self.balance = balance
+        self.profile = profile or StorageProfile(checkpoint_interval=0, optimize_interval=0)
+        self.commits = CommitCounter()
+        self.users: Dict[int, FakeUser] = {}
+        self.user_ids: List[int] = []
+        self._tmp: Optional[tempfile.TemporaryDirectory[str]] = None
+
+    @property
+    def directory(self) -> str:
+        assert self._tmp is not None
+        return self._tmp.name
+
+    async def __aenter__(self) -> Harness:
+        self._tmp = tempfile.TemporaryDirectory(prefix='botchallenge-bench-')
+        # Relative paths like the write-behind journal end up in here too.
+        self._cwd = os.getcwd()
+        os.chdir(self.directory)
+
+        def init(connection: sqlite3.Connection) -> None:
+            self.profile.apply(connection)
+            self.commits.install(connection)
+
+        self._pool_cm = asqlite.create_pool(os.path.join(self.directory, 'bench.db'), init=init, size=self.profile.pool_size)
+        pool = await self._pool_cm.__aenter__()
+        await migrate(pool)
+
+        first_id = 10**17
+        self.user_ids = list(range(first_id, first_id + self.user_count))
+        self.users = {user_id: FakeUser(user_id) for user_id in self.user_ids}
+        async with pool.acquire() as conn:
+            await conn.execute('BEGIN')
+            await conn.executemany(
+                'INSERT INTO wallets (user_id, balance) VALUES (?, ?)', [(user_id, self.balance) for user_id in self.users]
+            )
+            await conn.commit()
+
+        self.bot = BenchBot(pool, self.users)
+        await self.bot.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.bot.__aexit__(*exc_info)
+        await self._pool_cm.__aexit__(*exc_info)
+        os.chdir(self._cwd)
+        assert self._tmp is not None
+        self._tmp.cleanup()
+
+    async def add_cog(self, cog_factory: Callable[[BotChallenge], commands.Cog]) -> Any:
+        cog = cog_factory(self.bot)
+        await self.bot.add_cog(cog)
+        return cog
+
+    def context(self, user: FakeUser, cog: commands.Cog) -> FakeContext:
+        return FakeContext(self.bot, user, cog)
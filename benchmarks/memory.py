@@ -0,0 +1,117 @@
+"""Memory benchmark for cached wallets: bytes per cached user.
+
+Loads wallets with a few items each through ``get_wallet`` and measures what they
+take with ``tracemalloc``, next to the same wallets loaded the way they used to be
+(an instance ``__dict__`` and a ``defaultdict(int)`` inventory)::
+
+    python -m benchmarks.memory --users 20000 --items 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, DefaultDict, List
+
+# Sets up the environment main.py needs, so it has to come first.
+from benchmarks.harness import Harness  # isort: skip
+
+import discord
+
+from cogs.economy import Economy
+from cogs.economy.cache import estimate_size
+
+
+class DictWallet:
+    """What a cached wallet used to look like, for comparison."""
+
+    def __init__(self, user_id: int, balance: int, inventory: DefaultDict[int, int], bot: Any) -> None:
+        self._bot = bot
+        self._journal = None
+        self._ranking = None
+        self._ledger = None
+        self.user_id = user_id
+        self.inventory = inventory
+        self.inventory_version = 0
+        self._balance = balance
+
+
+async def measure(build: Callable[[], Awaitable[List[Any]]]) -> int:
+    """Bytes still allocated by what ``build`` returns, garbage from building it doesn't count."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = await build()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del kept
+    return sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    async with Harness(users=args.users, balance=10**6) as harness:
+        cog: Economy = await harness.add_cog(Economy)
+        await cog.warmed_up('catalog')
+        item_ids = sorted(cog.items)
+        async with harness.bot.pool.acquire() as conn:
+            await conn.execute('BEGIN')
+            await conn.executemany(
+                'INSERT INTO inventory (user_id, item_id, amount) VALUES (?, ?, ?)',
+                [
+                    (user_id, item_id, rng.randrange(1, 10_000))
+                    for user_id in harness.user_ids
+                    for item_id in rng.sample(item_ids, args.items)
+                ],
+            )
+            await conn.commit()
+
+        # The users are loaded straight from the database both ways, so neither shares
+        # anything with the other, and the cache's own bookkeeping isn't counted.
+        async def legacy() -> List[Any]:
+            wallets = []
+            async with harness.bot.pool.acquire() as conn:
+                for user_id in harness.user_ids:
+                    row = await conn.fetchone('SELECT * FROM wallets WHERE user_id = ?', (user_id,))
+                    items = await conn.fetchall('SELECT item_id, amount FROM inventory WHERE user_id = ?', (user_id,))
+                    inventory: DefaultDict[int, int] = defaultdict(int)
+                    inventory.update({item_id: amount for item_id, amount in items})
+                    wallets.append(DictWallet(row['user_id'], row['balance'], inventory, harness.bot))
+            return wallets
+
+        async def slotted() -> List[Any]:
+            cog._wallets.clear()
+            for user_id in harness.user_ids:
+                await cog.get_wallet(discord.Object(user_id))
+            wallets = list(cog._wallets.values())
+            cog._wallets.clear()
+            return wallets
+
+        cog._wallets.max_size = args.users
+        before = await measure(legacy)
+        started = time.perf_counter()
+        after = await measure(slotted)
+        load_s = time.perf_counter() - started
+        estimate = sum(estimate_size(wallet) for wallet in await slotted())
+        print(f'{args.users} wallets with {args.items} items each, loaded in {load_s:.2f}s')
+        print(f'  dict wallets:   {before / args.users:>6.0f} B per user')
+        print(f'  slotted arrays: {after / args.users:>6.0f} B per user ({1 - after / before:.0%} less)')
+        print(f'  cache estimate: {estimate / args.users:>6.0f} B per user')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--items', type=int, default=3, help='different items every user has')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
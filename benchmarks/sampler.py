@@ -0,0 +1,105 @@
+"""Benchmark for picking a random wallet, the way robberies pick their target.
+
+Compares ``ORDER BY RANDOM()`` (what robberies used to do), :func:`probe_wallet`
+(random rowid probing, the fallback while the ranking loads) and
+:meth:`BalanceRanking.sample`, on a wallets table with random balances::
+
+    python -m benchmarks.sampler --wallets 1000000 --picks 200
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Sets up the environment main.py needs, so it has to come first.
+from benchmarks.harness import Harness, peak_rss_kib  # isort: skip
+
+from cogs.economy.ranking import BalanceRanking
+from cogs.economy.timed_events import probe_wallet
+
+Sampler = Callable[[], Awaitable[Optional[int]]]
+
+
+async def measure(sample: Sampler, picks: int) -> Dict[str, float]:
+    timings: List[float] = []
+    for _ in range(picks):
+        started = time.perf_counter()
+        await sample()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'p50_ms': statistics.median(timings) * 1000,
+        'p99_ms': timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    async with Harness(users=args.wallets, balance=0) as harness:
+        pool = harness.bot.pool
+        async with pool.acquire() as conn:
+            # Most players are broke, like in the real thing.
+            await conn.execute(
+                'UPDATE wallets SET balance = CASE WHEN abs(random()) % 100 < ? THEN abs(random()) % 10000 ELSE 0 END',
+                (args.eligible,),
+            )
+            await conn.commit()
+            eligible = (await conn.fetchone('SELECT COUNT(*) FROM wallets WHERE balance > ?', (args.above,)))[0]
+
+        started = time.perf_counter()
+        ranking = BalanceRanking()
+        await ranking.load(pool)
+        load_s = time.perf_counter() - started
+        print(f'{args.wallets} wallets, {eligible} with more than {args.above}, ranking loaded in {load_s:.2f}s')
+
+        async def order_by_random() -> Optional[int]:
+            async with pool.acquire() as conn:
+                row = await conn.fetchone(
+                    'SELECT user_id FROM wallets WHERE balance > ? ORDER BY RANDOM() LIMIT 1', (args.above,)
+                )
+            return row and row['user_id']
+
+        async def probe() -> Optional[int]:
+            async with pool.acquire() as conn:
+                return await probe_wallet(conn, args.above, rng)
+
+        async def in_memory() -> Optional[int]:
+            return ranking.sample(args.above, rng)
+
+        samplers: Dict[str, Sampler] = {'order by random()': order_by_random, 'rowid probe': probe, 'ranking': in_memory}
+        print(f"  {'':<18} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name, sample in samplers.items():
+            picks = min(args.picks, 20) if sample is order_by_random else args.picks
+            stats = await measure(sample, picks)
+            print(f"  {name:<18} {stats['p50_ms']:>9.3f} {stats['p99_ms']:>9.3f} {stats['max_ms']:>9.3f}")
+
+        # How evenly each one picks, over a small population so every wallet gets picked a few times.
+        if eligible and args.fairness:
+            for name in ('rowid probe', 'ranking'):
+                counts = Counter([await samplers[name]() for _ in range(args.fairness)])
+                expected = args.fairness / eligible
+                worst = max(counts.values()) / expected
+                print(f'  {name}: most picked wallet {worst:.1f}x as often as expected, {len(counts)} distinct')
+        print(f'  peak RSS {peak_rss_kib() / 1024:.1f} MiB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wallets', type=int, default=1_000_000)
+    parser.add_argument('--picks', type=int, default=200)
+    parser.add_argument('--above', type=int, default=25, help='only wallets with more than this are picked')
+    parser.add_argument('--eligible', type=int, default=30, help='rough percentage of wallets with money')
+    parser.add_argument('--fairness', type=int, default=0, help='picks to check how uniform the samplers are')
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark for restarting the economy cog, with and without a state snapshot.
+
+Loads the cog, touches ``--hot`` wallets so they're cached, unloads it (which saves the
+snapshot) and loads it again. Prints how long it took until the ranking, the registered
+users and the catalog were ready, and how many of the hot wallets the first wave of
+commands finds cached::
+
+    python -m benchmarks.warmup --users 1000000 --hot 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import time
+
+# Sets up the environment main.py needs, so it has to come first.
+from benchmarks.harness import Harness, peak_rss_kib  # isort: skip
+
+import discord
+
+from cogs.economy import Economy
+
+
+async def restart(harness: Harness, hot: int, snapshot: bool) -> None:
+    cog: Economy = await harness.add_cog(Economy)
+    await asyncio.gather(cog._registered_users_task, cog._ranking_task, cog.warmed_up('catalog'))
+    cog._wallets.max_size = max(cog._wallets.max_size, hot)
+    for user_id in harness.user_ids[:hot]:
+        await cog.get_wallet(discord.Object(user_id))
+    if not snapshot:
+        cog.snapshot_file = None
+    started = time.perf_counter()
+    await harness.bot.remove_cog(cog.qualified_name)
+    saved_s = time.perf_counter() - started
+    size = os.path.getsize('economy.snapshot') if snapshot else 0
+
+    started = time.perf_counter()
+    cog = await harness.add_cog(Economy)
+    cog._wallets.max_size = max(cog._wallets.max_size, hot)
+    await asyncio.gather(cog._registered_users_task, cog._ranking_task, cog.warmed_up('catalog'))
+    ready_s = time.perf_counter() - started
+    cached = sum(user_id in cog._wallets for user_id in harness.user_ids[:hot])
+    name = 'snapshot' if snapshot else 'database'
+    print(
+        f'  {name:<9} ready in {ready_s:>6.3f}s, {cached}/{hot} hot wallets cached'
+        + (f', saved {size / 1024:.0f} KiB in {saved_s:.3f}s' if snapshot else '')
+    )
+    await harness.bot.remove_cog(cog.qualified_name)
+
+
+async def run(args: argparse.Namespace) -> None:
+    async with Harness(users=args.users, balance=1000) as harness:
+        print(f'{args.users} wallets, {args.hot} of them hot')
+        await restart(harness, args.hot, snapshot=False)
+        await restart(harness, args.hot, snapshot=True)
+        print(f'  peak RSS {peak_rss_kib() / 1024:.1f} MiB')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--hot', type=int, default=10_000, help='wallets used before the restart')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,69 @@
+import asyncio
+from functools import partial
+
 from .item_store import ItemStore
 from .lottery import Lottery
+from .snapshot import Snapshots
 from .wallet import WalletManagement
+from .timed_events import TimedEvents
 from .trivia import Trivia
 
 
-class Economy(WalletManagement, ItemStore, Lottery, Trivia):
+class Economy(WalletManagement, ItemStore, Lottery, Trivia, TimedEvents, Snapshots):
     """Economy commands, the 'start' command to get started."""
 
     async def cog_load(self):
-        self.lottery_check.start()
-        await self.get_items()
+        if self.balance_journal:
+            await self.balance_journal.start()
+        if self.ledger:
+            self.ledger.start()
+        # Commands work before these are done, the ones that need them wait for them.
+        self.warm_up('cooldowns', self.cooldowns.load())
+        self.cooldowns.start()
+        # Whatever isn't in the snapshot (or is out of date) is loaded from the database after it.
+        self.warm_up('snapshot', self.restore_snapshot())
+        self.warm_up('catalog', self.load_unless_restored('catalog', self.get_items))
+        self.catalog.start(self.bot.pool)
+        self.warm_up('lotteries', self.start_lotteries())
+        self.warm_up('timed events', self.start_timed_events())
+        self.notifier.start()
+        if self.bot.cluster is not None:
+            self.bot.cluster.subscribe('wallet', self._on_wallet_changed)
+            self.bot.cluster.subscribe('bonus_hours', self._on_bonus_hours)
+            self.bot.cluster.subscribe('cooldown', self.cooldowns.apply)
+        # cog_check asks the database until this is done.
+        self._registered_users_task = asyncio.create_task(
+            self.load_unless_restored('registered users', partial(self.registered_users.load, self.bot.pool))
+        )
+        # Same for the leaderboard, it reads from the database until the ranking is rebuilt.
+        self._ranking_task = asyncio.create_task(
+            self.load_unless_restored('ranking', partial(self.ranking.load, self.bot.pool))
+        )
+
+    async def cog_unload(self):
+        for task in self._warming.values():
+            task.cancel()
+        await self.stop_lotteries()
+        if self.lottery_lease is not None:
+            await self.lottery_lease.stop()
+        await self.stop_timed_events()
+        if self.timed_events_lease is not None:
+            await self.timed_events_lease.stop()
+        if self.bot.cluster is not None:
+            self.bot.cluster.unsubscribe('wallet', self._on_wallet_changed)
+            self.bot.cluster.unsubscribe('bonus_hours', self._on_bonus_hours)
+            self.bot.cluster.unsubscribe('cooldown', self.cooldowns.apply)
+        self.trivia_provider.close()
+        await self.trivia_bank.flush()
+        self.catalog.close()
+        self.notifier.close()
+        await self.cooldowns.close()
+        if self.balance_journal:
+            await self.balance_journal.close()
+        if self.ledger:
+            await self.ledger.close()
+        # Last, once nothing changes wallets anymore.
+        await self.save_snapshot()
 
 
 async def setup(bot):
@@ -1,16 +1,34 @@
+import asyncio
+import itertools
 import sqlite3
-import sys
-from collections import defaultdict
-from contextlib import asynccontextmanager
+import time
 from dataclasses import dataclass
-from typing import DefaultDict, Dict, Optional
+from logging import getLogger
+from typing import Any, Awaitable, Dict, Optional, Tuple
 
-import asqlite
 import discord
 from discord.ext import commands
 
 from main import BotChallenge
 
+from .cache import WalletCache
+from .cooldowns import CooldownStore
+from .inventory import Inventory
+from .catalog import ItemCatalog
+from .journal import BalanceJournal
+from .ledger import Ledger
+from .locks import UserLocks
+from .membership import GuildMembers, RegisteredUsers
+from .notifications import Notifier
+from .operations import EconomyTransaction, bump_wallet_version
+from .ranking import BalanceRanking
+from .resolver import UserResolver
+
+log = getLogger('BotChallenge.economy')
+
+# Every state of every inventory gets its own number, even across reloads of the same wallet.
+_inventory_versions = itertools.count()
+
 
 @dataclass
 class Item:
@@ -24,73 +42,123 @@ class Item:
 
 
 class Wallet:
-    def __init__(self, data: sqlite3.Row, inventory: DefaultDict[int, int], bot: BotChallenge) -> None:
+    # There can be thousands of these cached, slots keep each one small.
+    __slots__ = ('_bot', '_journal', '_ranking', '_ledger', 'user_id', 'inventory', 'inventory_version', '_balance')
+
+    def __init__(
+        self,
+        user_id: int,
+        balance: int,
+        inventory: Inventory,
+        bot: BotChallenge,
+        journal: Optional[BalanceJournal] = None,
+        ranking: Optional[BalanceRanking] = None,
+        ledger: Optional[Ledger] = None,
+    ) -> None:
         self._bot = bot
-        self.user_id = data['user_id']
-        self.inventory = inventory  # Dict[<item id>: <amount of items>]
-        self._balance = data['balance']
+        self._journal = journal
+        self._ranking = ranking
+        self._ledger = ledger
+        self.user_id = user_id
+        self.inventory = inventory
+        self.inventory_version = next(_inventory_versions)
+        self._balance = balance
 
     @property
     def balance(self):
         return self._balance
 
-    @asynccontextmanager
-    async def managed_conn(self, connection: Optional[asqlite.Connection] = None):
-        """Async context manager that creates a connection
-        and manages it if no connection is passed to it. It will
-        also commit automatically, if it's managing the connection.
-        """
-        context_manager = None
-        try:
-            if connection is None:
-                context_manager = self._bot.pool.acquire()
-                connection = await context_manager
-            yield connection
-        finally:
-            if context_manager:
-                await connection.commit()
-                await context_manager.__aexit__(*sys.exc_info())
-
-    async def withdraw(self, amount: int, /, *, connection: Optional[asqlite.Connection] = None):
+    def _set_balance(self, balance: int) -> None:
+        self._balance = balance
+        if self._ranking is not None:
+            self._ranking.update(self.user_id, balance)
+
+    def _inventory_changed(self) -> None:
+        self.inventory_version = next(_inventory_versions)
+
+    def _publish(self) -> None:
+        # Other processes in the cluster have to drop their copy of this wallet.
+        if self._bot.cluster is not None:
+            self._bot.cluster.publish('wallet', user_id=self.user_id, balance=self._balance)
+
+    async def withdraw(self, amount: int, /, *, reason: str = 'other'):
         """|coro|
 
-        Withdraws money from this wallet.
+        Withdraws money from this wallet. In write-behind mode, the change is journaled.
+
+        For changes that have to be part of a bigger transaction, use ``BaseEconomyCog.transaction``.
 
         Parameter
         ---------
         amount: int
             The amount of money to withdraw.
-        connection: Optional[asqlite.Connection]
-            An optional connection to use, if not passed, this
-            method will acquire and manage it's own connection.
+        reason: str
+            What the money was spent on, for the ledger.
+
+        Raises
+        ------
+        commands.BadArgument
+            There isn't enough money. In a cluster the cached balance can be out of date,
+            so the database has the final say.
         """
         if amount > self.balance:
             raise commands.BadArgument(f'You do not have enough money. You have {self.balance}')
-        self._balance -= amount
-        async with self.managed_conn(connection) as conn:
-            data = await conn.fetchone(
-                'UPDATE wallets SET balance = balance - ? WHERE user_id = ? RETURNING balance', (amount, self.user_id)
-            )
-            self._balance = data['balance']
+        if self._journal is not None:
+            self._set_balance(self._balance - amount)
+            self._journal.record(self.user_id, -amount)
+        else:
+            data = await self._write_balance(-amount)
+            if data is None:
+                raise commands.BadArgument('You do not have enough money.')
+            self._set_balance(data['balance'])
+            self._publish()
+        self._log(-amount, reason)
 
-    async def add(self, amount: int, /, *, connection: Optional[asqlite.Connection] = None):
+    async def add(self, amount: int, /, *, reason: str = 'other'):
         """|coro|
 
-        Adds money to this wallet.
+        Adds money to this wallet. In write-behind mode, the change is journaled.
+
+        For changes that have to be part of a bigger transaction, use ``BaseEconomyCog.transaction``.
 
         Parameter
         ---------
         amount: int
             The amount of money to add.
-        connection: Optional[asqlite.Connection]
-            An optional connection to use, if not passed, this
-            method will acquire and manage it's own connection.
+        reason: str
+            Where the money came from, for the ledger.
         """
-        async with self.managed_conn(connection) as conn:
-            data = await conn.fetchone(
-                'UPDATE wallets SET balance = balance + ? WHERE user_id = ? RETURNING balance', (amount, self.user_id)
-            )
-            self._balance = data['balance']
+        if self._journal is not None:
+            self._set_balance(self._balance + amount)
+            self._journal.record(self.user_id, amount)
+        else:
+            data = await self._write_balance(amount)
+            self._set_balance(data['balance'])
+            self._publish()
+        self._log(amount, reason)
+
+    async def _write_balance(self, delta: int) -> Optional[sqlite3.Row]:
+        # The change and the wallet version are committed together. None if it would go below zero.
+        async with self._bot.pool.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                data = await conn.fetchone(
+                    'UPDATE wallets SET balance = balance + :delta WHERE user_id = :user_id AND balance + :delta >= 0'
+                    ' RETURNING balance',
+                    {'delta': delta, 'user_id': self.user_id},
+                )
+                if data is not None:
+                    await bump_wallet_version(conn)
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+        return data
+
+    def _log(self, delta: int, reason: str) -> None:
+        # Only called once the change is committed (or journaled).
+        if self._ledger is not None:
+            self._ledger.record(self.user_id, delta, reason)
 
 
 class BaseEconomyCog(commands.Cog):
@@ -102,25 +170,118 @@ class BaseEconomyCog(commands.Cog):
     def __init__(self, bot: BotChallenge) -> None:
         self.bot: BotChallenge = bot
         super().__init__()
-        self._wallets: Dict[int, Wallet] = {}
-        self.items: Dict[int, Item] = {}
+        self.catalog = ItemCatalog.from_env(Item.from_row)
+        self.balance_journal: Optional[BalanceJournal] = BalanceJournal.from_env(bot.pool)
+        self.ledger: Optional[Ledger] = Ledger.from_env(bot.pool)
+        if self.balance_journal and bot.cluster is not None:
+            # Each process would have its own idea of every balance.
+            log.warning('Write-behind balances are not supported in cluster mode, disabling them')
+            self.balance_journal = None
+        self._wallets: WalletCache = WalletCache.from_env(can_evict=self._can_evict_wallet)
+        self.registered_users = RegisteredUsers()
+        self.guild_members = GuildMembers.from_env()
+        self.ranking = BalanceRanking()
+        self.user_resolver = UserResolver.from_env(bot)
+        self.notifier = Notifier.from_env(bot)
+        self.cooldowns = CooldownStore.from_env(bot.pool)
+        # Wallet changes are serialized per user, see UserLocks.
+        self.user_locks = UserLocks.from_env(bot.metrics)
+        # (ends at, multiplier), see TimedEvents.
+        self._bonus_hours: Tuple[int, int] = (0, 1)
+        # Startup work that runs in the background, by name, see warm_up.
+        self._warming: Dict[str, asyncio.Task[Any]] = {}
+
+    def warm_up(self, name: str, work: Awaitable[Any]) -> None:
+        """Runs startup work in the background, so the cog doesn't hold up the bot coming online.
+
+        Commands that need it done wait for it with :meth:`warmed_up`.
+        """
+        self._warming[name] = asyncio.create_task(self.bot.startup.background(name, work))
+
+    async def warmed_up(self, name: str) -> None:
+        """|coro|
+
+        Waits for the startup work called ``name`` to finish, if it hasn't yet.
+        """
+        task = self._warming.get(name)
+        if task is not None and not task.done():
+            # Shielded, one command timing out shouldn't cancel it for everyone.
+            await asyncio.shield(task)
+
+    def _can_evict_wallet(self, wallet: Wallet) -> bool:
+        # With write-behind, the cached wallet is the only up to date copy until it's flushed.
+        return not (self.balance_journal and self.balance_journal.is_dirty(wallet.user_id))
+
+    def invalidate_wallet(self, user_id: int) -> None:
+        """Drops a wallet from the cache, so it's loaded from the database again next time it's needed."""
+        self._wallets.invalidate(user_id)
+
+    def publish_wallet(self, user_id: int, balance: Optional[int]) -> None:
+        """Tells the other processes in the cluster that a wallet was opened (or closed, if balance is None)."""
+        if self.bot.cluster is not None:
+            self.bot.cluster.publish('wallet', user_id=user_id, balance=balance)
+
+    def _on_wallet_changed(self, message: Dict[str, Any]) -> None:
+        # Another process changed a wallet, so our copy is out of date.
+        user_id, balance = message['user_id'], message['balance']
+        self._wallets.invalidate(user_id)
+        if balance is None:
+            self.registered_users.discard(user_id)
+            self.ranking.remove(user_id)
+        else:
+            self.registered_users.add(user_id)
+            self.ranking.update(user_id, balance)
+
+    @property
+    def bonus_multiplier(self) -> int:
+        """What work and daily pay is multiplied by right now, more than 1 during bonus hours."""
+        ends_at, multiplier = self._bonus_hours
+        return multiplier if ends_at > time.time() else 1
+
+    @property
+    def items(self) -> Dict[int, Item]:
+        """The items in the store, by item ID"""
+        return self.catalog.by_id
 
     async def get_items(self) -> None:
-        """Gets the items from the database, and stores it in self.items"""
-        async with self.bot.pool.acquire() as conn:
-            items = await conn.fetchall("SELECT * FROM items")
-            self.items = {r['item_id']: Item.from_row(r) for r in items}
+        """Gets the items from the database, and stores them in self.catalog"""
+        await self.catalog.load(self.bot.pool)
+
+    def find_item(self, name: str) -> Item:
+        """Gets an item by name, or raises an error suggesting the items that were probably meant.
+
+        Raises
+        ------
+        commands.BadArgument
+            There is no item with that name.
+        """
+        item = self.catalog.get(name)
+        if item:
+            return item
+        suggestions = self.catalog.complete(name, limit=3) or self.catalog.suggest(name)
+        if suggestions:
+            names = ', '.join(f'`{item.name}`' for item in suggestions)
+            raise commands.BadArgument(f'There is no item with that name. Did you mean {names}?')
+        raise commands.BadArgument('There is no item with that name.')
+
+    def transaction(self, reason: str = 'other') -> EconomyTransaction:
+        """Starts collecting balance and inventory changes to commit together.
+
+        ``reason`` is what the balance changes are recorded as in the ledger.
+
+        Example
+        -------
+        .. code-block:: python3
+
+            await self.transaction('buy').withdraw(wallet, price).give_item(wallet, item.item_id, amount).commit()
+        """
+        return EconomyTransaction(self.bot.pool, ledger=self.ledger, reason=reason)
 
     async def cog_check(self, ctx: commands.Context) -> bool:
         """Check so that all commands have you entered in the database, but with a special case for start."""
         if not ctx.command:
             return True
-        async with self.bot.pool.acquire() as conn:
-            check = (
-                await conn.fetchone(
-                    'SELECT EXISTS(SELECT user_id FROM wallets WHERE user_id = ?) AS value', (ctx.author.id,)
-                )
-            )['value']
+        check = await self.registered_users.contains(ctx.author.id, self.bot.pool)
         if not check:
             if ctx.command.name != 'start':
                 raise commands.CheckFailure('You do not have a wallet, use the command "start" to get one')
@@ -129,14 +290,30 @@ class BaseEconomyCog(commands.Cog):
             raise commands.CheckFailure('You already have a wallet')
         return True
 
-    async def get_wallet(self, user: discord.abc.User) -> Wallet:
+    async def cog_before_invoke(self, ctx: commands.Context) -> None:
+        """Applies the cooldowns from ``cooldowns.cooldown``, only looking at memory."""
+        assert ctx.command is not None
+        per = getattr(ctx.command.callback, '__economy_cooldown__', None)
+        if per is None:
+            return
+        # Or everyone would get to skip their cooldowns right after a restart.
+        await self.warmed_up('cooldowns')
+        name = ctx.command.qualified_name
+        retry_after = self.cooldowns.trigger(name, ctx.author.id, per)
+        if retry_after:
+            raise commands.CommandOnCooldown(commands.Cooldown(1, per), retry_after, commands.BucketType.user)
+        if self.bot.cluster is not None:
+            expires_at = self.cooldowns.expires_at(name, ctx.author.id)
+            self.bot.cluster.publish('cooldown', command=name, user_id=ctx.author.id, expires_at=expires_at)
+
+    async def get_wallet(self, user: discord.abc.Snowflake) -> Wallet:
         """|coro|
 
         Gets a wallet from cache, or creates one from database if it doesn't exist
 
         Parameter
         ---------
-        user: discord.abc.User
+        user: discord.abc.Snowflake
             The owner of the wallet you are trying to get.
 
         Raises
@@ -150,12 +327,17 @@ class BaseEconomyCog(commands.Cog):
         if wallet:
             return wallet
         async with self.bot.pool.acquire() as conn:
-            wallet_info = await conn.fetchone('SELECT * FROM wallets WHERE user_id = ?', (user.id,))
-        if wallet_info:
-            items = await conn.fetchall('SELECT item_id, amount FROM inventory WHERE user_id = ?', (user.id,))
-            dd = defaultdict(int)
-            dd.update({item_id: amount for item_id, amount in items})
-            wallet = Wallet(wallet_info, dd, self.bot)
-            self._wallets[user.id] = wallet
-            return wallet
+            # One row per item, or a single row with NULLs for an empty inventory.
+            rows = await conn.fetchall(
+                'SELECT wallets.balance, inventory.item_id, inventory.amount FROM wallets'
+                ' LEFT JOIN inventory ON inventory.user_id = wallets.user_id'
+                ' WHERE wallets.user_id = ? ORDER BY inventory.item_id',
+                (user.id,),
+            )
+        if rows:
+            inventory = Inventory((row[1], row[2]) for row in rows if row[1] is not None)
+            wallet = Wallet(user.id, rows[0][0], inventory, self.bot, self.balance_journal, self.ranking, self.ledger)
+            # Someone else might have loaded it while we were waiting on the database.
+            # Only one copy can be cached, or balance changes could get lost.
+            return self._wallets.setdefault(user.id, wallet)
         raise commands.BadArgument(f'Wallet not found.')
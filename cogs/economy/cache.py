@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Optional, Tuple
+
+from main import getenv_int
+
+if TYPE_CHECKING:
+    from .base_cog import Wallet
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def estimate_size(wallet: Wallet) -> int:
+    """Rough amount of bytes a cached wallet takes up, including its inventory."""
+    # Wallets have slots and inventories count their arrays, the only boxed int is the balance.
+    return sys.getsizeof(wallet) + sys.getsizeof(wallet.inventory) + sys.getsizeof(wallet.balance)
+
+
+class WalletCache:
+    """A bounded LRU cache of wallets, keyed by user ID.
+
+    Entries are evicted least recently used first once there are more than
+    ``max_size`` of them, or once their estimated size adds up to more than
+    ``max_bytes``. Entries that haven't been used for ``ttl`` seconds expire.
+
+    ``can_evict`` gets called before an entry is dropped because of size limits or
+    expiry, wallets it returns False for are kept around (used so write-behind
+    wallets with uncommitted changes stay cached).
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 10_000,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = 60 * 60,
+        can_evict: Optional[Callable[[Wallet], bool]] = None,
+    ) -> None:
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.can_evict = can_evict
+        self.stats = CacheStats()
+        self.nbytes = 0
+        # user_id: (wallet, estimated size, last used)
+        self._entries: OrderedDict[int, Tuple[Wallet, int, float]] = OrderedDict()
+
+    @classmethod
+    def from_env(cls, can_evict: Optional[Callable[[Wallet], bool]] = None) -> WalletCache:
+        """Creates a cache with the limits from the .env file."""
+        ttl = getenv_int('WALLET_CACHE_TTL', 60 * 60)
+        max_bytes = getenv_int('WALLET_CACHE_MAX_BYTES', 0)
+        return cls(
+            max_size=getenv_int('WALLET_CACHE_SIZE', 10_000),
+            max_bytes=max_bytes or None,
+            ttl=ttl or None,
+            can_evict=can_evict,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def get(self, user_id: int) -> Optional[Wallet]:
+        """Gets a wallet, marking it as recently used."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        wallet, size, last_used = entry
+        now = time.monotonic()
+        if self._expired(last_used, now) and self._evictable(wallet):
+            self._remove(user_id)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries[user_id] = (wallet, size, now)
+        self._entries.move_to_end(user_id)
+        self.stats.hits += 1
+        return wallet
+
+    def peek(self, user_id: int) -> Optional[Wallet]:
+        """Gets a wallet without touching its position or the stats."""
+        entry = self._entries.get(user_id)
+        return entry[0] if entry else None
+
+    def setdefault(self, user_id: int, wallet: Wallet) -> Wallet:
+        """Caches a wallet, unless one is already cached for that user. Returns the cached one."""
+        existing = self._entries.get(user_id)
+        if existing is not None:
+            return existing[0]
+        size = estimate_size(wallet)
+        self._entries[user_id] = (wallet, size, time.monotonic())
+        self.nbytes += size
+        self._shrink()
+        return wallet
+
+    def invalidate(self, user_id: int) -> Optional[Wallet]:
+        """Drops a wallet from the cache, regardless of ``can_evict``."""
+        if user_id not in self._entries:
+            return None
+        self.stats.invalidations += 1
+        return self._remove(user_id)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    def values(self):
+        return (wallet for wallet, _, _ in self._entries.values())
+
+    def _remove(self, user_id: int) -> Wallet:
+        wallet, size, _ = self._entries.pop(user_id)
+        self.nbytes -= size
+        return wallet
+
+    def _expired(self, last_used: float, now: float) -> bool:
+        return self.ttl is not None and now - last_used > self.ttl
+
+    def _evictable(self, wallet: Wallet) -> bool:
+        return self.can_evict is None or self.can_evict(wallet)
+
+    def _shrink(self) -> None:
+        now = time.monotonic()
+        count, nbytes = len(self._entries), self.nbytes
+        victims = []
+        # Least recently used entries come first, so this stops at the first entry
+        # that is fresh while we're within budget, which keeps it cheap.
+        for user_id, (wallet, size, last_used) in self._entries.items():
+            expired = self._expired(last_used, now)
+            over_budget = count > self.max_size or (self.max_bytes is not None and nbytes > self.max_bytes)
+            if not expired and not over_budget:
+                break
+            # Pinned wallets are skipped, and we keep looking for something else to drop.
+            if self._evictable(wallet):
+                victims.append((user_id, expired))
+                count -= 1
+                nbytes -= size
+
+        for user_id, expired in victims:
+            self._remove(user_id)
+            if expired:
+                self.stats.expirations += 1
+            else:
+                self.stats.evictions += 1
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import difflib
+import sqlite3
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
+
+import asqlite
+
+from main import getenv_int
+
+if TYPE_CHECKING:
+    from .base_cog import Item
+
+log = getLogger('BotChallenge.catalog')
+
+
+def normalize(name: str) -> str:
+    """The form item names are compared in."""
+    return ' '.join(name.casefold().split())
+
+
+def trigrams(name: str) -> Set[str]:
+    padded = f'  {name} '
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class ItemCatalog:
+    """The items in the store, indexed for lookups by name.
+
+    - :meth:`get` is a dict lookup on the casefolded name.
+    - :meth:`complete` finds names by prefix, with a binary search over the sorted names.
+    - :meth:`suggest` finds names that look like a misspelled one, using a trigram index
+      to narrow it down to a few candidates before comparing them.
+
+    The indexes are rebuilt as a whole when the catalog is (re)loaded, items don't change
+    often enough to make updating them in place worth it. :meth:`start` polls the
+    ``catalog_version`` row (bumped by triggers on the items table) every ``interval``
+    seconds and reloads when it changed.
+    """
+
+    def __init__(self, item_factory: Callable[[sqlite3.Row], Item], *, interval: float = 30.0) -> None:
+        self.item_factory = item_factory
+        self.interval = interval
+        self.version: Optional[int] = None
+        self.by_id: Dict[int, Item] = {}
+        self._by_name: Dict[str, Item] = {}
+        self._names: List[str] = []
+        self._trigrams: Dict[str, List[str]] = {}
+        self._task: Optional[asyncio.Task[None]] = None
+
+    @classmethod
+    def from_env(cls, item_factory: Callable[[sqlite3.Row], Item]) -> ItemCatalog:
+        return cls(item_factory, interval=getenv_int('ITEM_CATALOG_REFRESH', 30))
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def get(self, name: str) -> Optional[Item]:
+        """Gets an item by name, ignoring case and extra whitespace."""
+        return self._by_name.get(normalize(name))
+
+    def complete(self, prefix: str, *, limit: int = 25) -> List[Item]:
+        """Gets the items whose names start with ``prefix``, in alphabetical order."""
+        prefix = normalize(prefix)
+        start = bisect.bisect_left(self._names, prefix)
+        found: List[Item] = []
+        for name in self._names[start : start + limit]:
+            if not name.startswith(prefix):
+                break
+            found.append(self._by_name[name])
+        return found
+
+    def suggest(self, name: str, *, limit: int = 3, cutoff: float = 0.6) -> List[Item]:
+        """Gets the items whose names are closest to ``name``, best match first.
+
+        Used for "did you mean" when :meth:`get` doesn't find anything.
+        """
+        name = normalize(name)
+        shared: Dict[str, int] = {}
+        for gram in trigrams(name):
+            for candidate in self._trigrams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        # Only the candidates with the most trigrams in common are worth a closer look.
+        candidates = sorted(shared, key=shared.__getitem__, reverse=True)[: limit * 10]
+        matches = difflib.get_close_matches(name, candidates, n=limit, cutoff=cutoff)
+        return [self._by_name[match] for match in matches]
+
+    def replace(self, items: Dict[int, Item]) -> None:
+        """Swaps in a new set of items, rebuilding the indexes."""
+        by_name = {normalize(item.name): item for item in items.values()}
+        index: Dict[str, List[str]] = {}
+        for name in by_name:
+            for gram in trigrams(name):
+                index.setdefault(gram, []).append(name)
+        self.by_id = items
+        self._by_name = by_name
+        self._names = sorted(by_name)
+        self._trigrams = index
+
+    async def load(self, pool: asqlite.Pool) -> None:
+        """|coro|
+
+        Loads the items from the database.
+        """
+        async with pool.acquire() as conn:
+            version = await conn.fetchone('SELECT version FROM catalog_version')
+            rows = await conn.fetchall('SELECT * FROM items')
+        self.replace({row['item_id']: self.item_factory(row) for row in rows})
+        self.version = version['version'] if version else None
+        log.info('Loaded %s items (catalog version %s)', len(self), self.version)
+
+    def restore(self, items: Dict[int, Item], version: Optional[int]) -> None:
+        """Swaps in items that are known to be at ``version``, like the ones in a state snapshot."""
+        self.replace(items)
+        self.version = version
+        log.info('Restored %s items (catalog version %s)', len(self), self.version)
+
+    async def refresh(self, pool: asqlite.Pool) -> bool:
+        """|coro|
+
+        Reloads the items if they changed since they were last loaded.
+
+        Returns whether they were reloaded.
+        """
+        async with pool.acquire() as conn:
+            version = await conn.fetchone('SELECT version FROM catalog_version')
+        if version is not None and version['version'] == self.version:
+            return False
+        await self.load(pool)
+        return True
+
+    def start(self, pool: asqlite.Pool) -> None:
+        """Starts checking for changes to the items every ``interval`` seconds."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(pool))
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, pool: asqlite.Pool) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh(pool)
+            except Exception:
+                log.exception('Could not refresh the item catalog')
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+import asqlite
+from discord.ext import commands
+
+from main import getenv_int
+
+log = getLogger('BotChallenge.cooldowns')
+
+T = TypeVar('T')
+
+# The longest the sweeper sleeps for.
+SWEEP_INTERVAL = 60.0
+
+
+def cooldown(per: float) -> Callable[[T], T]:
+    """Gives a command a per-user cooldown of ``per`` seconds that's kept in the :class:`CooldownStore`.
+
+    Unlike ``commands.cooldown``, it survives restarts and is shared by every process.
+    It's applied by ``BaseEconomyCog.cog_before_invoke``, so it only works in the economy cog.
+    """
+
+    def decorator(func: T) -> T:
+        if isinstance(func, commands.Command):
+            func.callback.__economy_cooldown__ = per  # type: ignore
+        else:
+            func.__economy_cooldown__ = per  # type: ignore
+        return func
+
+    return decorator
+
+
+class CooldownStore:
+    """When every user can use every command with a cooldown again.
+
+    Checks only look at memory: expiry times are kept in a dict per command, and
+    entries that are found expired are dropped on the spot. A heap of expiry times lets
+    a background task drop the rest as they expire, without scanning everything.
+
+    New cooldowns are written through to the ``cooldowns`` table every ``interval``
+    seconds, all of them in one transaction, and read back in bulk on startup. So a
+    restart (or a crash, minus at most ``interval`` seconds of cooldowns) doesn't
+    hand everyone a fresh ``daily``. In a cluster, new cooldowns are also sent to the
+    other processes, see :meth:`apply`.
+    """
+
+    def __init__(self, pool: asqlite.Pool, *, interval: float = 1.0) -> None:
+        self.pool = pool
+        self.interval = interval
+        # command: {user_id: expires at}
+        self._expiry: Dict[str, Dict[int, float]] = {}
+        self._heap: List[Tuple[float, str, int]] = []
+        self._pending: Dict[Tuple[str, int], float] = {}
+        self._lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task[None]] = []
+
+    @classmethod
+    def from_env(cls, pool: asqlite.Pool) -> CooldownStore:
+        return cls(pool, interval=getenv_int('COOLDOWN_FLUSH_INTERVAL_MS', 1000) / 1000)
+
+    def __len__(self) -> int:
+        return sum(len(users) for users in self._expiry.values())
+
+    def retry_after(self, command: str, user_id: int) -> float:
+        """Seconds until the user can use the command again, 0 if they can now."""
+        users = self._expiry.get(command)
+        if not users:
+            return 0.0
+        expires_at = users.get(user_id)
+        if expires_at is None:
+            return 0.0
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            del users[user_id]
+            return 0.0
+        return remaining
+
+    def expires_at(self, command: str, user_id: int) -> float:
+        """The unix timestamp the user's cooldown ends at, 0 if they're not on one."""
+        return self._expiry.get(command, {}).get(user_id, 0.0)
+
+    def trigger(self, command: str, user_id: int, per: float) -> float:
+        """Starts a cooldown, unless the user is already on one.
+
+        Returns the seconds left on the cooldown they're on, or 0 if a new one was started.
+        """
+        remaining = self.retry_after(command, user_id)
+        if remaining:
+            return remaining
+        self.set(command, user_id, time.time() + per)
+        return 0.0
+
+    def set(self, command: str, user_id: int, expires_at: float, *, persist: bool = True) -> None:
+        """Puts a user on cooldown until ``expires_at``, a unix timestamp."""
+        self._expiry.setdefault(command, {})[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, command, user_id))
+        if persist:
+            self._pending[command, user_id] = expires_at
+
+    def reset(self, command: str, user_id: int) -> None:
+        """Lets a user use a command again right away."""
+        if self._expiry.get(command, {}).pop(user_id, None) is not None:
+            # An expiry in the past is deleted from the database by the next sweep.
+            self._pending[command, user_id] = 0.0
+
+    def apply(self, message: Dict[str, Any]) -> None:
+        """Takes a cooldown started by another process, it already wrote it to the database."""
+        self.set(message['command'], message['user_id'], message['expires_at'], persist=False)
+
+    async def load(self) -> None:
+        """|coro|
+
+        Reads every cooldown that hasn't expired yet from the database.
+        """
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetchall('SELECT command, user_id, expires_at FROM cooldowns WHERE expires_at > ?', (now,))
+        for command, user_id, expires_at in rows:
+            # Ones started since are newer than what's in the database.
+            self._expiry.setdefault(command, {}).setdefault(user_id, expires_at)
+        self._heap.extend((expires_at, command, user_id) for command, user_id, expires_at in rows)
+        heapq.heapify(self._heap)
+        log.info('Loaded %s cooldowns', len(rows))
+
+    async def flush(self) -> None:
+        """|coro|
+
+        Writes the new cooldowns to the database, and deletes the expired ones there.
+        """
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        if pending:
+                            await conn.executemany(
+                                'INSERT INTO cooldowns (command, user_id, expires_at) VALUES (?, ?, ?)'
+                                '\nON CONFLICT DO UPDATE SET expires_at = excluded.expires_at',
+                                [(command, user_id, expires_at) for (command, user_id), expires_at in pending.items()],
+                            )
+                        await conn.execute('DELETE FROM cooldowns WHERE expires_at <= ?', (time.time(),))
+                    except BaseException:
+                        await conn.rollback()
+                        raise
+                    await conn.commit()
+            except BaseException:
+                for key, expires_at in pending.items():
+                    self._pending.setdefault(key, expires_at)
+                raise
+
+    def sweep(self) -> int:
+        """Drops the cooldowns that expired from memory, returns how many."""
+        now = time.time()
+        dropped = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, command, user_id = heapq.heappop(self._heap)
+            users = self._expiry.get(command)
+            # It might have been reset or started again since, then this entry is stale.
+            if users is not None and users.get(user_id) == expires_at:
+                del users[user_id]
+                dropped += 1
+        return dropped
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._flush_forever()), asyncio.create_task(self._sweep_forever())]
+
+    async def close(self) -> None:
+        """|coro|
+
+        Stops the background tasks and writes whatever is still pending.
+        """
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.flush()
+
+    async def _flush_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._pending:
+                continue
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to write cooldowns, retrying in %ss', self.interval)
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            self.sweep()
+            # Checks expire entries on their own, this only has to keep memory in check,
+            # so it's fine if a cooldown that was started since expires a bit earlier.
+            wait = self._heap[0][0] - time.time() if self._heap else SWEEP_INTERVAL
+            await asyncio.sleep(min(max(wait, 0), SWEEP_INTERVAL))
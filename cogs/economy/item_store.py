@@ -1,36 +1,31 @@
 import asyncio
 from typing import Optional
 
-import discord
-import tabulate
 from discord.ext import commands
 
-from .base_cog import BaseEconomyCog, Item
+from main import BotChallenge
+
+from .base_cog import BaseEconomyCog
+from .render import RenderCache, TableView
 
 
 class ItemStore(BaseEconomyCog):
+    def __init__(self, bot: BotChallenge) -> None:
+        super().__init__(bot)
+        # The tables are the same until the catalog or someone's inventory changes.
+        self.renders = RenderCache()
+
     @commands.command()
     async def buy(self, ctx: commands.Context, amount: Optional[int], *, item_name: str):
         """Buys one or more items from the store."""
         amount = amount or 1
 
-        def pred(item: Item) -> bool:
-            return item.name.lower() == item_name.lower()
-
-        item = discord.utils.find(pred, self.items.values())
-        if not item:
-            raise commands.BadArgument('There is no item with that name.')
+        await self.warmed_up('catalog')
+        item = self.find_item(item_name)
         price = item.price * amount
-        wallet = await self.get_wallet(ctx.author)
-        await wallet.withdraw(price)
-        wallet.inventory[item.item_id] += 1
-        async with self.bot.pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO inventory (user_id, item_id, amount) VALUES (:user_id, :item_id, :amount)'
-                '\nON CONFLICT DO UPDATE SET amount = amount + :amount',
-                {'user_id': ctx.author.id, 'item_id': item.item_id, 'amount': amount},
-            )
-            await conn.commit()
+        async with self.user_locks.hold(ctx.author.id):
+            wallet = await self.get_wallet(ctx.author)
+            await self.transaction('buy').withdraw(wallet, price).give_item(wallet, item.item_id, amount).commit()
         await ctx.send(f'You bough {amount} {item.name} for a total of {self.currency_symbol}{price}')
 
     @commands.command()
@@ -38,46 +33,33 @@ class ItemStore(BaseEconomyCog):
         """Sells one or more items back to the store"""
         amount = amount or 1
 
-        def pred(item: Item) -> bool:
-            return item.name.lower() == item_name.lower()
-
-        item = discord.utils.find(pred, self.items.values())
-        if not item:
-            raise commands.BadArgument('There is no item with that name.')
-        wallet = await self.get_wallet(ctx.author)
-        if wallet.inventory[item.item_id] - amount >= 0:
-            raise commands.BadArgument(f'You do not have that many of {item.name}')
-        wallet.inventory[item.item_id] -= amount
+        await self.warmed_up('catalog')
+        item = self.find_item(item_name)
         price = item.price * amount
-        await wallet.add(price)
-
-        async with self.bot.pool.acquire() as conn:
-            await conn.execute(
-                'UPDATE inventory SET amount = amount - :amount WHERE user_id = :user_id AND item_id = :item_id',
-                {'user_id': ctx.author.id, 'item_id': item.item_id, 'amount': amount},
-            )
-            await conn.commit()
+        async with self.user_locks.hold(ctx.author.id):
+            wallet = await self.get_wallet(ctx.author)
+            if wallet.inventory[item.item_id] < amount:
+                raise commands.BadArgument(f'You do not have that many of {item.name}')
+            await self.transaction('sell').take_item(wallet, item.item_id, amount).deposit(wallet, price).commit()
 
         await ctx.send(f'You sold {amount} {item.name} and earned {self.currency_symbol}{price}')
 
     @commands.command(aliases=['shop'])
     async def store(self, ctx: commands.Context):
         """Shows the items available to be bought."""
-        items = [(item.name, item.price) for item in sorted(self.items.values(), key=lambda i: i.price, reverse=True)]
-        table = tabulate.tabulate(items, headers=('Item Name', 'Price'), tablefmt='grid')
-        embed = discord.Embed(title='Item Store', color=discord.Color.blurple(), description=f'```py\n{table}\n```')
-        embed.set_footer(text='Buy items with `buy`.')
-        await ctx.send(embed=embed)
+        await self.warmed_up('catalog')
+        pages = self.renders.store(self.items)
+        await TableView(ctx, pages, title='Item Store', footer='Buy items with `buy`.').send()
 
     @commands.command(aliases=['inv'])
     async def inventory(self, ctx: commands.Context):
         """Shows the items in the user inventory"""
         wallet = await self.get_wallet(ctx.author)
-        items = [(item.name, wallet.inventory[item.item_id]) for item in self.items.values()]
-        table = tabulate.tabulate(items, headers=('Item Name', 'Amount'), tablefmt='grid')
-        embed = discord.Embed(title='Inventory', color=discord.Color.blurple(), description=f'```py\n{table}\n```')
-        embed.set_footer(text='Sell items with `sell`.')
-        await ctx.send(embed=embed)
+        await self.warmed_up('catalog')
+        pages = self.renders.inventory(wallet, self.items)
+        if not pages:
+            return await ctx.send('You do not have any items. Buy some with `buy`.')
+        await TableView(ctx, pages, title='Inventory', footer='Sell items with `sell`.').send()
 
     @commands.command()
     async def trade(self, ctx: commands.Context, amount: Optional[int], *, item_name: str):
@@ -95,29 +77,14 @@ class ItemStore(BaseEconomyCog):
         if player == ctx.author:
             raise commands.BadArgument('You cannot trade with yourself.')
         amount = amount or 1
-        wallet = await self.get_wallet(ctx.author)
-        wallet2 = await self.get_wallet(player)
-
-        def pred(item: Item) -> bool:
-            return item.name.lower() == item_name.lower()
-
-        item = discord.utils.find(pred, self.items.values())
-        if not item:
-            raise commands.BadArgument('There is no item with that name.')
-        if wallet.inventory[item.item_id] - amount >= 0:
-            raise commands.BadArgument(f'You do not have that many of {item.name}')
-        wallet.inventory[item.item_id] -= amount
-        wallet2.inventory[item.item_id] += amount
-
-        async with self.bot.pool.acquire() as conn:
-            await conn.execute(
-                'UPDATE inventory SET amount = amount - :amount WHERE user_id = :user_id AND item_id = :item_id',
-                {'user_id': ctx.author.id, 'item_id': item.item_id, 'amount': amount},
-            )
-            await conn.execute(
-                'UPDATE inventory SET amount = amount + :amount WHERE user_id = :user_id AND item_id = :item_id',
-                {'user_id': player.id, 'item_id': item.item_id, 'amount': amount},
-            )
-            await conn.commit()
+        await self.warmed_up('catalog')
+        item = self.find_item(item_name)
+        async with self.user_locks.hold(ctx.author.id, player.id):
+            wallet = await self.get_wallet(ctx.author)
+            wallet2 = await self.get_wallet(player)
+            if wallet.inventory[item.item_id] < amount:
+                raise commands.BadArgument(f'You do not have that many of {item.name}')
+            transaction = self.transaction('trade').take_item(wallet, item.item_id, amount)
+            await transaction.give_item(wallet2, item.item_id, amount).commit()
 
         await ctx.send(f'You traded {amount} {item.name} to {player}')
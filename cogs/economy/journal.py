@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+import glob
+import os
+from collections import defaultdict
+from logging import getLogger
+from typing import DefaultDict, Dict, Iterable, Optional, TextIO, Tuple
+
+import asqlite
+
+from main import getenv_flag, getenv_int
+
+from .operations import bump_wallet_version
+
+log = getLogger('BotChallenge.journal')
+
+
+class BalanceJournal:
+    """Write-behind buffer for wallet balance changes.
+
+    Instead of running an ``UPDATE`` (and a commit) for every change, deltas are
+    appended to a journal file and kept in memory, coalesced per user. A background
+    task then writes them to the database in a single transaction every ``interval``
+    seconds, or as soon as ``max_ops`` changes are waiting.
+
+    While this is enabled the cached :class:`Wallet` objects are the source of truth
+    for balances, the database lags behind by at most one flush.
+
+    Every line in the journal file has a sequence number, and the last sequence number
+    that made it to the database is stored in the ``balance_journal`` table within the
+    same transaction as the deltas themselves. On startup, anything in the journal
+    files that is newer than that gets replayed, so a crash doesn't lose money, and
+    a crash right after a commit doesn't apply it twice.
+
+    Lines are written to the OS right away, but only fsynced once per flush, so a process
+    crash loses nothing. An OS crash or power failure can lose what was recorded since
+    the last flush, at most ``interval`` seconds of changes. That's the same window SQLite
+    leaves with ``synchronous=normal``.
+    """
+
+    def __init__(
+        self, pool: asqlite.Pool, *, path: str = 'balance.journal', interval: float = 0.5, max_ops: int = 500
+    ) -> None:
+        self.pool = pool
+        self.path = path
+        self.interval = interval
+        self.max_ops = max_ops
+        self._pending: DefaultDict[int, int] = defaultdict(int)
+        self._inflight: Dict[int, int] = {}
+        self._ops = 0
+        self._seq = 0
+        self._file: Optional[TextIO] = None
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    @classmethod
+    def from_env(cls, pool: asqlite.Pool) -> Optional[BalanceJournal]:
+        """Creates a journal from the .env settings, or returns None if write-behind is disabled."""
+        if not getenv_flag('WRITE_BEHIND'):
+            return None
+        return cls(
+            pool,
+            path=os.getenv('WRITE_BEHIND_JOURNAL') or 'balance.journal',
+            interval=getenv_int('WRITE_BEHIND_INTERVAL_MS', 500) / 1000,
+            max_ops=getenv_int('WRITE_BEHIND_MAX_OPS', 500),
+        )
+
+    def is_dirty(self, user_id: int) -> bool:
+        """Whether this user has balance changes that haven't been committed yet."""
+        return user_id in self._pending or user_id in self._inflight
+
+    def record(self, user_id: int, delta: int) -> None:
+        """Records a balance change for a user. It will be written on the next flush."""
+        if self._file is None:
+            raise RuntimeError('The balance journal has not been started')
+        self._seq += 1
+        self._file.write(f'{self._seq} {user_id} {delta}\n')
+        self._file.flush()
+        self._pending[user_id] += delta
+        self._ops += 1
+        if self._ops >= self.max_ops:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        """|coro|
+
+        Replays anything that was left in the journal files, and starts the flusher.
+        """
+        async with self.pool.acquire() as conn:
+            committed = (await conn.fetchone('SELECT last_seq FROM balance_journal WHERE id = 1'))['last_seq']
+
+        self._seq = committed
+        replay: DefaultDict[int, int] = defaultdict(int)
+        replayed = 0
+        for seq, user_id, delta in self._read_segments():
+            self._seq = max(self._seq, seq)
+            if seq > committed:
+                replay[user_id] += delta
+                replayed += 1
+
+        if replay:
+            await self._write(replay.items(), self._seq)
+            log.warning('Replayed %s balance changes (%s wallets) from the journal.', replayed, len(replay))
+        self._remove_segments()
+
+        self._file = open(self.path, 'a')
+        self._task = asyncio.create_task(self._run())
+
+    async def flush(self) -> None:
+        """|coro|
+
+        Writes all pending balance changes to the database in one transaction.
+        """
+        async with self._lock:
+            if not self._pending or self._file is None:
+                return
+            # Off the event loop, it can take a while on a busy disk. Lines recorded in the meantime
+            # are in the file and in _pending, so they go out with this flush.
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+            self._inflight, self._pending = dict(self._pending), defaultdict(int)
+            self._ops = 0
+            last_seq = self._seq
+
+            # Rotate the journal so whatever gets recorded during the write ends up in a new file.
+            self._file.close()
+            os.replace(self.path, f'{self.path}.{last_seq}')
+            self._file = open(self.path, 'a')
+
+            try:
+                await self._write(self._inflight.items(), last_seq)
+            except BaseException:
+                for user_id, delta in self._inflight.items():
+                    self._pending[user_id] += delta
+                raise
+            else:
+                self._remove_segments(up_to=last_seq)
+            finally:
+                self._inflight = {}
+
+    async def close(self) -> None:
+        """|coro|
+
+        Stops the flusher and writes everything that is still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            if not self._pending:
+                os.remove(self.path)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to flush the balance journal, retrying in %ss', self.interval)
+                await asyncio.sleep(self.interval)
+
+    async def _write(self, deltas: Iterable[Tuple[int, int]], last_seq: int) -> None:
+        params = [(delta, user_id) for user_id, delta in deltas if delta]
+        async with self.pool.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await conn.executemany('UPDATE wallets SET balance = balance + ? WHERE user_id = ?', params)
+                await bump_wallet_version(conn)
+                await conn.execute('UPDATE balance_journal SET last_seq = ? WHERE id = 1', (last_seq,))
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+
+    def _segments(self) -> Dict[str, int]:
+        """Rotated journal files, mapped to the last sequence number they contain."""
+        segments = {}
+        for path in glob.glob(glob.escape(self.path) + '.*'):
+            suffix = path.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                segments[path] = int(suffix)
+        return segments
+
+    def _read_segments(self) -> Iterable[Tuple[int, int, int]]:
+        segments = self._segments()
+        paths = sorted(segments, key=segments.__getitem__)
+        if os.path.exists(self.path):
+            paths.append(self.path)
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        seq, user_id, delta = map(int, line.split())
+                    except ValueError:
+                        # A torn write from a crash, nothing after it made it to disk either.
+                        break
+                    yield seq, user_id, delta
+
+    def _remove_segments(self, up_to: Optional[int] = None) -> None:
+        for path, last_seq in self._segments().items():
+            if up_to is None or last_seq <= up_to:
+                os.remove(path)
+        if up_to is None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, Collection, List, Optional, Tuple
+
+import asqlite
+import discord
+from discord.ext import commands
+
+from .resolver import UserResolver
+
+if TYPE_CHECKING:
+    from .ranking import BalanceRanking
+
+
+SCOPE_TABLE = '''
+CREATE TEMP TABLE IF NOT EXISTS leaderboard_scope (
+  user_id INTEGER PRIMARY KEY
+);
+'''
+
+
+@dataclass(frozen=True)
+class LeaderboardEntry:
+    rank: int
+    user_id: int
+    balance: int
+
+
+class Leaderboard:
+    """Reads the leaderboard from the wallets table one page at a time.
+
+    Pages use keyset pagination over the ``wallets (balance DESC, user_id)`` index:
+    every page starts right after the last entry of the previous one, so going deeper
+    doesn't get any slower, and nothing past the current page is ever read.
+
+    Parameters
+    ----------
+    pool: asqlite.Pool
+        The pool to get connections from.
+    scope: Optional[Collection[int]]
+        If passed, only these users are ranked. They're loaded into a temporary
+        table that the queries join against.
+    page_size: int
+        How many entries are in a page.
+    ranking: Optional[BalanceRanking]
+        If passed, unscoped leaderboards are read from it once it's ready,
+        instead of the database.
+    """
+
+    def __init__(
+        self,
+        pool: asqlite.Pool,
+        scope: Optional[Collection[int]] = None,
+        *,
+        page_size: int = 10,
+        ranking: Optional[BalanceRanking] = None,
+    ) -> None:
+        self.pool = pool
+        self.scope = scope
+        self.page_size = page_size
+        self.ranking = ranking
+
+    @property
+    def in_memory(self) -> bool:
+        return self.scope is None and self.ranking is not None and self.ranking.ready
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[Tuple[asqlite.Connection, str]]:
+        """Acquires a connection, and gives back the JOIN clause needed to apply the scope."""
+        async with self.pool.acquire() as conn:
+            if self.scope is None:
+                yield conn, ''
+                return
+            await conn.executescript(SCOPE_TABLE)
+            await conn.execute('BEGIN')
+            try:
+                await conn.execute('DELETE FROM temp.leaderboard_scope')
+                await conn.executemany(
+                    'INSERT OR IGNORE INTO temp.leaderboard_scope (user_id) VALUES (?)', [(i,) for i in self.scope]
+                )
+                yield conn, 'JOIN temp.leaderboard_scope s ON s.user_id = w.user_id'
+            finally:
+                # Nothing in here needs to be kept around.
+                await conn.rollback()
+
+    async def page(self, after: Optional[LeaderboardEntry] = None) -> List[LeaderboardEntry]:
+        """|coro|
+
+        Gets the page of the leaderboard that comes right after the given entry.
+
+        Parameter
+        ---------
+        after: Optional[LeaderboardEntry]
+            The last entry of the previous page. If not passed, the first page is returned.
+        """
+        if self.in_memory:
+            assert self.ranking is not None
+            return self.ranking.page(after, self.page_size)
+        if after is None:
+            where, params, start = '', {}, 1
+        else:
+            # The first condition is the one the index range scan can use.
+            where = 'WHERE w.balance <= :balance AND (w.balance < :balance OR w.user_id > :user_id)'
+            params, start = {'balance': after.balance, 'user_id': after.user_id}, after.rank + 1
+
+        async with self._connection() as (conn, join):
+            rows = await conn.fetchall(
+                f'SELECT w.user_id, w.balance FROM wallets w {join} {where}'
+                ' ORDER BY w.balance DESC, w.user_id LIMIT :limit',
+                {**params, 'limit': self.page_size},
+            )
+        return [LeaderboardEntry(start + i, row['user_id'], row['balance']) for i, row in enumerate(rows)]
+
+    async def count(self) -> int:
+        """|coro|
+
+        How many users are on the leaderboard.
+        """
+        if self.in_memory:
+            assert self.ranking is not None
+            return len(self.ranking)
+        async with self._connection() as (conn, join):
+            row = await conn.fetchone(f'SELECT COUNT(*) AS value FROM wallets w {join}')
+        return row['value']
+
+    async def rank_of(self, user_id: int) -> Optional[LeaderboardEntry]:
+        """|coro|
+
+        Gets where a user stands on the leaderboard, or None if they don't have a wallet
+        (or aren't in the scope).
+
+        This counts the entries above the user on the balance index, no rows are read.
+        """
+        if self.in_memory:
+            assert self.ranking is not None
+            return self.ranking.entry(user_id)
+        async with self._connection() as (conn, join):
+            row = await conn.fetchone(f'SELECT w.balance FROM wallets w {join} WHERE w.user_id = ?', (user_id,))
+            if row is None:
+                return None
+            above = await conn.fetchone(
+                f'SELECT COUNT(*) AS value FROM wallets w {join}'
+                ' WHERE w.balance >= :balance AND (w.balance > :balance OR w.user_id < :user_id)',
+                {'balance': row['balance'], 'user_id': user_id},
+            )
+        return LeaderboardEntry(above['value'] + 1, user_id, row['balance'])
+
+
+class LeaderboardView(discord.ui.View):
+    """Paginates a :class:`Leaderboard` with previous/next buttons."""
+
+    message: discord.Message  # set when view sent.
+
+    def __init__(
+        self, ctx: commands.Context, leaderboard: Leaderboard, resolver: UserResolver, *, title: str, footer: str
+    ) -> None:
+        super().__init__(timeout=120.0)
+        self.ctx = ctx
+        self.leaderboard = leaderboard
+        self.resolver = resolver
+        self.title = title
+        self.footer = footer
+        # The last entry of every page before the current one, None for the first page.
+        self._cursors: List[Optional[LeaderboardEntry]] = [None]
+        self._entries: List[LeaderboardEntry] = []
+
+    @property
+    def page_number(self) -> int:
+        return len(self._cursors)
+
+    async def load(self) -> discord.Embed:
+        """|coro|
+
+        Loads the current page and builds its embed.
+        """
+        self._entries = await self.leaderboard.page(self._cursors[-1])
+        self.previous_page.disabled = len(self._cursors) == 1
+        # A full last page would otherwise lead to an empty one.
+        self.next_page.disabled = (
+            len(self._entries) < self.leaderboard.page_size or self._entries[-1].rank >= await self.leaderboard.count()
+        )
+        return await self.build_embed()
+
+    async def build_embed(self) -> discord.Embed:
+        cog = self.ctx.cog
+        symbol = getattr(cog, 'currency_symbol', '')
+        names = await self.resolver.resolve_many(entry.user_id for entry in self._entries)
+
+        lines = [
+            f'{entry.rank}) {symbol}{entry.balance} - {names[entry.user_id]} (ID: {entry.user_id})'
+            for entry in self._entries
+        ]
+        embed = discord.Embed(description='\n'.join(lines) or 'Nobody here yet.', title=self.title)
+        embed.set_footer(text=f'{self.footer} | Page {self.page_number}')
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user == self.ctx.author:
+            return True
+        await interaction.response.send_message('This is not your leaderboard.', ephemeral=True)
+        return False
+
+    async def on_timeout(self) -> None:
+        await self.message.edit(view=None)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.blurple)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        self._cursors.pop()
+        await interaction.response.edit_message(embed=await self.load(), view=self)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.blurple)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        self._cursors.append(self._entries[-1])
+        await interaction.response.edit_message(embed=await self.load(), view=self)
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from logging import getLogger
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import asqlite
+
+from main import getenv_flag, getenv_int
+
+log = getLogger('BotChallenge.ledger')
+
+# Rows per INSERT, 4 parameters each keeps it well under SQLite's default limit of 999.
+BATCH_SIZE = 200
+
+
+class LedgerEntry(NamedTuple):
+    user_id: int
+    ts: int
+    delta: int
+    kind: str
+
+
+class LedgerTotals(NamedTuple):
+    earned: int
+    spent: int
+
+
+class Ledger:
+    """Append-only history of every balance change, for audits and things like "earned in the last 24h".
+
+    Changes made as part of a transaction are added to it with :meth:`write`, so they're committed
+    (or rolled back) with it. Everything else is buffered by :meth:`record` and written every
+    ``interval`` seconds, or once ``max_pending`` entries are waiting, with multi-row ``INSERT``\\s
+    in one transaction. Neither costs a commit of its own. Buffered entries are lost if the bot
+    crashes, the balances themselves aren't.
+
+    Every ``snapshot_interval`` seconds, every balance is copied to ``ledger_snapshots``, and
+    entries and snapshots older than ``retention`` seconds are deleted, except for the last
+    snapshot before that. So any balance in the retention window is a snapshot plus the
+    entries after it. Entries from the same second as that snapshot may already be in it,
+    so reads only go back to the second after it.
+    """
+
+    def __init__(
+        self,
+        pool: asqlite.Pool,
+        *,
+        interval: float = 2.0,
+        max_pending: int = 1000,
+        snapshot_interval: int = 24 * 60 * 60,
+        retention: int = 30 * 24 * 60 * 60,
+    ) -> None:
+        self.pool = pool
+        self.interval = interval
+        self.max_pending = max_pending
+        self.snapshot_interval = snapshot_interval
+        self.retention = retention
+        self._pending: List[LedgerEntry] = []
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task[None]] = []
+
+    @classmethod
+    def from_env(cls, pool: asqlite.Pool) -> Optional[Ledger]:
+        """Creates a ledger from the .env settings, or returns None if it's disabled."""
+        if not getenv_flag('LEDGER', True):
+            return None
+        return cls(
+            pool,
+            interval=getenv_int('LEDGER_FLUSH_INTERVAL_MS', 2000) / 1000,
+            snapshot_interval=getenv_int('LEDGER_SNAPSHOT_INTERVAL', 24 * 60 * 60),
+            retention=getenv_int('LEDGER_RETENTION_DAYS', 30) * 24 * 60 * 60,
+        )
+
+    def record(self, user_id: int, delta: int, kind: str) -> None:
+        """Records a balance change that was already committed. It's written on the next flush."""
+        if not delta:
+            return
+        self._pending.append(LedgerEntry(user_id, int(time.time()), delta, kind))
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def write(self, conn: asqlite.Connection, changes: Iterable[Tuple[int, int]], kind: str) -> None:
+        """|coro|
+
+        Adds balance changes to the ledger as part of the transaction ``conn`` is in.
+
+        Parameter
+        ---------
+        conn: asqlite.Connection
+            A connection in a transaction.
+        changes: Iterable[Tuple[int, int]]
+            (user ID, change in balance) pairs.
+        kind: str
+            What the changes were for.
+        """
+        now = int(time.time())
+        await self._insert(conn, [LedgerEntry(user_id, now, delta, kind) for user_id, delta in changes if delta])
+
+    async def flush(self) -> None:
+        """|coro|
+
+        Writes the buffered entries in one transaction.
+        """
+        async with self._lock:
+            if not self._pending:
+                return
+            entries, self._pending = self._pending, []
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        await self._insert(conn, entries)
+                    except BaseException:
+                        await conn.rollback()
+                        raise
+                    await conn.commit()
+            except BaseException:
+                self._pending[:0] = entries
+                raise
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._run()))
+        if self.snapshot_interval > 0:
+            self._tasks.append(asyncio.create_task(self._snapshot_forever()))
+
+    async def close(self) -> None:
+        """|coro|
+
+        Stops the background tasks and writes whatever is still buffered.
+        """
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        await self.flush()
+
+    async def snapshot(self) -> int:
+        """|coro|
+
+        Copies every balance to ``ledger_snapshots`` and deletes what's past the retention.
+        Returns how many entries were deleted.
+        """
+        await self.flush()
+        now = int(time.time())
+        cutoff = now - self.retention
+        async with self.pool.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await conn.execute(
+                    'INSERT OR REPLACE INTO ledger_snapshots (taken_at, user_id, balance)'
+                    ' SELECT ?, user_id, balance FROM wallets',
+                    (now,),
+                )
+                base = await self._base(conn, cutoff)
+                deleted = 0
+                if base is not None:
+                    await conn.execute('DELETE FROM ledger_snapshots WHERE taken_at < ?', (base,))
+                    await conn.execute('DELETE FROM ledger WHERE ts < ?', (base,))
+                    deleted = (await conn.fetchone('SELECT changes() AS deleted'))['deleted']
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+        log.info('Took a ledger snapshot, deleted %s old entries', deleted)
+        return deleted
+
+    async def totals(self, user_id: int, since: int) -> LedgerTotals:
+        """|coro|
+
+        How much a user earned and spent since a unix timestamp, from the index alone.
+        Buffered entries are included.
+        """
+        async with self.pool.acquire() as conn:
+            since = max(since, await self._window_start(conn))
+            row = await conn.fetchone(
+                'SELECT COALESCE(SUM(MAX(delta, 0)), 0) AS earned, COALESCE(SUM(MIN(delta, 0)), 0) AS spent'
+                ' FROM ledger WHERE user_id = ? AND ts >= ?',
+                (user_id, since),
+            )
+        earned, spent = row['earned'], -row['spent']
+        for entry in self._pending:
+            if entry.user_id == user_id and entry.ts >= since:
+                if entry.delta > 0:
+                    earned += entry.delta
+                else:
+                    spent -= entry.delta
+        return LedgerTotals(earned, spent)
+
+    async def history(self, user_id: int, *, limit: int = 10) -> List[LedgerEntry]:
+        """|coro|
+
+        A user's most recent balance changes, newest first.
+        """
+        async with self.pool.acquire() as conn:
+            since = await self._window_start(conn)
+            rows = await conn.fetchall(
+                'SELECT user_id, ts, delta, kind FROM ledger WHERE user_id = ? AND ts >= ?'
+                ' ORDER BY ts DESC, entry_id DESC LIMIT ?',
+                (user_id, since, limit),
+            )
+        pending = [entry for entry in reversed(self._pending) if entry.user_id == user_id and entry.ts >= since][:limit]
+        return (pending + [LedgerEntry(*row) for row in rows])[:limit]
+
+    async def _base(self, conn: asqlite.Connection, cutoff: int) -> Optional[int]:
+        # The newest snapshot that's past the retention is what the entries after it build on.
+        row = await conn.fetchone('SELECT MAX(taken_at) AS taken_at FROM ledger_snapshots WHERE taken_at <= ?', (cutoff,))
+        return row['taken_at']
+
+    async def _window_start(self, conn: asqlite.Connection) -> int:
+        # The first second that isn't covered by the base snapshot, strictly after it.
+        base = await self._base(conn, int(time.time()) - self.retention)
+        return 0 if base is None else base + 1
+
+    async def _insert(self, conn: asqlite.Connection, entries: Sequence[LedgerEntry]) -> None:
+        for start in range(0, len(entries), BATCH_SIZE):
+            batch = entries[start : start + BATCH_SIZE]
+            values = ', '.join(['(?, ?, ?, ?)'] * len(batch))
+            await conn.execute(
+                f'INSERT INTO ledger (user_id, ts, delta, kind) VALUES {values}',
+                tuple(value for entry in batch for value in entry),
+            )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to write the ledger, retrying in %ss', self.interval)
+                await asyncio.sleep(self.interval)
+
+    async def _snapshot_forever(self) -> None:
+        while True:
+            # Counting from the last snapshot, so restarts don't keep pushing it back
+            # (and other processes sharing the database don't take one too).
+            async with self.pool.acquire() as conn:
+                last = (await conn.fetchone('SELECT MAX(taken_at) AS taken_at FROM ledger_snapshots'))['taken_at']
+            due = (last or 0) + self.snapshot_interval
+            if due > time.time():
+                await asyncio.sleep(due - time.time())
+                continue
+            try:
+                await self.snapshot()
+            except Exception:
+                log.exception('Failed to take a ledger snapshot')
+                await asyncio.sleep(self.snapshot_interval)
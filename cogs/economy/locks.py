@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+from components.metrics import Metrics
+from main import getenv_int
+
+# Fibonacci hashing: snowflakes end in a per-process counter that's usually small,
+# so their low bits alone would pile most users onto a few stripes.
+_GOLDEN = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+
+class UserLocks:
+    """A fixed number of locks that every user's wallet changes are serialized on.
+
+    Each user ID hashes to one of ``stripes`` locks, so memory stays the same however
+    many users there are, at the cost of two users now and then sharing a lock. While a
+    command holds a user's lock, nothing else in this process changes their wallet, so
+    checking the cached balance is enough to know a withdrawal will go through, and
+    concurrent commands from the same user don't race each other into failed updates.
+
+    Operations on two users take both locks in stripe order, so two of them going
+    opposite ways (A pays B while B pays A) can't deadlock. Locks have to be taken
+    before a connection or a database transaction, never while holding one.
+
+    How long was waited for a lock that was taken is recorded as ``user_lock_wait_seconds``,
+    uncontended acquisitions only count towards :attr:`acquired`.
+    """
+
+    def __init__(self, stripes: int = 256, *, metrics: Optional[Metrics] = None) -> None:
+        # A power of two, so the top bits of the hash pick the stripe.
+        self._bits = max(stripes - 1, 1).bit_length()
+        self._locks = [asyncio.Lock() for _ in range(1 << self._bits)]
+        self.metrics = metrics
+        self.acquired = 0
+        self.contended = 0
+
+    @classmethod
+    def from_env(cls, metrics: Optional[Metrics] = None) -> UserLocks:
+        return cls(getenv_int('USER_LOCK_STRIPES', 256), metrics=metrics)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def stripe(self, user_id: int) -> int:
+        """The index of the lock a user's changes are serialized on."""
+        return ((user_id * _GOLDEN) & _MASK) >> (64 - self._bits)
+
+    def locked(self, user_id: int) -> bool:
+        return self._locks[self.stripe(user_id)].locked()
+
+    @asynccontextmanager
+    async def hold(self, *user_ids: int) -> AsyncIterator[None]:
+        """Holds the locks of all the given users for the ``async with`` block."""
+        await self._acquire(sorted({self.stripe(user_id) for user_id in user_ids}))
+        try:
+            yield
+        finally:
+            for index in {self.stripe(user_id) for user_id in user_ids}:
+                self._locks[index].release()
+
+    @asynccontextmanager
+    async def hold_all(self) -> AsyncIterator[None]:
+        """Holds every lock, so no wallet changes are in progress during the block."""
+        indexes = list(range(len(self._locks)))
+        await self._acquire(indexes)
+        try:
+            yield
+        finally:
+            for index in indexes:
+                self._locks[index].release()
+
+    async def _acquire(self, indexes: List[int]) -> None:
+        # Always in ascending order, that's what keeps two-user operations from deadlocking.
+        taken: List[int] = []
+        try:
+            for index in indexes:
+                lock = self._locks[index]
+                self.acquired += 1
+                if not lock.locked():
+                    # Uncontended, this doesn't yield to the event loop.
+                    await lock.acquire()
+                    taken.append(index)
+                    continue
+                self.contended += 1
+                started = time.perf_counter()
+                await lock.acquire()
+                taken.append(index)
+                if self.metrics is not None:
+                    self.metrics.observe('user_lock_wait_seconds', time.perf_counter() - started)
+        except BaseException:
+            # Cancelled while waiting, let go of the ones we already got.
+            for index in taken:
+                self._locks[index].release()
+            raise
@@ -1,60 +1,198 @@
 import random
+import sqlite3
 from datetime import datetime
 from logging import getLogger
+from typing import List, Optional, Tuple
 
+import asqlite
 import discord
 from discord.ext import commands, tasks
 
+from components.cluster import LeaderLease
+from main import BotChallenge
+
 from .base_cog import BaseEconomyCog
+from .operations import bump_wallet_version
+from .scheduler import DeadlineScheduler, RetryLater
 
 log = getLogger('BotChallenge.lottery')
 
+TICKET_PRICE = 25
+# How many times a ticket of someone who quit is drawn again, before drawing from the rest directly.
+MAX_REDRAWS = 5
+
 
 class Lottery(BaseEconomyCog):
     """All lottery related commands/tasks"""
 
-    @tasks.loop(minutes=1)
-    async def lottery_check(self):
-        """Check if any lotteries have ended and draw a winner"""
+    def __init__(self, bot: BotChallenge) -> None:
+        super().__init__(bot)
+        self.lottery_scheduler: DeadlineScheduler[int] = DeadlineScheduler(self.draw_lotteries, name='lottery')
+        self.lottery_lease: Optional[LeaderLease] = None
+
+    async def start_lotteries(self) -> None:
+        """|coro|
+
+        Starts creating and drawing lotteries. In a cluster, only the process
+        holding the lottery lease does that.
+        """
+        if self.bot.cluster is None:
+            await self.lead_lotteries()
+            return
+        self.lottery_lease = self.bot.cluster.lease(self.bot.pool, 'lottery')
+        self.lottery_lease.start(on_elected=self.lead_lotteries, on_deposed=self.stop_lotteries)
+
+    async def lead_lotteries(self) -> None:
+        await self.start_lottery_scheduler()
+        self.create_lottery.start()
+
+    async def stop_lotteries(self) -> None:
+        self.create_lottery.cancel()
+        self.lottery_scheduler.stop()
 
+    async def start_lottery_scheduler(self) -> None:
+        """|coro|
+
+        Schedules every lottery that still needs to be drawn, and starts the scheduler.
+        The draws themselves only start happening once the bot is ready.
+        """
         async with self.bot.pool.acquire() as conn:
-            lottery = await conn.fetchone(
-                'SELECT * FROM lottery WHERE winner IS NULL and end_time <= :current_time',
+            # Lotteries that ended without entries never get a winner, there's nothing left to do for them.
+            lotteries = await conn.fetchall(
+                'SELECT lot_id, end_time FROM lottery WHERE winner IS NULL AND (end_time > :current_time OR tickets > 0)',
                 {'current_time': round(datetime.now().timestamp())},
             )
-            await conn.commit()
+        for lottery in lotteries:
+            self.lottery_scheduler.schedule(lottery['lot_id'], lottery['end_time'])
+        self.lottery_scheduler.start(before=self.bot.wait_until_ready)
+        log.info(f'Scheduled {len(lotteries)} pending lotteries')
 
-        if not lottery:
-            return
+    async def draw_lotteries(self, lottery_ids: List[int]) -> None:
+        """Draws a winner for every lottery that has ended, each in its own transaction
+
+        One lottery failing doesn't hold up the others, the ones that failed are retried later.
+        """
+        failed: List[int] = []
+        drawn = False
+        for lottery_id in lottery_ids:
+            try:
+                drawn |= await self.draw_lottery(lottery_id)
+            except Exception:
+                log.exception(f'Could not draw lottery {lottery_id}')
+                failed.append(lottery_id)
+        if drawn:
+            self.notifier.wake()
+        if failed:
+            raise RetryLater(failed)
+
+    async def draw_lottery(self, lottery_id: int) -> bool:
+        """|coro|
+
+        Draws the winner of a lottery that has ended and pays them, in one transaction.
+
+        The winner is drawn before that transaction, so their lock can be taken first.
+        If they quit in between, the lottery is drawn again.
+
+        Returns whether it had a winner.
+        """
+        while True:
+            async with self.bot.pool.acquire() as conn:
+                lottery = await conn.fetchone(
+                    'SELECT * FROM lottery WHERE lot_id = ? AND winner IS NULL AND end_time <= ?',
+                    (lottery_id, round(datetime.now().timestamp())),
+                )
+                # Check if there are any entrants
+                if lottery is None or not lottery['tickets']:
+                    return False
+                winner_id = await self._pick_winner(conn, lottery)
+                if winner_id is None:
+                    # Everyone who entered has quit since, so it's over without a winner.
+                    await conn.execute('UPDATE lottery SET tickets = 0 WHERE lot_id = ? AND winner IS NULL', (lottery_id,))
+                    await conn.commit()
+                    log.warning(f'Lottery {lottery_id} ended without a winner, everyone who entered quit')
+                    return False
+
+            async with self.user_locks.hold(winner_id):
+                async with self.bot.pool.acquire() as conn:
+                    await conn.execute('BEGIN IMMEDIATE')
+                    try:
+                        result = await self._pay(conn, lottery_id, winner_id)
+                    except BaseException:
+                        await conn.rollback()
+                        raise
+                    if result is None:
+                        await conn.rollback()
+                    else:
+                        await conn.commit()
+                if result is None:
+                    continue
+                if not result:
+                    # Someone else drew it in the meantime.
+                    return False
+
+                amount, balance = result
+                # Only now that it's committed, the same way EconomyTransaction does it.
+                wallet = self._wallets.peek(winner_id)
+                if wallet is not None:
+                    wallet._set_balance(wallet.balance + amount)
+                    wallet._publish()
+                else:
+                    self.ranking.update(winner_id, balance)
+                    self.publish_wallet(winner_id, balance)
+            log.info(f"Lottery {lottery_id} ended. Winner ID: {winner_id}")
+            return True
+
+    async def _pay(self, conn: asqlite.Connection, lottery_id: int, winner_id: int) -> Optional[Tuple[int, ...]]:
+        # (prize, their balance in the database), () if the lottery has been drawn already,
+        # or None if the winner quit after being drawn.
+        lottery = await conn.fetchone('SELECT * FROM lottery WHERE lot_id = ? AND winner IS NULL', (lottery_id,))
+        if lottery is None:
+            return ()
 
-        print(lottery)
-        winner = None
-        # Check if there are any entrants
-        if not lottery['entries']:
-            return
         amount = lottery['bal']
-        # Split all the user ids into a list
-        entrants = lottery['entries'].split(',')
         # Check if there is only one entrant
-        if len(entrants) == 1:
+        single = await conn.fetchone(
+            'SELECT MIN(user_id) = MAX(user_id) AS value FROM lottery_entries WHERE lot_id = ?', (lottery_id,)
+        )
+        if single['value']:
             amount *= random.randint(1, 5)
-            winner = entrants[0]
-        # Pick a winner
-        if winner is None:
-            winner = random.choice(entrants)
-        # Get winner's wallet
-        winner = await self.bot.fetch_user(winner)
-        wallet = await self.get_wallet(winner)
         # Give the winner their prize
-        async with self.bot.pool.acquire() as conn:
-            await wallet.add(amount, connection=conn)
-            await conn.execute(
-                'UPDATE lottery SET winner = :winner WHERE lot_id = :id', {'winner': winner.id, 'id': lottery['lot_id']}
+        row = await conn.fetchone(
+            'UPDATE wallets SET balance = balance + ? WHERE user_id = ? RETURNING balance', (amount, winner_id)
+        )
+        if row is None:
+            return None
+        await bump_wallet_version(conn)
+        if self.ledger is not None:
+            await self.ledger.write(conn, [(winner_id, amount)], 'lottery')
+        await conn.execute('UPDATE lottery SET winner = :winner WHERE lot_id = :id', {'winner': winner_id, 'id': lottery_id})
+        # Tell the winner, it's only sent once this transaction is committed.
+        await self.notifier.notify(
+            winner_id, f'You won the lottery! You won {self.currency_symbol}{amount}', connection=conn
+        )
+        return amount, row['balance']
+
+    async def _pick_winner(self, conn: asqlite.Connection, lottery: sqlite3.Row) -> Optional[int]:
+        # Every ticket has the same chance, but entrants that quit since don't have a wallet to pay.
+        # Drawing again when that happens keeps the chances even among the ones that are left.
+        for _ in range(MAX_REDRAWS):
+            winner = await conn.fetchone(
+                'SELECT lottery_entries.user_id, wallets.user_id IS NOT NULL AS has_wallet FROM lottery_entries'
+                ' LEFT JOIN wallets ON wallets.user_id = lottery_entries.user_id'
+                ' WHERE lot_id = ? AND first_ticket <= ? ORDER BY first_ticket DESC LIMIT 1',
+                (lottery['lot_id'], random.randrange(lottery['tickets'])),
             )
-            await conn.commit()
-        # Send a message to the winner
-        await winner.send(f'You won the lottery! You won {self.currency_symbol}{lottery["bal"]}')
-        log.info(f"Lottery ended. Winner: {winner} (ID: {winner.id})")
+            if winner['has_wallet']:
+                return winner['user_id']
+        # Most of the tickets belong to people who quit, so draw from the rest directly.
+        entries = await conn.fetchall(
+            'SELECT lottery_entries.user_id, lottery_entries.tickets FROM lottery_entries'
+            ' JOIN wallets ON wallets.user_id = lottery_entries.user_id WHERE lot_id = ?',
+            (lottery['lot_id'],),
+        )
+        if not entries:
+            return None
+        return random.choices([entry['user_id'] for entry in entries], [entry['tickets'] for entry in entries])[0]
 
     # Create a lottery at random
     @tasks.loop(hours=1)
@@ -67,20 +205,17 @@ class Lottery(BaseEconomyCog):
         log.info("Starting a lottery")
 
         async with self.bot.pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO lottery (bal, entries, start_time, end_time) VALUES (:start_bal, :entries, :start_time, :end_time)',
+            lottery = await conn.fetchone(
+                'INSERT INTO lottery (bal, start_time, end_time) VALUES (:start_bal, :start_time, :end_time)'
+                ' RETURNING lot_id, end_time',
                 {
                     'start_time': round(datetime.now().timestamp()),
                     'end_time': round(datetime.now().timestamp()) + 3600,
                     'start_bal': 0,
-                    'entries': None,
                 },
             )
             await conn.commit()
-
-    @lottery_check.before_loop
-    async def before_lottery_check(self):
-        await self.bot.wait_until_ready()
+        self.lottery_scheduler.schedule(lottery['lot_id'], lottery['end_time'])
 
     # View the currently running lottery
     @commands.command()
@@ -92,17 +227,19 @@ class Lottery(BaseEconomyCog):
                 'SELECT * FROM lottery WHERE start_time < :current_time AND end_time > :current_time',
                 {'current_time': round(datetime.now().timestamp())},
             )
-            await conn.commit()
+            if lottery:
+                participants = await conn.fetchone(
+                    'SELECT COUNT(DISTINCT user_id) AS value FROM lottery_entries WHERE lot_id = ?', (lottery['lot_id'],)
+                )
 
         if not lottery:
             return await ctx.send('There is no lottery running at the moment')
         embed = discord.Embed(title='Lottery', description=f'Lottery ID: {lottery["lot_id"]}')
         embed.add_field(name='Prize', value=f'{self.currency_symbol}{lottery["bal"]}', inline=False)
-        # Split all the user ids into a list
-        entrants = lottery['entries'].split(',') if lottery['entries'] else ''
-        embed.add_field(name='Participants', value=f'{len(entrants)}', inline=False)
+        embed.add_field(name='Participants', value=f'{participants["value"]}', inline=False)
+        embed.add_field(name='Tickets', value=f'{lottery["tickets"]}', inline=False)
         embed.add_field(
-            name='Winner', value=f'{lottery["winner"] if lottery["winner"] == 0 else "Not yet drawn"}', inline=False
+            name='Winner', value=f'<@{lottery["winner"]}>' if lottery['winner'] else 'Not yet drawn', inline=False
         )
         await ctx.send(embed=embed)
 
@@ -114,16 +251,17 @@ class Lottery(BaseEconomyCog):
         duration = duration * 60
 
         async with self.bot.pool.acquire() as conn:
-            await conn.execute(
-                'INSERT INTO lottery (bal, entries, start_time, end_time) VALUES (:start_bal, :entries, :start_time, :end_time)',
+            lottery = await conn.fetchone(
+                'INSERT INTO lottery (bal, start_time, end_time) VALUES (:start_bal, :start_time, :end_time)'
+                ' RETURNING lot_id, end_time',
                 {
                     'start_time': round(datetime.now().timestamp()),
                     'end_time': round(datetime.now().timestamp()) + duration,
                     'start_bal': 0,
-                    'entries': None,
                 },
             )
             await conn.commit()
+        self.lottery_scheduler.schedule(lottery['lot_id'], lottery['end_time'])
 
         await ctx.send(f'Lottery started for {duration/60} minutes')
 
@@ -137,44 +275,39 @@ class Lottery(BaseEconomyCog):
                 'UPDATE lottery SET end_time = :end_time WHERE lot_id = :id', {'end_time': 0, 'id': lottery_id}
             )
             await conn.commit()
+        self.lottery_scheduler.schedule(lottery_id, 0)
 
         await ctx.send('Lottery ended')
 
     @commands.command()
-    async def enter(self, ctx: commands.Context):
-        """Enter the lottery"""
+    async def enter(self, ctx: commands.Context, tickets: int = 1):
+        """Enter the lottery, optionally with more than one ticket"""
 
-        async with self.bot.pool.acquire() as conn:
-            lottery = await conn.fetchone(
-                'SELECT * FROM lottery WHERE start_time < :current_time AND end_time > :current_time',
-                {'current_time': round(datetime.now().timestamp())},
-            )
-            await conn.commit()
-
-        if not lottery:
-            return await ctx.send('There is no lottery running at the moment')
+        if tickets < 1:
+            raise commands.BadArgument('You need to buy at least one ticket.')
+        price = TICKET_PRICE * tickets
+        async with self.user_locks.hold(ctx.author.id):
+            wallet = await self.get_wallet(ctx.author)
+            if wallet.balance < price:
+                raise commands.BadArgument(f'You need at least {price} to enter the lottery with {tickets} tickets')
 
-        wallet = await self.get_wallet(ctx.author)
-        if wallet.balance < 25:
-            return await ctx.send('You need at least 25 to enter the lottery')
+            async def claim_tickets(conn: asqlite.Connection) -> None:
+                # Claim a range of ticket numbers, and add the price to the prize pool
+                lottery = await conn.fetchone(
+                    'UPDATE lottery SET tickets = tickets + :tickets, bal = bal + :price'
+                    ' WHERE lot_id = (SELECT lot_id FROM lottery'
+                    ' WHERE start_time < :current_time AND end_time > :current_time)'
+                    ' RETURNING lot_id, tickets - :tickets AS first_ticket',
+                    {'tickets': tickets, 'price': price, 'current_time': round(datetime.now().timestamp())},
+                )
+                if not lottery:
+                    raise commands.BadArgument('There is no lottery running at the moment')
+                await conn.execute(
+                    'INSERT INTO lottery_entries (lot_id, user_id, tickets, first_ticket) VALUES (?, ?, ?, ?)',
+                    (lottery['lot_id'], ctx.author.id, tickets, lottery['first_ticket']),
+                )
 
-        async with self.bot.pool.acquire() as conn:
-            await wallet.withdraw(25, connection=conn)
-            # Fetch current entries
-            lottery = await conn.fetchone('SELECT * FROM lottery WHERE lot_id = :id', {'id': lottery['lot_id']})
-            if not lottery['entries']:
-                entries = str(ctx.author.id)
-            else:
-                entries = f'{lottery["entries"]},{ctx.author.id}'
-            await conn.execute(
-                'UPDATE lottery SET entries = :entries, bal = :bal, entries = :entries WHERE lot_id = :id',
-                {
-                    'entries': f'{lottery["entries"]},{ctx.author.id}',
-                    'bal': lottery['bal'] + 25,
-                    'entries': entries,
-                    'id': lottery['lot_id'],
-                },
-            )
-            await conn.commit()
+            # The cached wallet only changes once all of it is committed.
+            await self.transaction('lottery').withdraw(wallet, price).commit(extra=claim_tickets)
 
-        await ctx.send(f'You entered the lottery for {self.currency_symbol}25')
+        await ctx.send(f'You entered the lottery with {tickets} tickets for {self.currency_symbol}{price}')
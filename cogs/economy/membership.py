@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from logging import getLogger
+from typing import Dict, Iterable, Set, Tuple
+
+import asqlite
+import discord
+
+from main import getenv_int
+
+log = getLogger('BotChallenge.membership')
+
+
+class RegisteredUsers:
+    """In-memory index of the user IDs that have a wallet.
+
+    The bulk of the IDs live in a sorted ``array('q')`` (8 bytes per user, instead of
+    the ~60 a Python int in a set costs) and are looked up with a binary search.
+    Wallets opened or closed since then are kept in two small sets, which get merged
+    into the array once they grow past ``compact_threshold``.
+
+    The index is *cold* until :meth:`load` finishes, callers should ask the database
+    while :attr:`ready` is False.
+    """
+
+    def __init__(self, *, compact_threshold: int = 4096) -> None:
+        self.compact_threshold = compact_threshold
+        self._ids = array('q')
+        self._added: Set[int] = set()
+        self._removed: Set[int] = set()
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._added) - len(self._removed)
+
+    def __contains__(self, user_id: int) -> bool:
+        if user_id in self._removed:
+            return False
+        return user_id in self._added or self._in_base(user_id)
+
+    @property
+    def nbytes(self) -> int:
+        return self._ids.itemsize * len(self._ids)
+
+    def add(self, user_id: int) -> None:
+        self._removed.discard(user_id)
+        if not self._in_base(user_id):
+            self._added.add(user_id)
+            self._maybe_compact()
+
+    def discard(self, user_id: int) -> None:
+        self._added.discard(user_id)
+        # While cold, the base array isn't loaded yet, so the load has to sort it out.
+        if not self.ready or self._in_base(user_id):
+            self._removed.add(user_id)
+            self._maybe_compact()
+
+    async def load(self, pool: asqlite.Pool) -> None:
+        """|coro|
+
+        Loads every registered user ID from the database.
+        """
+        async with pool.acquire() as conn:
+            rows = await conn.fetchall('SELECT user_id FROM wallets ORDER BY user_id')
+        self.replace(row[0] for row in rows)
+        self.ready = True
+        log.info('Loaded %s registered users (%s KiB)', len(self), self.nbytes // 1024)
+
+    def replace(self, sorted_ids: Iterable[int]) -> None:
+        """Replaces the base array, keeping any changes recorded while it was being loaded."""
+        self._ids = array('q', sorted_ids)
+        # Changes that raced the load might already be in there.
+        self._added = {user_id for user_id in self._added if not self._in_base(user_id)}
+        self._removed = {user_id for user_id in self._removed if self._in_base(user_id)}
+
+    async def contains(self, user_id: int, pool: asqlite.Pool) -> bool:
+        """|coro|
+
+        Checks if a user has a wallet, falling back to the database if the index is cold.
+        """
+        if self.ready:
+            return user_id in self
+        async with pool.acquire() as conn:
+            row = await conn.fetchone('SELECT EXISTS(SELECT user_id FROM wallets WHERE user_id = ?) AS value', (user_id,))
+        return bool(row['value'])
+
+    def _in_base(self, user_id: int) -> bool:
+        index = bisect_left(self._ids, user_id)
+        return index < len(self._ids) and self._ids[index] == user_id
+
+    def _maybe_compact(self) -> None:
+        if len(self._added) + len(self._removed) < self.compact_threshold:
+            return
+        removed = self._removed
+        merged = [user_id for user_id in self._ids if user_id not in removed] if removed else list(self._ids)
+        merged.extend(self._added)
+        merged.sort()
+        self._ids = array('q', merged)
+        self._added.clear()
+        self._removed.clear()
+
+
+class GuildMembers:
+    """Member IDs of guilds whose members aren't cached, requested when they're needed.
+
+    With the lean gateway profile, guilds aren't chunked and members aren't cached. Things like
+    the guild leaderboard call :meth:`ids` instead, which requests the guild's members without
+    caching them, and keeps only their IDs in a sorted ``array('q')`` for ``ttl`` seconds.
+    At most ``max_guilds`` guilds are kept, the least recently used one is dropped first.
+    Concurrent requests for the same guild share one chunk request.
+
+    Guilds that are chunked already (the full profile) are read from the member cache directly.
+    """
+
+    def __init__(self, *, ttl: int = 10 * 60, max_guilds: int = 100) -> None:
+        self.ttl = ttl
+        self.max_guilds = max_guilds
+        # guild_id: (member IDs, fetched_at)
+        self._members: OrderedDict[int, Tuple[array[int], float]] = OrderedDict()
+        self._inflight: Dict[int, asyncio.Task[array[int]]] = {}
+
+    @classmethod
+    def from_env(cls) -> GuildMembers:
+        return cls(ttl=getenv_int('GUILD_MEMBERS_TTL', 10 * 60))
+
+    async def ids(self, guild: discord.Guild) -> array[int]:
+        """|coro|
+
+        Gets the IDs of a guild's members, sorted.
+        """
+        if guild.chunked:
+            return array('q', sorted(member.id for member in guild.members))
+
+        cached = self._members.get(guild.id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            self._members.move_to_end(guild.id)
+            return cached[0]
+
+        task = self._inflight.get(guild.id)
+        if task is None:
+            task = self._inflight[guild.id] = asyncio.create_task(self._chunk(guild))
+            task.add_done_callback(lambda _: self._inflight.pop(guild.id, None))
+        return await asyncio.shield(task)
+
+    def invalidate(self, guild_id: int) -> None:
+        self._members.pop(guild_id, None)
+
+    async def _chunk(self, guild: discord.Guild) -> array[int]:
+        started = time.perf_counter()
+        members = await guild.chunk(cache=False)
+        ids = array('q', sorted(member.id for member in members))
+        self._members[guild.id] = (ids, time.monotonic())
+        self._members.move_to_end(guild.id)
+        while len(self._members) > self.max_guilds:
+            self._members.popitem(last=False)
+        log.debug('Requested %s members of guild %s in %.2fs', len(ids), guild.id, time.perf_counter() - started)
+        return ids
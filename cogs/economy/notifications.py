@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import sqlite3
+import time
+from logging import getLogger
+from typing import TYPE_CHECKING, Dict, List, Optional, Set
+
+import asqlite
+import discord
+
+from main import getenv_int
+
+if TYPE_CHECKING:
+    from main import BotChallenge
+
+log = getLogger('BotChallenge.notifications')
+
+# Waiting longer than this on one user's rate limit would hold up everyone queued behind them
+# on the same worker, so the notification goes back to the outbox instead.
+MAX_ROUTE_WAIT = 1.0
+# How many routes to keep rate limits for before forgetting the ones that expired.
+MAX_ROUTES = 10_000
+
+
+class Notifier:
+    """Sends DMs in the background, so whatever wants to tell a user something doesn't wait on Discord.
+
+    Notifications are written to the ``notification_outbox`` table first, and only removed
+    once they've been delivered (or can't ever be), so they survive restarts.
+
+    - Each user is always handled by the same worker, one DM at a time. That keeps their
+      DMs in order, and never has two requests waiting on the same DM channel's rate limit.
+    - Every route (a user's DM channel) has its own bucket: DMs to the same user are at least
+      ``route_interval`` seconds apart, and a 429 from Discord blocks that route until its
+      ``retry_after`` is over. A route that's blocked for longer than a moment doesn't hold
+      up its worker, its notification goes back to the outbox until then. All workers
+      together still send at most ``rate`` DMs per second, to stay clear of the global limit.
+    - Failed sends are retried with exponential backoff, up to ``max_attempts`` times.
+      Users that closed their DMs or don't exist anymore are dropped right away.
+    - Notifications with a ``key`` replace the undelivered one with the same key for that user,
+      so e.g. five robberies while someone's DMs are failing become one message, not five.
+    - The in-memory queues are bounded. Whatever doesn't fit stays in the outbox until
+      the next sweep picks it up.
+    - A notification is claimed for ``claim_timeout`` seconds when it's queued, so when several
+      processes share the outbox (see ``components/cluster.py``) only one of them sends it.
+      If that process dies, it's sent by someone else once the claim runs out.
+
+    Parameters
+    ----------
+    bot: BotChallenge
+        The bot to send DMs with.
+    workers: int
+        How many DMs can be in flight at once.
+    rate: float
+        The most DMs per second, across all workers.
+    route_interval: float
+        The least time between two DMs to the same user, in seconds.
+    max_queued: int
+        How many notifications can be waiting in memory.
+    max_attempts: int
+        How many times to try sending a notification before giving up on it.
+    claim_timeout: int
+        How long a queued notification is reserved for this process, in seconds.
+    """
+
+    def __init__(
+        self,
+        bot: BotChallenge,
+        *,
+        workers: int = 2,
+        rate: float = 5.0,
+        route_interval: float = 1.0,
+        max_queued: int = 1000,
+        max_attempts: int = 5,
+        sweep_interval: float = 30.0,
+        claim_timeout: int = 5 * 60,
+    ) -> None:
+        self.bot = bot
+        self.rate = rate
+        self.route_interval = route_interval
+        self.max_attempts = max_attempts
+        self.sweep_interval = sweep_interval
+        self.claim_timeout = claim_timeout
+        self._queues: List[asyncio.Queue[int]] = [asyncio.Queue(max(max_queued // workers, 1)) for _ in range(workers)]
+        self._queued: Set[int] = set()
+        self._next_slot = 0.0
+        # User ID -> when (on the monotonic clock) their route can be used again.
+        self._routes: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task[None]] = []
+
+    @classmethod
+    def from_env(cls, bot: BotChallenge) -> Notifier:
+        return cls(
+            bot,
+            workers=max(getenv_int('DM_WORKERS', 2), 1),
+            rate=max(getenv_int('DM_RATE', 5), 1),
+            route_interval=getenv_int('DM_ROUTE_INTERVAL_MS', 1000) / 1000,
+            max_queued=getenv_int('DM_QUEUE_SIZE', 1000),
+            max_attempts=getenv_int('DM_MAX_ATTEMPTS', 5),
+        )
+
+    async def notify(
+        self, user_id: int, content: str, *, key: Optional[str] = None, connection: Optional[asqlite.Connection] = None
+    ) -> None:
+        """|coro|
+
+        Queues a DM to a user.
+
+        Parameter
+        ---------
+        user_id: int
+            Who to send it to.
+        content: str
+            The message.
+        key: Optional[str]
+            If set, this replaces the user's undelivered notification with the same key.
+        connection: Optional[asqlite.Connection]
+            A connection in a transaction to add the notification in. It won't be sent before
+            that transaction is committed, call :meth:`wake` after committing to send it right away.
+        """
+        now = int(time.time())
+        query = (
+            'INSERT INTO notification_outbox (user_id, content, coalesce_key, next_attempt_at, created_at)'
+            ' VALUES (:user_id, :content, :key, :next_attempt_at, :created_at)'
+            '\nON CONFLICT (user_id, coalesce_key) WHERE coalesce_key IS NOT NULL'
+            ' DO UPDATE SET content = excluded.content, attempts = 0, next_attempt_at = excluded.next_attempt_at'
+            ' RETURNING notification_id'
+        )
+        params = {'user_id': user_id, 'content': content, 'key': key, 'next_attempt_at': now, 'created_at': now}
+        if connection is not None:
+            await connection.fetchone(query, params)
+            return
+        # It's queued right away, so it's claimed right away.
+        params['next_attempt_at'] = now + self.claim_timeout
+        async with self.bot.pool.acquire() as conn:
+            row = await conn.fetchone(query, params)
+        self._enqueue(row['notification_id'], user_id)
+
+    def wake(self) -> None:
+        """Makes the sweeper look for notifications to send right away."""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._sweep_forever()))
+        self._tasks.extend(asyncio.create_task(self._work(queue)) for queue in self._queues)
+
+    def close(self) -> None:
+        # Anything that wasn't sent yet is still in the outbox.
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    @property
+    def queued(self) -> int:
+        return len(self._queued)
+
+    def _enqueue(self, notification_id: int, user_id: int) -> bool:
+        if notification_id in self._queued:
+            return True
+        try:
+            self._queues[user_id % len(self._queues)].put_nowait(notification_id)
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(notification_id)
+        return True
+
+    async def sweep(self) -> int:
+        """|coro|
+
+        Claims and queues the notifications in the outbox that are due. Returns how many were queued.
+        """
+        room = sum(queue.maxsize - queue.qsize() for queue in self._queues)
+        if room <= 0:
+            return 0
+        now = int(time.time())
+        async with self.bot.pool.acquire() as conn:
+            rows = await conn.fetchall(
+                'UPDATE notification_outbox SET next_attempt_at = :claimed_until WHERE notification_id IN ('
+                'SELECT notification_id FROM notification_outbox WHERE next_attempt_at <= :now'
+                ' ORDER BY next_attempt_at LIMIT :limit'
+                ') RETURNING notification_id, user_id',
+                {'claimed_until': now + self.claim_timeout, 'now': now, 'limit': room},
+            )
+        return sum(self._enqueue(row['notification_id'], row['user_id']) for row in rows)
+
+    async def _sweep_forever(self) -> None:
+        await self.bot.wait_until_ready()
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.sweep()
+            except Exception:
+                log.exception('Could not read the notification outbox')
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.sweep_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _throttle(self) -> None:
+        # Every send takes the next free slot, 1/rate seconds after the previous one.
+        now = time.monotonic()
+        self._next_slot = max(self._next_slot, now) + 1 / self.rate
+        delay = self._next_slot - 1 / self.rate - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _route_wait(self, user_id: int) -> float:
+        return self._routes.get(user_id, 0.0) - time.monotonic()
+
+    def _block_route(self, user_id: int, seconds: float) -> None:
+        now = time.monotonic()
+        if len(self._routes) >= MAX_ROUTES and user_id not in self._routes:
+            self._routes = {route: ready_at for route, ready_at in self._routes.items() if ready_at > now}
+        self._routes[user_id] = max(self._routes.get(user_id, 0.0), now + seconds)
+
+    async def _work(self, queue: asyncio.Queue[int]) -> None:
+        await self.bot.wait_until_ready()
+        while True:
+            notification_id = await queue.get()
+            try:
+                await self._deliver(notification_id)
+            except Exception:
+                log.exception('Could not handle notification %s', notification_id)
+            finally:
+                self._queued.discard(notification_id)
+
+    async def _deliver(self, notification_id: int) -> None:
+        async with self.bot.pool.acquire() as conn:
+            notification = await conn.fetchone(
+                'SELECT * FROM notification_outbox WHERE notification_id = ?', (notification_id,)
+            )
+        if notification is None:
+            return
+
+        user_id = notification['user_id']
+        wait = self._route_wait(user_id)
+        if wait > MAX_ROUTE_WAIT:
+            await self._defer(notification, wait)
+            return
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self._throttle()
+        self._block_route(user_id, self.route_interval)
+        try:
+            user = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+            await user.send(notification['content'])
+        except (discord.Forbidden, discord.NotFound) as e:
+            # DMs closed, or the user is gone. Trying again won't help.
+            log.debug('Dropping notification for %s: %s', user_id, e)
+        except discord.RateLimited as e:
+            # discord.py gave up waiting on the rate limit itself.
+            self._block_route(user_id, e.retry_after)
+            await self._defer(notification, e.retry_after)
+            return
+        except discord.HTTPException as e:
+            if e.status == 429:
+                retry_after = float(e.response.headers.get('Retry-After', self.route_interval))
+                self._block_route(user_id, retry_after)
+                await self._defer(notification, retry_after)
+            else:
+                await self._retry_later(notification, e)
+            return
+        await self._remove(notification)
+
+    async def _remove(self, notification: sqlite3.Row) -> None:
+        async with self.bot.pool.acquire() as conn:
+            # If it was replaced while we were sending it, the new content still has to go out.
+            await conn.execute(
+                'DELETE FROM notification_outbox WHERE notification_id = ? AND content = ?',
+                (notification['notification_id'], notification['content']),
+            )
+
+    async def _defer(self, notification: sqlite3.Row, delay: float) -> None:
+        # Rate limited, that's not the notification's fault, so it doesn't count as an attempt.
+        async with self.bot.pool.acquire() as conn:
+            await conn.execute(
+                'UPDATE notification_outbox SET next_attempt_at = ? WHERE notification_id = ?',
+                (int(time.time() + delay) + 1, notification['notification_id']),
+            )
+
+    async def _retry_later(self, notification: sqlite3.Row, error: discord.HTTPException) -> None:
+        attempts = notification['attempts'] + 1
+        if attempts >= self.max_attempts:
+            log.warning('Giving up on a notification for %s after %s attempts: %s', notification['user_id'], attempts, error)
+            await self._remove(notification)
+            return
+        # 30s, 1m, 2m, 4m... with some jitter so failed notifications don't all come back at once.
+        delay = min(30 * 2 ** (attempts - 1), 60 * 60) * random.uniform(0.8, 1.2)
+        async with self.bot.pool.acquire() as conn:
+            await conn.execute(
+                'UPDATE notification_outbox SET attempts = ?, next_attempt_at = ? WHERE notification_id = ?',
+                (attempts, int(time.time() + delay), notification['notification_id']),
+            )
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import asqlite
+from discord.ext import commands
+
+if TYPE_CHECKING:
+    from .base_cog import Wallet
+    from .ledger import Ledger
+
+
+async def bump_wallet_version(conn: asqlite.Connection) -> None:
+    """|coro|
+
+    Marks the wallets and inventories as changed, so a snapshot taken before won't be used.
+    Every transaction that writes to them calls this once, before it commits.
+    """
+    await conn.execute('UPDATE wallet_version SET version = version + 1')
+
+
+def _positive(amount: int) -> int:
+    if amount <= 0:
+        raise commands.BadArgument('The amount has to be at least 1.')
+    return amount
+
+
+class EconomyTransaction:
+    """Balance and inventory changes that are written to the database together.
+
+    Changes are only collected until :meth:`commit`, which acquires one connection and
+    applies all of them inside a single ``BEGIN IMMEDIATE`` transaction. Either all of
+    them happen or none do, so a purchase can't take the money and then fail to hand
+    over the item.
+
+    The database is what decides whether there's enough money or items: every decrease
+    is a conditional ``UPDATE`` that only matches if the result won't go below zero.
+    SQLite only lets one write transaction run at a time, so concurrent transactions on
+    the same wallet can't both spend the same money. The cached wallets are only updated
+    once the transaction is committed, by the same amounts that were written.
+
+    In write-behind mode the database balance can lag behind the cached one, so balances
+    are checked against (and reserved in) the cached wallet instead, and given back if
+    the transaction fails. Inventories are never journaled, those are always checked by
+    the database.
+
+    Parameters
+    ----------
+    pool: asqlite.Pool
+        The pool to get a connection from.
+    ledger: Optional[Ledger]
+        Where to record the balance changes, in the same transaction.
+    reason: str
+        What the balance changes are recorded as.
+    """
+
+    def __init__(self, pool: asqlite.Pool, *, ledger: Optional[Ledger] = None, reason: str = 'other') -> None:
+        self.pool = pool
+        self.ledger = ledger
+        self.reason = reason
+        self._wallets: Dict[int, Wallet] = {}
+        self._balances: Dict[int, int] = {}  # user_id: change in balance
+        self._items: Dict[Tuple[int, int], int] = {}  # (user_id, item_id): change in amount
+
+    def withdraw(self, wallet: Wallet, amount: int) -> EconomyTransaction:
+        """Takes money from a wallet."""
+        return self._change_balance(wallet, -_positive(amount))
+
+    def deposit(self, wallet: Wallet, amount: int) -> EconomyTransaction:
+        """Gives money to a wallet."""
+        return self._change_balance(wallet, _positive(amount))
+
+    def give_item(self, wallet: Wallet, item_id: int, amount: int) -> EconomyTransaction:
+        """Adds items to a wallet's inventory."""
+        return self._change_items(wallet, item_id, _positive(amount))
+
+    def take_item(self, wallet: Wallet, item_id: int, amount: int) -> EconomyTransaction:
+        """Removes items from a wallet's inventory."""
+        return self._change_items(wallet, item_id, -_positive(amount))
+
+    def transfer(self, sender: Wallet, receiver: Wallet, amount: int) -> EconomyTransaction:
+        """Moves money from one wallet to another."""
+        return self.withdraw(sender, amount).deposit(receiver, amount)
+
+    def _change_balance(self, wallet: Wallet, delta: int) -> EconomyTransaction:
+        if delta < -wallet.balance:
+            # Not authoritative, but it saves a round trip in the common case.
+            raise commands.BadArgument(f'You do not have enough money. You have {wallet.balance}')
+        self._wallets[wallet.user_id] = wallet
+        self._balances[wallet.user_id] = self._balances.get(wallet.user_id, 0) + delta
+        return self
+
+    def _change_items(self, wallet: Wallet, item_id: int, delta: int) -> EconomyTransaction:
+        key = (wallet.user_id, item_id)
+        if delta < -wallet.inventory[item_id]:
+            raise commands.BadArgument('You do not have that many of that item.')
+        self._wallets[wallet.user_id] = wallet
+        self._items[key] = self._items.get(key, 0) + delta
+        return self
+
+    async def commit(self, *, extra: Optional[Callable[[asqlite.Connection], Awaitable[Any]]] = None) -> None:
+        """|coro|
+
+        Writes all the changes in one transaction, then updates the cached wallets.
+
+        Parameter
+        ---------
+        extra: Optional[Callable[[asqlite.Connection], Awaitable[Any]]]
+            Other writes that belong in the same transaction, called with its connection
+            before the changes are written. If it raises, nothing is changed.
+
+        Raises
+        ------
+        commands.BadArgument
+            A wallet doesn't have enough money or items. Nothing was changed.
+        """
+        reserved = self._reserve()
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                try:
+                    if extra is not None:
+                        await extra(conn)
+                    await self._write(conn, reserved)
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                await conn.commit()
+        except BaseException:
+            for wallet, delta in reserved:
+                wallet._set_balance(wallet.balance - delta)
+            raise
+
+        for user_id, delta in self._balances.items():
+            wallet = self._wallets[user_id]
+            if wallet._journal is None:
+                # Apply the change rather than the balance the database returned, so the
+                # result is the same whatever order concurrent transactions finish in.
+                wallet._set_balance(wallet.balance + delta)
+        for (user_id, item_id), delta in self._items.items():
+            self._wallets[user_id].inventory[item_id] += delta
+            self._wallets[user_id]._inventory_changed()
+        for wallet in self._wallets.values():
+            wallet._publish()
+
+    def _reserve(self) -> List[Tuple[Wallet, int]]:
+        # Write-behind wallets are the source of truth, so their balance is checked
+        # and changed right away. There's no await in here, so nothing can get between
+        # the check and the change.
+        reserved: List[Tuple[Wallet, int]] = []
+        for user_id, delta in self._balances.items():
+            wallet = self._wallets[user_id]
+            if wallet._journal is not None and wallet.balance + delta < 0:
+                for other, other_delta in reserved:
+                    other._set_balance(other.balance - other_delta)
+                raise commands.BadArgument(f'You do not have enough money. You have {wallet.balance}')
+            if wallet._journal is not None:
+                wallet._set_balance(wallet.balance + delta)
+                reserved.append((wallet, delta))
+        return reserved
+
+    async def _write(self, conn: asqlite.Connection, reserved: List[Tuple[Wallet, int]]) -> None:
+        journaled = {wallet.user_id for wallet, _ in reserved}
+        for user_id, delta in self._balances.items():
+            if user_id in journaled:
+                await conn.execute('UPDATE wallets SET balance = balance + ? WHERE user_id = ?', (delta, user_id))
+                continue
+            row = await conn.fetchone(
+                'UPDATE wallets SET balance = balance + :delta WHERE user_id = :user_id AND balance + :delta >= 0'
+                ' RETURNING balance',
+                {'delta': delta, 'user_id': user_id},
+            )
+            if row is None:
+                raise commands.BadArgument('You do not have enough money.' if delta < 0 else 'Wallet not found.')
+
+        for (user_id, item_id), delta in self._items.items():
+            if delta >= 0:
+                await conn.execute(
+                    'INSERT INTO inventory (user_id, item_id, amount) VALUES (:user_id, :item_id, :amount)'
+                    '\nON CONFLICT DO UPDATE SET amount = amount + :amount',
+                    {'user_id': user_id, 'item_id': item_id, 'amount': delta},
+                )
+                continue
+            row = await conn.fetchone(
+                'UPDATE inventory SET amount = amount + :delta'
+                ' WHERE user_id = :user_id AND item_id = :item_id AND amount + :delta >= 0 RETURNING amount',
+                {'delta': delta, 'user_id': user_id, 'item_id': item_id},
+            )
+            if row is None:
+                raise commands.BadArgument('You do not have that many of that item.')
+
+        if self._balances or self._items:
+            await bump_wallet_version(conn)
+        if self.ledger is not None:
+            await self.ledger.write(conn, self._balances.items(), self.reason)
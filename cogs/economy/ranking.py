@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import random
+from array import array
+from logging import getLogger
+from typing import Awaitable, Dict, List, Optional, Set, Tuple
+
+import asqlite
+from sortedcontainers import SortedList
+
+from .leaderboard import LeaderboardEntry
+
+log = getLogger('BotChallenge.ranking')
+
+
+class BalanceRanking:
+    """Every wallet's balance, kept in order in memory.
+
+    Balances are stored as ``(-balance, user_id)`` keys in a :class:`SortedList`, which
+    is the same order as the leaderboard, so ranks, top-k and percentiles are all
+    O(log n) lookups that don't touch the database. :class:`Wallet` keeps it up to date
+    every time a balance changes.
+
+    It's rebuilt from the wallets table on cog load, until that's done :attr:`ready` is
+    False and the leaderboard is read from the database instead.
+    """
+
+    def __init__(self) -> None:
+        self._keys: SortedList = SortedList()
+        self._balances: Dict[int, int] = {}
+        # Users that changed while we were loading, their rows from the database are out of date.
+        self._changed: Optional[Set[int]] = None
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._balances
+
+    def update(self, user_id: int, balance: int) -> None:
+        """Sets a user's balance, adding them if they're not ranked yet."""
+        old = self._balances.get(user_id)
+        if old == balance:
+            return
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        self._keys.add((-balance, user_id))
+        self._balances[user_id] = balance
+        if self._changed is not None:
+            self._changed.add(user_id)
+
+    def remove(self, user_id: int) -> None:
+        """Removes a user from the ranking, if they're in it."""
+        old = self._balances.pop(user_id, None)
+        if old is not None:
+            self._keys.remove((-old, user_id))
+        if self._changed is not None:
+            self._changed.add(user_id)
+
+    async def load(self, pool: asqlite.Pool) -> None:
+        """|coro|
+
+        Rebuilds the ranking from the wallets table.
+        """
+
+        async def fetch() -> Dict[int, int]:
+            async with pool.acquire() as conn:
+                rows = await conn.fetchall('SELECT user_id, balance FROM wallets')
+            return {row[0]: row[1] for row in rows}
+
+        await self.rebuild(fetch())
+
+    async def rebuild(self, balances: Awaitable[Optional[Dict[int, int]]]) -> bool:
+        """|coro|
+
+        Rebuilds the ranking from the balances ``balances`` gives, keeping the changes made
+        while waiting for it. If it gives None, nothing changes and this returns False.
+        """
+        self._changed = set()
+        try:
+            fetched = await balances
+            changed = self._changed
+        finally:
+            self._changed = None
+        if fetched is None:
+            return False
+        for user_id in changed:
+            if user_id in self._balances:
+                fetched[user_id] = self._balances[user_id]
+            else:
+                # They quit in the meantime.
+                fetched.pop(user_id, None)
+        self._balances = fetched
+        self._keys = SortedList((-balance, user_id) for user_id, balance in fetched.items())
+        self.ready = True
+        log.info('Ranked %s wallets', len(self))
+        return True
+
+    def export(self) -> Tuple[array, array]:
+        """The user IDs and balances of everyone, in leaderboard order."""
+        return array('q', (user_id for _, user_id in self._keys)), array('q', (-balance for balance, _ in self._keys))
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Gets the 1-based leaderboard position of a user."""
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return self._keys.bisect_left((-balance, user_id)) + 1
+
+    def percentile(self, user_id: int) -> Optional[float]:
+        """Gets the share of ranked users that have less money than this user, from 0 to 100."""
+        rank = self.rank(user_id)
+        if rank is None:
+            return None
+        return 100 * (len(self) - rank) / len(self)
+
+    def sample(self, above: int, rng: Optional[random.Random] = None) -> Optional[int]:
+        """Picks a random user with more than ``above`` money, every one of them equally likely.
+
+        They're the start of the ranking, so this is one bisect and one index, both O(log n).
+        """
+        # (-above,) sorts before every (-above, user_id), so this counts the balances over ``above``.
+        eligible = self._keys.bisect_left((-above,))
+        if not eligible:
+            return None
+        return self._keys[(rng or random).randrange(eligible)][1]
+
+    def top(self, k: int, *, start: int = 0) -> List[LeaderboardEntry]:
+        """Gets ``k`` entries of the leaderboard, starting at the 0-based position ``start``."""
+        keys = self._keys.islice(start, start + k)
+        return [LeaderboardEntry(start + i + 1, user_id, -balance) for i, (balance, user_id) in enumerate(keys)]
+
+    def page(self, after: Optional[LeaderboardEntry], size: int) -> List[LeaderboardEntry]:
+        """Gets the ``size`` entries right after the given one, like :meth:`Leaderboard.page`."""
+        start = 0 if after is None else self._keys.bisect_right(self._key(after))
+        return self.top(size, start=start)
+
+    def entry(self, user_id: int) -> Optional[LeaderboardEntry]:
+        rank = self.rank(user_id)
+        if rank is None:
+            return None
+        return LeaderboardEntry(rank, user_id, self._balances[user_id])
+
+    @staticmethod
+    def _key(entry: LeaderboardEntry) -> Tuple[int, int]:
+        return -entry.balance, entry.user_id
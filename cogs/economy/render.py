@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, List, Mapping, Optional, Sequence, Tuple
+
+import discord
+from discord.ext import commands
+
+if TYPE_CHECKING:
+    from .base_cog import Item, Wallet
+
+# What an embed description can hold, minus the code block around the table.
+PAGE_LIMIT = 4096 - len('```py\n\n```')
+
+
+def grid_table(rows: Sequence[Sequence[Any]], headers: Sequence[str]) -> List[str]:
+    """Formats rows like ``tabulate``'s ``grid`` format, a lot faster.
+
+    Numbers are aligned right, everything else left. Returns the lines of the table,
+    so it can be split into pages between rows.
+    """
+    cells = [[str(value) for value in row] for row in rows]
+    numeric = [bool(rows) and all(isinstance(row[i], int) for row in rows) for i in range(len(headers))]
+    # Like tabulate, headers get at least two spaces of padding.
+    widths = [max([len(header) + 2, *(len(row[i]) for row in cells)]) for i, header in enumerate(headers)]
+
+    def line(values: Sequence[str]) -> str:
+        padded = (
+            value.rjust(width) if right else value.ljust(width) for value, width, right in zip(values, widths, numeric)
+        )
+        return '| ' + ' | '.join(padded) + ' |'
+
+    border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+    lines = [border, line(headers), border.replace('-', '=')]
+    for row in cells:
+        lines.append(line(row))
+        lines.append(border)
+    return lines
+
+
+def paginate(lines: List[str], *, header: int = 3, limit: int = PAGE_LIMIT) -> List[str]:
+    """Splits a :func:`grid_table` into pages that fit in an embed, repeating its header on every page.
+
+    Pages are only split after a row's bottom border, so rows never get cut in half.
+    """
+    head, body = lines[:header], lines[header:]
+    head_size = sum(len(line) + 1 for line in head)
+    pages: List[str] = []
+    page: List[str] = []
+    size = head_size
+    # Every row is the row itself and the border below it.
+    for i in range(0, len(body), 2):
+        row = body[i : i + 2]
+        row_size = sum(len(line) + 1 for line in row)
+        if page and size + row_size > limit:
+            pages.append('\n'.join(head + page))
+            page, size = [], head_size
+        page.extend(row)
+        size += row_size
+    pages.append('\n'.join(head + page))
+    return pages
+
+
+class TableView(discord.ui.View):
+    """Pages through pre-rendered tables with previous/next buttons."""
+
+    message: discord.Message  # set when view sent.
+
+    def __init__(self, ctx: commands.Context, pages: List[str], *, title: str, footer: str) -> None:
+        super().__init__(timeout=120.0)
+        self.ctx = ctx
+        self.pages = pages
+        self.title = title
+        self.footer = footer
+        self.index = 0
+
+    def build_embed(self) -> discord.Embed:
+        self.previous_page.disabled = self.index == 0
+        self.next_page.disabled = self.index == len(self.pages) - 1
+        embed = discord.Embed(
+            title=self.title, color=discord.Color.blurple(), description=f'```py\n{self.pages[self.index]}\n```'
+        )
+        footer = self.footer if len(self.pages) == 1 else f'{self.footer} | Page {self.index + 1}/{len(self.pages)}'
+        embed.set_footer(text=footer)
+        return embed
+
+    async def send(self) -> None:
+        """|coro|
+
+        Sends the first page, with the buttons only if there's more than one.
+        """
+        embed = self.build_embed()
+        if len(self.pages) == 1:
+            self.stop()
+            await self.ctx.send(embed=embed)
+            return
+        self.message = await self.ctx.send(embed=embed, view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user == self.ctx.author:
+            return True
+        await interaction.response.send_message('This is not yours.', ephemeral=True)
+        return False
+
+    async def on_timeout(self) -> None:
+        await self.message.edit(view=None)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.blurple)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        self.index -= 1
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.blurple)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        self.index += 1
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+
+
+class RenderCache:
+    """The store and inventory tables, rendered once and reused until what they show changes.
+
+    The store is rendered again when the catalog is reloaded. Inventories are kept per user
+    for the version of their inventory (see ``Wallet.inventory_version``) and the catalog
+    they were rendered with, for at most ``max_inventories`` users, least recently used first out.
+    """
+
+    def __init__(self, *, max_inventories: int = 1000) -> None:
+        self.max_inventories = max_inventories
+        self._store: Optional[Tuple[Mapping[int, Item], List[str]]] = None
+        # user_id: (inventory version, catalog, pages)
+        self._inventories: OrderedDict[int, Tuple[int, Mapping[int, Item], List[str]]] = OrderedDict()
+
+    def store(self, items: Mapping[int, Item]) -> List[str]:
+        if self._store is not None and self._store[0] is items:
+            return self._store[1]
+        ordered = sorted(items.values(), key=lambda item: item.price, reverse=True)
+        rows = [(item.name, item.price) for item in ordered]
+        pages = paginate(grid_table(rows, ('Item Name', 'Price')))
+        self._store = (items, pages)
+        return pages
+
+    def inventory(self, wallet: Wallet, items: Mapping[int, Item]) -> List[str]:
+        cached = self._inventories.get(wallet.user_id)
+        if cached is not None and cached[0] == wallet.inventory_version and cached[1] is items:
+            self._inventories.move_to_end(wallet.user_id)
+            return cached[2]
+
+        owned = sorted(
+            ((items[item_id].name, amount) for item_id, amount in wallet.inventory.items() if amount and item_id in items),
+            key=lambda row: row[0],
+        )
+        pages = paginate(grid_table(owned, ('Item Name', 'Amount'))) if owned else []
+        self._inventories[wallet.user_id] = (wallet.inventory_version, items, pages)
+        self._inventories.move_to_end(wallet.user_id)
+        while len(self._inventories) > self.max_inventories:
+            self._inventories.popitem(last=False)
+        return pages
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from logging import getLogger
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+from main import getenv_int
+
+if TYPE_CHECKING:
+    from main import BotChallenge
+
+log = getLogger('BotChallenge.resolver')
+
+
+UNKNOWN_USER = 'Unknown user'
+
+
+class UserResolver:
+    """Turns user IDs into names for things like the leaderboard, without blocking on the API.
+
+    Names are looked up in this order:
+
+    - the bot's user cache
+    - names fetched earlier, kept in memory and in the ``user_names`` table for ``ttl`` seconds
+    - ``fetch_user``, with at most ``concurrency`` requests running at once
+
+    Concurrent lookups for the same user share a single request. If the API doesn't
+    answer within the ``timeout`` passed to :meth:`resolve_many`, a placeholder is used
+    instead, and the request carries on in the background so the name is there next time.
+    Expired names are still used while they're being refreshed.
+    """
+
+    def __init__(
+        self, bot: BotChallenge, *, ttl: int = 24 * 60 * 60, concurrency: int = 4, max_cached: int = 10_000
+    ) -> None:
+        self.bot = bot
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # user_id: (name, fetched_at)
+        self._names: Dict[int, Tuple[Optional[str], int]] = {}
+        self._inflight: Dict[int, asyncio.Task[Optional[str]]] = {}
+
+    @classmethod
+    def from_env(cls, bot: BotChallenge) -> UserResolver:
+        return cls(
+            bot,
+            ttl=getenv_int('USER_NAME_TTL', 24 * 60 * 60),
+            concurrency=getenv_int('USER_FETCH_CONCURRENCY', 4),
+        )
+
+    async def resolve_many(self, user_ids: Iterable[int], *, timeout: float = 1.5) -> Dict[int, str]:
+        """|coro|
+
+        Gets the names of a few users, like the ones on a leaderboard page.
+
+        Parameter
+        ---------
+        user_ids: Iterable[int]
+            The IDs of the users.
+        timeout: float
+            How long to wait for the API before giving up and using a placeholder.
+        """
+        names: Dict[int, str] = {}
+        missing: List[int] = []
+        for user_id in user_ids:
+            user = self.bot.get_user(user_id)
+            if user is not None:
+                names[user_id] = str(user)
+            else:
+                missing.append(user_id)
+        if not missing:
+            return names
+
+        await self._load_stored([user_id for user_id in missing if user_id not in self._names])
+
+        now = int(time.time())
+        tasks: Dict[int, asyncio.Task[Optional[str]]] = {}
+        for user_id in missing:
+            stored = self._names.get(user_id)
+            if stored is not None:
+                name, fetched_at = stored
+                names[user_id] = name or UNKNOWN_USER
+                if now - fetched_at > self.ttl:
+                    self._fetch(user_id)  # refresh in the background, the old name will do for now
+            else:
+                tasks[user_id] = self._fetch(user_id)
+
+        if tasks:
+            done, _ = await asyncio.wait(tasks.values(), timeout=timeout)
+            for user_id, task in tasks.items():
+                name = task.result() if task in done and not task.cancelled() and task.exception() is None else None
+                names[user_id] = name or UNKNOWN_USER
+        return names
+
+    async def _load_stored(self, user_ids: List[int]) -> None:
+        if not user_ids:
+            return
+        placeholders = ', '.join('?' * len(user_ids))
+        async with self.bot.pool.acquire() as conn:
+            rows = await conn.fetchall(
+                f'SELECT user_id, name, fetched_at FROM user_names WHERE user_id IN ({placeholders})', tuple(user_ids)
+            )
+        for row in rows:
+            self._remember(row['user_id'], row['name'], row['fetched_at'])
+
+    def _remember(self, user_id: int, name: Optional[str], fetched_at: int) -> None:
+        self._names.pop(user_id, None)
+        self._names[user_id] = (name, fetched_at)
+        if len(self._names) > self.max_cached:
+            # Oldest first, the database still has it if it's needed again.
+            del self._names[next(iter(self._names))]
+
+    def _fetch(self, user_id: int) -> asyncio.Task[Optional[str]]:
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_store(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return task
+
+    async def _fetch_and_store(self, user_id: int) -> Optional[str]:
+        async with self._semaphore:
+            try:
+                name: Optional[str] = str(await self.bot.fetch_user(user_id))
+            except discord.NotFound:
+                name = None
+            except discord.HTTPException as e:
+                # Don't remember anything, we'll just try again next time.
+                log.debug('Could not fetch user %s: %s', user_id, e)
+                return None
+
+        fetched_at = int(time.time())
+        self._remember(user_id, name, fetched_at)
+        async with self.bot.pool.acquire() as conn:
+            await conn.execute(
+                'INSERT INTO user_names (user_id, name, fetched_at) VALUES (?, ?, ?)'
+                '\nON CONFLICT DO UPDATE SET name = excluded.name, fetched_at = excluded.fetched_at',
+                (user_id, name, fetched_at),
+            )
+        return name
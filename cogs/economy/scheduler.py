@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from logging import getLogger
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+log = getLogger('BotChallenge.scheduler')
+
+K = TypeVar('K', bound=Hashable)
+
+
+class RetryLater(Exception):
+    """Raised by a scheduler's callback to only have ``keys`` tried again, not everything it was given."""
+
+    def __init__(self, keys: Iterable[Hashable]) -> None:
+        self.keys = list(keys)
+        super().__init__(f'Failed to handle {self.keys}')
+
+
+class DeadlineScheduler(Generic[K]):
+    """Runs a callback for keys once their deadline passes, without polling.
+
+    Deadlines are kept in a min-heap, and the scheduler sleeps until the earliest
+    one. Everything that's due at that point is handed to ``callback`` as a single
+    batch. Scheduling something earlier than what the scheduler is sleeping towards
+    wakes it up.
+
+    Deadlines are unix timestamps, so they can come straight from the database.
+    Nothing is persisted here, whoever owns the scheduler has to schedule the
+    pending keys again after a restart.
+
+    Parameters
+    ----------
+    callback: Callable[[List[K]], Awaitable[None]]
+        Called with the keys that are due. Errors are logged, and the keys are scheduled
+        again ``retry_delay`` seconds later, all of them unless the callback raised
+        :exc:`RetryLater` with the ones that failed. So it has to be fine with being
+        called again for keys it already handled.
+    name: str
+        Used in logs.
+    retry_delay: float
+        How many seconds to wait before retrying keys that failed.
+    """
+
+    def __init__(self, callback: Callable[[List[K]], Awaitable[None]], *, name: str, retry_delay: float = 60.0) -> None:
+        self.callback = callback
+        self.name = name
+        self.retry_delay = retry_delay
+        self._heap: List[Tuple[float, int, K]] = []
+        self._deadlines: Dict[K, float] = {}
+        self._counter = itertools.count()  # tie breaker, keys don't need to be comparable
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._deadlines
+
+    @property
+    def next_deadline(self) -> Optional[float]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def schedule(self, key: K, when: float) -> None:
+        """Schedules a key, or moves it if it was already scheduled."""
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), key))
+        # Let the scheduler work out if it needs to wake up any sooner.
+        self._wakeup.set()
+
+    def cancel(self, key: K) -> None:
+        """Unschedules a key. Its heap entry is skipped when it comes up."""
+        self._deadlines.pop(key, None)
+
+    def wake(self) -> None:
+        """Makes the scheduler check for due keys right away."""
+        self._wakeup.set()
+
+    def start(self, *, before: Optional[Callable[[], Awaitable[object]]] = None) -> None:
+        """Starts the scheduler, optionally waiting on ``before`` first (e.g. ``bot.wait_until_ready``)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(before))
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _retry(self, keys: List[K]) -> None:
+        when = time.time() + self.retry_delay
+        log.warning('Scheduler %r retrying %s in %ss', self.name, keys, self.retry_delay)
+        for key in keys:
+            # Unless it was scheduled again in the meantime.
+            if key not in self._deadlines:
+                self.schedule(key, when)
+
+    def _drop_stale(self) -> None:
+        # Entries for keys that were cancelled or rescheduled since they were pushed.
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now: float) -> List[K]:
+        due: List[K] = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+            self._drop_stale()
+        return due
+
+    async def _run(self, before: Optional[Callable[[], Awaitable[object]]]) -> None:
+        if before is not None:
+            await before()
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self.callback(due)
+                except RetryLater as e:
+                    self._retry(e.keys)  # type: ignore
+                except Exception:
+                    log.exception('Scheduler %r failed to handle %s', self.name, due)
+                    self._retry(due)
+                continue
+
+            next_deadline = self.next_deadline
+            timeout = None if next_deadline is None else max(next_deadline - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,367 @@
+"""Snapshots of the economy's in-memory state, so a restart doesn't start cold.
+
+On shutdown the hot part of the wallet cache, the ranking, the item catalog and the
+buffered trivia questions are written to one binary file. On startup it's memory-mapped
+and read back in the background, instead of every command missing the cache at once
+and the ranking and catalog being rebuilt from full table scans.
+
+The file is a header followed by tagged sections::
+
+    header   magic, format version, schema version, wallet version, catalog version,
+             payload size, CRC-32 of the payload
+    section  4 byte tag, payload size, payload
+
+Numbers are ``array('q')`` dumps in the machine's byte order, strings are a length array
+followed by the UTF-8 bytes of all of them. Nothing in it is executable, unlike a pickle.
+
+A snapshot is only used if its checksum matches and it was taken at the same schema
+version. The wallets and the ranking are only used if the ``wallet_version`` row (bumped
+once by every transaction that writes to the wallets or inventory tables) hasn't changed
+since, the catalog only if ``catalog_version`` hasn't. Anything else editing those tables
+has to bump it as well, or delete the snapshot file. The trivia questions don't come from
+the database, so those are used either way. The file is deleted once it's read, a crash
+later on shouldn't serve the same questions again.
+"""
+
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import asqlite
+
+from main import BotChallenge, getenv_flag
+
+from .base_cog import BaseEconomyCog, Item, Wallet
+from .inventory import Inventory
+
+if TYPE_CHECKING:
+    from .trivia import TriviaProvider
+
+log = getLogger('BotChallenge.snapshot')
+
+MAGIC = b'ECONSNAP'
+FORMAT_VERSION = 1
+# magic, format version, schema version, wallet version, catalog version (-1 for none), payload size, crc32
+HEADER = struct.Struct('=8sHqqqQI')
+SECTION = struct.Struct('=4sQ')
+COUNT = struct.Struct('=Q')
+
+# (category, difficulty) and the questions buffered for it, as
+# (category, question, correct answer, difficulty, *incorrect answers).
+TriviaBuffer = Dict[Tuple[Optional[int], Optional[str]], List[Tuple[str, ...]]]
+
+
+@dataclass
+class EconomySnapshot:
+    schema_version: int
+    wallet_version: int
+    catalog_version: Optional[int]
+    # (user ID, balance, inventory), least recently used first.
+    wallets: List[Tuple[int, int, Inventory]] = field(default_factory=list)
+    # User IDs and balances, in leaderboard order. Empty if the ranking wasn't loaded.
+    ranking: Tuple[array, array] = field(default_factory=lambda: (array('q'), array('q')))
+    # (item ID, name, price)
+    items: List[Tuple[int, str, int]] = field(default_factory=list)
+    trivia: TriviaBuffer = field(default_factory=dict)
+
+    def encode(self) -> bytes:
+        sections = [
+            (b'WALT', self._encode_wallets()),
+            (b'RANK', _ints(self.ranking[0]) + _ints(self.ranking[1])),
+            (b'ITEM', self._encode_items()),
+            (b'TRIV', self._encode_trivia()),
+        ]
+        payload = b''.join(SECTION.pack(tag, len(data)) + data for tag, data in sections)
+        catalog_version = -1 if self.catalog_version is None else self.catalog_version
+        header = HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            self.schema_version,
+            self.wallet_version,
+            catalog_version,
+            len(payload),
+            zlib.crc32(payload),
+        )
+        return header + payload
+
+    @classmethod
+    def decode(cls, data: mmap.mmap) -> EconomySnapshot:
+        """Reads a snapshot back.
+
+        Raises
+        ------
+        ValueError
+            The data isn't a snapshot this version can read, or it's corrupted.
+        """
+        if len(data) < HEADER.size:
+            raise ValueError('too short for a snapshot')
+        magic, version, schema_version, wallet_version, catalog_version, size, crc = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'not a version {FORMAT_VERSION} snapshot')
+        if len(data) != HEADER.size + size:
+            raise ValueError('truncated')
+        with memoryview(data)[HEADER.size :] as payload:
+            if zlib.crc32(payload) != crc:
+                raise ValueError('checksum mismatch')
+        snapshot = cls(schema_version, wallet_version, None if catalog_version < 0 else catalog_version)
+        offset = HEADER.size
+        while offset < len(data):
+            tag, length = SECTION.unpack_from(data, offset)
+            offset += SECTION.size
+            reader = _Reader(data, offset)
+            if tag == b'WALT':
+                snapshot._decode_wallets(reader)
+            elif tag == b'RANK':
+                snapshot.ranking = (reader.ints(), reader.ints())
+            elif tag == b'ITEM':
+                snapshot._decode_items(reader)
+            elif tag == b'TRIV':
+                snapshot._decode_trivia(reader)
+            offset += length
+        return snapshot
+
+    def _encode_wallets(self) -> bytes:
+        counts = array('q', (len(inventory) for _, _, inventory in self.wallets))
+        item_ids, amounts = array('q'), array('q')
+        for _, _, inventory in self.wallets:
+            for item_id, amount in inventory.items():
+                item_ids.append(item_id)
+                amounts.append(amount)
+        return b''.join(
+            [
+                _ints(user_id for user_id, _, _ in self.wallets),
+                _ints(balance for _, balance, _ in self.wallets),
+                _ints(counts),
+                _ints(item_ids),
+                _ints(amounts),
+            ]
+        )
+
+    def _decode_wallets(self, reader: _Reader) -> None:
+        user_ids, balances, counts, item_ids, amounts = (reader.ints() for _ in range(5))
+        start = 0
+        for user_id, balance, count in zip(user_ids, balances, counts):
+            end = start + count
+            self.wallets.append((user_id, balance, Inventory(zip(item_ids[start:end], amounts[start:end]))))
+            start = end
+
+    def _encode_items(self) -> bytes:
+        return b''.join(
+            [
+                _ints(item_id for item_id, _, _ in self.items),
+                _ints(price for _, _, price in self.items),
+                _strings(name for _, name, _ in self.items),
+            ]
+        )
+
+    def _decode_items(self, reader: _Reader) -> None:
+        item_ids, prices, names = reader.ints(), reader.ints(), reader.strings()
+        self.items = list(zip(item_ids, names, prices))
+
+    def _encode_trivia(self) -> bytes:
+        keys = list(self.trivia)
+        questions = [question for key in keys for question in self.trivia[key]]
+        return b''.join(
+            [
+                # Categories are positive, -1 is any.
+                _ints(-1 if category is None else category for category, _ in keys),
+                _strings(difficulty or '' for _, difficulty in keys),
+                _ints(len(self.trivia[key]) for key in keys),
+                _ints(len(question) for question in questions),
+                _strings(text for question in questions for text in question),
+            ]
+        )
+
+    def _decode_trivia(self, reader: _Reader) -> None:
+        categories, difficulties, counts = reader.ints(), reader.strings(), reader.ints()
+        lengths, texts = reader.ints(), iter(reader.strings())
+        questions = iter(lengths)
+        for category, difficulty, count in zip(categories, difficulties, counts):
+            key = (None if category < 0 else category, difficulty or None)
+            self.trivia[key] = [tuple(next(texts) for _ in range(next(questions))) for _ in range(count)]
+
+
+def _ints(values: Iterable[int]) -> bytes:
+    packed = values if isinstance(values, array) else array('q', values)
+    return COUNT.pack(len(packed)) + packed.tobytes()
+
+
+def _strings(values: Iterable[str]) -> bytes:
+    encoded = [value.encode() for value in values]
+    return _ints(len(value) for value in encoded) + b''.join(encoded)
+
+
+class _Reader:
+    def __init__(self, data: mmap.mmap, offset: int) -> None:
+        self.data = data
+        self.offset = offset
+
+    def ints(self) -> array:
+        (count,) = COUNT.unpack_from(self.data, self.offset)
+        start = self.offset + COUNT.size
+        self.offset = start + count * 8
+        values = array('q')
+        values.frombytes(self.data[start : self.offset])
+        return values
+
+    def strings(self) -> List[str]:
+        lengths = self.ints()
+        values: List[str] = []
+        for length in lengths:
+            values.append(self.data[self.offset : self.offset + length].decode())
+            self.offset += length
+        return values
+
+
+class SnapshotFile:
+    """Where the snapshot is kept between a shutdown and the next startup."""
+
+    def __init__(self, path: str = 'economy.snapshot') -> None:
+        self.path = path
+
+    @classmethod
+    def from_env(cls) -> Optional[SnapshotFile]:
+        """Creates one from the .env settings, or returns None if snapshots are turned off."""
+        if not getenv_flag('STATE_SNAPSHOT', True):
+            return None
+        return cls(os.getenv('STATE_SNAPSHOT_PATH') or 'economy.snapshot')
+
+    def save(self, snapshot: EconomySnapshot) -> int:
+        """Writes a snapshot, replacing the old one in one go. Returns its size in bytes."""
+        data = snapshot.encode()
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.path)
+        return len(data)
+
+    def load(self) -> Optional[EconomySnapshot]:
+        """Reads the snapshot and deletes it, returns None if there isn't a usable one."""
+        try:
+            with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                snapshot = EconomySnapshot.decode(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error, UnicodeDecodeError) as e:
+            log.warning('Ignoring the state snapshot at %s: %s', self.path, e)
+            snapshot = None
+        os.remove(self.path)
+        return snapshot
+
+
+async def current_versions(conn: asqlite.Connection) -> Tuple[int, int, Optional[int]]:
+    """|coro|
+
+    The schema, wallet and catalog versions of the database, in the order a snapshot has them.
+    """
+    row = await conn.fetchone(
+        'SELECT (SELECT MAX(version) FROM schema_version) AS schema_version,'
+        ' (SELECT version FROM wallet_version) AS wallet_version,'
+        ' (SELECT version FROM catalog_version) AS catalog_version'
+    )
+    return row['schema_version'], row['wallet_version'], row['catalog_version']
+
+
+class Snapshots(BaseEconomyCog):
+    """Saves the in-memory state on unload, and warms the caches from it on load."""
+
+    if TYPE_CHECKING:
+        trivia_provider: TriviaProvider
+
+    def __init__(self, bot: BotChallenge) -> None:
+        super().__init__(bot)
+        self.snapshot_file: Optional[SnapshotFile] = SnapshotFile.from_env()
+        if self.snapshot_file and bot.cluster is not None:
+            # The other processes keep changing wallets while one restarts, and they'd share the file.
+            log.info('State snapshots are not used in cluster mode')
+            self.snapshot_file = None
+        # What restore_snapshot restored, the rest has to be loaded from the database.
+        self.restored: Set[str] = set()
+
+    async def restore_snapshot(self) -> None:
+        """|coro|
+
+        Restores whatever is still up to date from the snapshot, if there is one.
+        """
+        snapshot = self.snapshot_file.load() if self.snapshot_file else None
+        if snapshot is not None and snapshot.trivia:
+            self.trivia_provider.restore(snapshot.trivia)
+            self.restored.add('trivia')
+        # Only asks OpenTDB if the snapshot didn't have enough questions.
+        self.trivia_provider.start()
+        if snapshot is None:
+            return
+
+        versions: List[Optional[int]] = []
+
+        async def balances() -> Optional[Dict[int, int]]:
+            async with self.bot.pool.acquire() as conn:
+                versions.extend(await current_versions(conn))
+            if versions[:2] != [snapshot.schema_version, snapshot.wallet_version] or not snapshot.ranking[0]:
+                return None
+            return dict(zip(*snapshot.ranking))
+
+        # The ranking keeps track of the balances that change while the versions are
+        # checked, the rest is restored right after it without awaiting anything.
+        if await self.ranking.rebuild(balances()):
+            self.registered_users.replace(sorted(snapshot.ranking[0]))
+            self.registered_users.ready = True
+            for user_id, balance, inventory in snapshot.wallets:
+                # If they quit in the meantime, the ranking knows.
+                if user_id in self.ranking:
+                    wallet = Wallet(user_id, balance, inventory, self.bot, self.balance_journal, self.ranking, self.ledger)
+                    self._wallets.setdefault(user_id, wallet)
+            self.restored.update(('wallets', 'ranking', 'registered users'))
+        if versions[0] == snapshot.schema_version and versions[2] == snapshot.catalog_version and snapshot.items:
+            items = {item_id: Item(item_id, name, price) for item_id, name, price in snapshot.items}
+            self.catalog.restore(items, snapshot.catalog_version)
+            self.restored.add('catalog')
+        log.info('Restored %s from the state snapshot', ', '.join(sorted(self.restored)) or 'nothing')
+
+    async def save_snapshot(self) -> None:
+        """|coro|
+
+        Writes the in-memory state to the snapshot file. Has to run after the balance
+        journal and everything else that writes wallets has stopped.
+        """
+        if self.snapshot_file is None:
+            return
+        # Nothing is halfway through changing a wallet, so the database and the cache agree.
+        async with self.user_locks.hold_all():
+            async with self.bot.pool.acquire() as conn:
+                schema_version, wallet_version, _ = await current_versions(conn)
+            snapshot = EconomySnapshot(schema_version, wallet_version, self.catalog.version)
+            if self.ranking.ready:
+                snapshot.wallets = [(wallet.user_id, wallet.balance, wallet.inventory) for wallet in self._wallets.values()]
+                snapshot.ranking = self.ranking.export()
+        snapshot.items = [(item.item_id, item.name, item.price) for item in self.items.values()]
+        snapshot.trivia = self.trivia_provider.export()
+        started = time.perf_counter()
+        size = self.snapshot_file.save(snapshot)
+        log.info(
+            'Saved a state snapshot of %s wallets, %s ranked, %s items (%s KiB) in %.3fs',
+            len(snapshot.wallets),
+            len(snapshot.ranking[0]),
+            len(snapshot.items),
+            size // 1024,
+            time.perf_counter() - started,
+        )
+
+    async def load_unless_restored(self, name: str, load: Callable[[], Awaitable[Any]]) -> None:
+        """|coro|
+
+        Waits for the snapshot to be restored, then loads ``name`` from the database if it wasn't in there.
+        """
+        await self.warmed_up('snapshot')
+        if name not in self.restored:
+            await load()
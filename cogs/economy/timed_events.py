@@ -1,54 +1,197 @@
+from __future__ import annotations
+
 import random
+import time
+from dataclasses import dataclass
 from logging import getLogger
+from typing import Any, Dict, Optional
+
+import asqlite
+import discord
+from discord.ext import commands, tasks
 
-from discord.ext import tasks
+from components.cluster import LeaderLease
+from main import BotChallenge, getenv_int
 
 from .base_cog import BaseEconomyCog
 
 log = getLogger('BotChallenge.timed_events')
 
 
+@dataclass
+class Robbery:
+    """Every ``every`` minutes, there's a ``chance`` percent chance that a random player
+    with more than ``min_balance`` loses up to ``max_share`` percent of their money.
+    ``every`` 0 turns robberies off.
+    """
+
+    every: int = 25
+    chance: int = 15
+    min_balance: int = 25
+    max_share: int = 100
+
+    @classmethod
+    def from_env(cls) -> Robbery:
+        return cls(
+            every=getenv_int('ROBBERY_EVERY_MINUTES', cls.every),
+            chance=getenv_int('ROBBERY_CHANCE', cls.chance),
+            min_balance=getenv_int('ROBBERY_MIN_BALANCE', cls.min_balance),
+            max_share=getenv_int('ROBBERY_MAX_SHARE', cls.max_share),
+        )
+
+
+@dataclass
+class BonusHours:
+    """Every ``every`` minutes, there's a ``chance`` percent chance that work and daily
+    pay ``multiplier`` times as much for the next ``duration`` minutes.
+    ``every`` 0 turns bonus hours off.
+    """
+
+    every: int = 60
+    chance: int = 10
+    duration: int = 60
+    multiplier: int = 2
+
+    @classmethod
+    def from_env(cls) -> BonusHours:
+        return cls(
+            every=getenv_int('BONUS_HOURS_EVERY_MINUTES', cls.every),
+            chance=getenv_int('BONUS_HOURS_CHANCE', cls.chance),
+            duration=getenv_int('BONUS_HOURS_DURATION_MINUTES', cls.duration),
+            multiplier=getenv_int('BONUS_HOURS_MULTIPLIER', cls.multiplier),
+        )
+
+
+async def probe_wallet(conn: asqlite.Connection, above: int, rng: Optional[random.Random] = None) -> Optional[int]:
+    """|coro|
+
+    Picks a random wallet with more than ``above`` money straight from the database.
+
+    It jumps to a random rowid and takes the first eligible wallet from there, wrapping
+    around once. Unlike ``ORDER BY RANDOM()``, that's a seek instead of reading and sorting
+    the whole table, but a wallet right after a gap in the rowids (or after wallets that
+    aren't eligible) is more likely to be picked. :meth:`BalanceRanking.sample` is exact,
+    this is for while it's loading.
+    """
+    # Separate subqueries, SQLite only reads MIN or MAX off the end of the b-tree when it's alone.
+    bounds = await conn.fetchone('SELECT (SELECT MIN(rowid) FROM wallets) AS low, (SELECT MAX(rowid) FROM wallets) AS high')
+    if bounds['low'] is None:
+        return None
+    start = (rng or random).randint(bounds['low'], bounds['high'])
+    # The + keeps SQLite from using the balance index, this has to walk the rowids.
+    row = await conn.fetchone(
+        'SELECT user_id FROM wallets WHERE rowid >= ? AND +balance > ? ORDER BY rowid LIMIT 1', (start, above)
+    )
+    if row is None:
+        row = await conn.fetchone(
+            'SELECT user_id FROM wallets WHERE rowid < ? AND +balance > ? ORDER BY rowid LIMIT 1', (start, above)
+        )
+    return row and row['user_id']
+
+
 class TimedEvents(BaseEconomyCog):
-    """Cog for all the timed events in the bot"""
+    """Events that happen on their own every now and then, see :class:`Robbery` and :class:`BonusHours`"""
+
+    def __init__(self, bot: BotChallenge) -> None:
+        super().__init__(bot)
+        self.robbery_event = Robbery.from_env()
+        self.bonus_hours_event = BonusHours.from_env()
+        self.timed_events_lease: Optional[LeaderLease] = None
 
-    async def cog_load(self):
-        self.robbery.start()
+    async def start_timed_events(self) -> None:
+        """|coro|
+
+        Picks up bonus hours that are still on, and starts the events. In a cluster,
+        only the process holding the timed events lease runs them.
+        """
+        async with self.bot.pool.acquire() as conn:
+            bonus = await conn.fetchone("SELECT ends_at, multiplier FROM timed_events WHERE name = 'bonus_hours'")
+        if bonus:
+            self._bonus_hours = (bonus['ends_at'], bonus['multiplier'])
+        if self.bot.cluster is None:
+            await self.lead_timed_events()
+            return
+        self.timed_events_lease = self.bot.cluster.lease(self.bot.pool, 'timed_events')
+        self.timed_events_lease.start(on_elected=self.lead_timed_events, on_deposed=self.stop_timed_events)
+
+    async def lead_timed_events(self) -> None:
+        for loop, every in ((self.robbery, self.robbery_event.every), (self.bonus_hours, self.bonus_hours_event.every)):
+            if every > 0:
+                loop.change_interval(minutes=every)
+                loop.start()
+
+    async def stop_timed_events(self) -> None:
+        self.robbery.cancel()
+        self.bonus_hours.cancel()
+
+    def _on_bonus_hours(self, message: Dict[str, Any]) -> None:
+        # The process running the events started bonus hours.
+        self._bonus_hours = (message['ends_at'], message['multiplier'])
+
+    async def pick_wallet(self, above: int) -> Optional[int]:
+        """|coro|
+
+        Picks a random player with more than ``above`` money, from the ranking
+        once it's loaded, and from the database until then.
+        """
+        if self.ranking.ready:
+            return self.ranking.sample(above)
+        async with self.bot.pool.acquire() as conn:
+            return await probe_wallet(conn, above)
 
     @tasks.loop(minutes=25)
     async def robbery(self):
         """Robbery event"""
 
-        chance = random.randint(1, 100)
-        if chance < 85:
+        event = self.robbery_event
+        if random.randrange(100) >= event.chance:
             return
 
-        # Select random user from the database
-        async with self.bot.pool.acquire() as conn:
-            user = await conn.fetchone(
-                'SELECT * FROM users WHERE bal > :bal_limit ORDER BY RANDOM() LIMIT 1', {'bal_limit': 25}
-            )
-            await conn.commit()
-
-        if not user:
+        user_id = await self.pick_wallet(event.min_balance)
+        if user_id is None:
+            return
+        async with self.user_locks.hold(user_id):
+            try:
+                wallet = await self.get_wallet(discord.Object(user_id))
+            except commands.BadArgument:
+                # They quit in the meantime.
+                return
+            if wallet.balance <= event.min_balance:
+                return
+
+            # Pick the amount to steal
+            amount = random.randint(1, max(1, (wallet.balance - 1) * event.max_share // 100))
+            await wallet.withdraw(amount, reason='robbery')
+
+        # Send message, without waiting for it to be delivered
+        await self.notifier.notify(
+            wallet.user_id, f'You were robbed! You lost {self.currency_symbol}{amount}', key='robbery'
+        )
+
+        log.info(f"{wallet.user_id} has been robbed")
+
+    @tasks.loop(minutes=60)
+    async def bonus_hours(self):
+        """Bonus hours event"""
+
+        event = self.bonus_hours_event
+        if self.bonus_multiplier > 1 or random.randrange(100) >= event.chance:
             return
 
-        # Get the user's wallet
-        wallet = await self.get_wallet(user['user_id'])
-
-        # Pick the amount to steal
-        amount = random.randint(1, wallet.balance - 1)
-
-        # Steal
+        ends_at = int(time.time()) + event.duration * 60
         async with self.bot.pool.acquire() as conn:
-            await wallet.withdraw(amount, connection=conn)
+            await conn.execute(
+                'INSERT OR REPLACE INTO timed_events (name, ends_at, multiplier) VALUES (?, ?, ?)',
+                ('bonus_hours', ends_at, event.multiplier),
+            )
             await conn.commit()
+        self._bonus_hours = (ends_at, event.multiplier)
+        if self.bot.cluster is not None:
+            self.bot.cluster.publish('bonus_hours', ends_at=ends_at, multiplier=event.multiplier)
 
-        # Send message
-        channel = await self.bot.fetch_user(wallet.user_id)
-        await channel.send(f'You were robbed! You lost {self.currency_symbol}{amount}')
-
-        log.info(f"{channel} (ID: {channel.id}) has been robbed")
+        log.info(f"Bonus hours started, {event.multiplier}x pay for {event.duration} minutes")
 
     @robbery.before_loop
-    async def before_robbery(self):
+    @bonus_hours.before_loop
+    async def before_timed_events(self):
         await self.bot.wait_until_ready()
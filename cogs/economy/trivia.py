@@ -1,54 +1,75 @@
 from __future__ import annotations
 
+import asyncio
 import html
+import json
 import random
+import sqlite3
+import time
+from collections import deque
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Literal, Optional, Tuple
 
 import aiohttp
 import discord
 from discord.ext import commands
 
+from main import BotChallenge
+
 from .base_cog import BaseEconomyCog
+from .cooldowns import cooldown
+from .trivia_bank import QuestionBank
+
+log = getLogger('BotChallenge.trivia')
 
 
 class TriviaException(Exception):
     pass
 
 
-# Suboptimal implementation, ideally I'd cache multiple questions at a time
-# but this is good enough for our purposes
 class TriviaQuestion:
     """Represents a trivia question"""
 
     LETTERS = ['A', 'B', 'C', 'D']
 
-    def __init__(self, category, question, correct_answer, incorrect_answers, difficulty):
-        self.category = html.unescape(category)
-        self.question = html.unescape(question)
-        self.correct_answer = html.unescape(correct_answer)
-        self.incorrect_answers = [html.unescape(x) for x in incorrect_answers]
-        self.difficulty = html.unescape(difficulty)
+    def __init__(self, category, question, correct_answer, incorrect_answers, difficulty, *, escaped=True):
+        # Questions from the question bank are already unescaped.
+        unescape = html.unescape if escaped else str
+        self.category = unescape(category)
+        self.question = unescape(question)
+        self.correct_answer = unescape(correct_answer)
+        self.incorrect_answers = [unescape(x) for x in incorrect_answers]
+        self.difficulty = unescape(difficulty)
         self.correct_answer_letter = random.choice(TriviaQuestion.LETTERS)
 
     @classmethod
-    async def get_trivia(cls, get_url: str = "https://opentdb.com/api.php?amount=1&type=multiple") -> TriviaQuestion:
-        try:
-            async with aiohttp.ClientSession() as cs:
-                async with cs.get(get_url) as resp:
-                    question_dict = await resp.json()
-                    questions = question_dict.get('results')
-                    if questions:
-                        result = questions[0]  # first question
-                        return cls(
-                            result['category'], result['question'], result['correct_answer'], result['incorrect_answers'], result['difficulty']
-                        )
-                    else:
-                        raise TriviaException("Invalid response received from API.")
-        except aiohttp.ClientConnectionError:
-            raise TriviaException("Could not connect to OpenTDB server.")
+    def from_result(cls, result: Dict[str, Any]) -> TriviaQuestion:
+        """Creates a question from an entry of OpenTDB's "results" list."""
+        return cls(
+            result['category'],
+            result['question'],
+            result['correct_answer'],
+            result['incorrect_answers'],
+            result['difficulty'],
+        )
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> TriviaQuestion:
+        """Creates a question from a row of the question bank."""
+        return cls(
+            row['category'],
+            row['question'],
+            row['correct_answer'],
+            json.loads(row['incorrect_answers']),
+            row['difficulty'],
+            escaped=False,
+        )
 
     @property
     def embed(self) -> discord.Embed:
-        embed = discord.Embed(title=f'Category: {self.category} ({self.difficulty})', description=self.question, color=discord.Color.blue())
+        embed = discord.Embed(
+            title=f'Category: {self.category} ({self.difficulty})', description=self.question, color=discord.Color.blue()
+        )
 
         incorrect_answers = self.incorrect_answers.copy()
         random.shuffle(incorrect_answers)
@@ -61,6 +82,155 @@ class TriviaQuestion:
         return embed
 
 
+TriviaKey = Tuple[Optional[int], Optional[str]]  # (category, difficulty), None meaning any
+
+
+class TriviaProvider:
+    """Keeps buffers of trivia questions around, so the trivia command doesn't have to wait on OpenTDB.
+
+    There's one queue per (category, difficulty) that has been asked for. Questions are
+    fetched in bulk, ``batch_size`` at a time, and once a queue gets below ``low_water``
+    a refill is started in the background. Only when a queue is completely empty does
+    a command have to wait for the API.
+
+    OpenTDB only allows one request every 5 seconds, so refills are done one at a time.
+
+    Every batch that is fetched is also passed to ``on_fetch``, which is how the question
+    bank grows.
+    """
+
+    API_URL = "https://opentdb.com/api.php"
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        *,
+        url: str = API_URL,
+        batch_size: int = 50,
+        low_water: int = 10,
+        min_interval: float = 5.0,
+        on_fetch: Optional[Callable[[List[TriviaQuestion], Optional[int]], Awaitable[Any]]] = None,
+    ):
+        self.session = session
+        self.on_fetch = on_fetch
+        self.url = url
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.min_interval = min_interval
+        self._queues: Dict[TriviaKey, Deque[TriviaQuestion]] = {}
+        self._refills: Dict[TriviaKey, asyncio.Task[None]] = {}
+        self._lock = asyncio.Lock()
+        self._last_request = 0.0
+
+    def buffered(self, category: Optional[int] = None, difficulty: Optional[str] = None) -> int:
+        return len(self._queues.get((category, difficulty), ()))
+
+    def start(self) -> None:
+        """Starts filling the default queue in the background, unless it has enough questions already."""
+        if self.buffered() < self.low_water:
+            self._refill((None, None))
+
+    def export(self) -> Dict[TriviaKey, List[Tuple[str, ...]]]:
+        """The buffered questions, as (category, question, correct answer, difficulty, *incorrect answers)."""
+        return {
+            key: [(q.category, q.question, q.correct_answer, q.difficulty, *q.incorrect_answers) for q in queue]
+            for key, queue in self._queues.items()
+            if queue
+        }
+
+    def restore(self, buffered: Dict[TriviaKey, List[Tuple[str, ...]]]) -> None:
+        """Buffers questions from :meth:`export` again."""
+        for key, questions in buffered.items():
+            queue = self._queues.setdefault(key, deque())
+            for category, question, correct_answer, difficulty, *incorrect_answers in questions:
+                queue.append(
+                    TriviaQuestion(category, question, correct_answer, incorrect_answers, difficulty, escaped=False)
+                )
+
+    def close(self) -> None:
+        for task in self._refills.values():
+            task.cancel()
+
+    async def get(self, category: Optional[int] = None, difficulty: Optional[str] = None) -> TriviaQuestion:
+        """|coro|
+
+        Gets a question, only waiting on the API if there are none buffered.
+
+        Raises
+        ------
+        TriviaException
+            There were no questions buffered, and OpenTDB didn't give us any.
+        """
+        key = (category, difficulty)
+        if not self._queues.get(key):
+            await asyncio.shield(self._refill(key))
+        question = self.get_nowait(category, difficulty)
+        if question is None:
+            raise TriviaException("Could not get a question from OpenTDB, try again later.")
+        return question
+
+    def get_nowait(self, category: Optional[int] = None, difficulty: Optional[str] = None) -> Optional[TriviaQuestion]:
+        """Gets a buffered question, or None if there are none right now.
+
+        Either way, the queue is refilled in the background if it's running low.
+        """
+        key = (category, difficulty)
+        queue = self._queues.setdefault(key, deque())
+        question = queue.popleft() if queue else None
+        if len(queue) < self.low_water:
+            self._refill(key)
+        return question
+
+    def _refill(self, key: TriviaKey) -> asyncio.Task[None]:
+        task = self._refills.get(key)
+        if task is None or task.done():
+            task = asyncio.create_task(self._fill(key))
+            self._refills[key] = task
+        return task
+
+    async def _fill(self, key: TriviaKey) -> None:
+        try:
+            async with self._lock:
+                wait = self._last_request + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    questions = await self.fetch(self.batch_size, *key)
+                finally:
+                    self._last_request = time.monotonic()
+        except TriviaException as e:
+            log.warning("Could not refill trivia questions for %s: %s", key, e)
+            return
+        self._queues.setdefault(key, deque()).extend(questions)
+        if self.on_fetch is not None:
+            try:
+                await self.on_fetch(questions, key[0])
+            except Exception:
+                log.exception("on_fetch failed for trivia questions %s", key)
+
+    async def fetch(
+        self, amount: int, category: Optional[int] = None, difficulty: Optional[str] = None
+    ) -> List[TriviaQuestion]:
+        """|coro|
+
+        Fetches questions straight from the API.
+        """
+        params: Dict[str, Any] = {"amount": amount, "type": "multiple"}
+        if category is not None:
+            params["category"] = category
+        if difficulty is not None:
+            params["difficulty"] = difficulty
+        try:
+            async with self.session.get(self.url, params=params) as resp:
+                question_dict = await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise TriviaException("Could not connect to OpenTDB server.")
+        questions = question_dict.get('results')
+        if not questions:
+            raise TriviaException(f"Invalid response received from API (code {question_dict.get('response_code')}).")
+        return [TriviaQuestion.from_result(result) for result in questions]
+
+
 class TriviaView(discord.ui.View):
     message: discord.Message  # set when view sent.
 
@@ -82,9 +252,10 @@ class TriviaView(discord.ui.View):
         pick = button.label
         if pick == self.question.correct_answer_letter:
             cog = interaction.client.get_cog("Economy")  # type: ignore
-            wallet = await cog.get_wallet(interaction.user)
             amount_won = random.randint(6, 20)
-            await wallet.add(amount_won)
+            async with cog.user_locks.hold(interaction.user.id):
+                wallet = await cog.get_wallet(interaction.user)
+                await wallet.add(amount_won, reason='trivia')
 
             win_text = f"That's correct. `{pick}` was the correct answer.\n\nYou won {amount_won}€"
             await interaction.response.edit_message(content=win_text, view=None)
@@ -111,11 +282,63 @@ class TriviaView(discord.ui.View):
 
 
 class Trivia(BaseEconomyCog):
+    def __init__(self, bot: BotChallenge):
+        super().__init__(bot)
+        self.trivia_bank = QuestionBank(bot.pool)
+        self.trivia_provider = TriviaProvider(bot.session, on_fetch=self.trivia_bank.add)
+
     @commands.command()
     @commands.guild_only()
-    @commands.cooldown(1, 30.0, commands.BucketType.user)  # 1 time per 30 seconds per user
-    async def trivia(self, ctx: commands.Context):
-        triviaquestion = await TriviaQuestion.get_trivia()
+    @cooldown(30.0)  # 1 time per 30 seconds per user
+    async def trivia(
+        self,
+        ctx: commands.Context,
+        difficulty: Optional[Literal['easy', 'medium', 'hard']] = None,
+        category: Optional[int] = None,
+    ):
+        """Answer a trivia question to earn some money.
+
+        You can pick a difficulty (easy, medium or hard), and an OpenTDB category ID.
+        """
+        # A question you haven't seen yet from the local bank, and only if there are none, OpenTDB.
+        row = await self.trivia_bank.pick(ctx.author.id, category, difficulty)
+        if row is not None:
+            triviaquestion = TriviaQuestion.from_row(row)
+        else:
+            triviaquestion = await self.unseen_from_provider(ctx.author.id, category, difficulty)
         triviaview = TriviaView(ctx.author, triviaquestion)
 
         triviaview.message = await ctx.send(embed=triviaquestion.embed, view=triviaview)
+
+    async def unseen_from_provider(
+        self, user_id: int, category: Optional[int] = None, difficulty: Optional[str] = None
+    ) -> TriviaQuestion:
+        """|coro|
+
+        Gets a question the user hasn't seen from OpenTDB, for when the bank has none left.
+
+        Buffered questions they've seen are skipped, those are in the bank already. Taking
+        them refills the buffer, which is what adds new questions to the bank. Only if none
+        of them are new, it waits for the API, and that question is asked either way.
+        """
+        while (question := self.trivia_provider.get_nowait(category, difficulty)) is not None:
+            if await self.trivia_bank.mark_seen(user_id, question):
+                return question
+        question = await self.trivia_provider.get(category, difficulty)
+        await self.trivia_bank.mark_seen(user_id, question)
+        return question
+
+    @commands.command(aliases=['triviaimport'])
+    @commands.is_owner()
+    async def trivia_import(self, ctx: commands.Context):
+        """Imports an attached JSON dump of OpenTDB questions into the question bank"""
+        if not ctx.message.attachments:
+            raise commands.BadArgument("Attach a JSON file with the questions to import.")
+        added = 0
+        for attachment in ctx.message.attachments:
+            try:
+                added += await self.trivia_bank.import_dump(await attachment.read())
+            except (ValueError, KeyError, TypeError) as e:
+                raise commands.BadArgument(f"Could not import {attachment.filename}: {e!r}")
+        stats = ', '.join(f"{amount} {difficulty}" for difficulty, amount in await self.trivia_bank.stats())
+        await ctx.send(f"Imported {added} new questions. The bank now has {stats or 'no'} questions.")
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import html
+import json
+import random
+import sqlite3
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple
+
+import asqlite
+
+if TYPE_CHECKING:
+    from .trivia import TriviaQuestion
+
+# OpenTDB's category IDs, by the name its questions have (https://opentdb.com/api_category.php).
+CATEGORY_IDS: Dict[str, int] = {
+    'General Knowledge': 9,
+    'Entertainment: Books': 10,
+    'Entertainment: Film': 11,
+    'Entertainment: Music': 12,
+    'Entertainment: Musicals & Theatres': 13,
+    'Entertainment: Television': 14,
+    'Entertainment: Video Games': 15,
+    'Entertainment: Board Games': 16,
+    'Science & Nature': 17,
+    'Science: Computers': 18,
+    'Science: Mathematics': 19,
+    'Mythology': 20,
+    'Sports': 21,
+    'Geography': 22,
+    'History': 23,
+    'Politics': 24,
+    'Art': 25,
+    'Celebrities': 26,
+    'Animals': 27,
+    'Vehicles': 28,
+    'Entertainment: Comics': 29,
+    'Science: Gadgets': 30,
+    'Entertainment: Japanese Anime & Manga': 31,
+    'Entertainment: Cartoon & Animations': 32,
+}
+
+
+class SeenBitmap:
+    """A growable bitset of question IDs."""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes = b'') -> None:
+        self.data = bytearray(data)
+
+    def __contains__(self, question_id: int) -> bool:
+        byte = question_id >> 3
+        return byte < len(self.data) and bool(self.data[byte] & (1 << (question_id & 7)))
+
+    def add(self, question_id: int) -> None:
+        byte = question_id >> 3
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte - len(self.data) + 1))
+        self.data[byte] |= 1 << (question_id & 7)
+
+
+class QuestionBank:
+    """Trivia questions stored in the database, so trivia keeps working without OpenTDB.
+
+    Questions are stored already unescaped, indexed by category and difficulty. Every
+    user has a bitmap of the questions they've been asked, so they don't get the same
+    one twice until they've gone through (most of) the bank.
+
+    Picking a question jumps to a random question ID and reads a handful of IDs from
+    the index from there, so it doesn't matter how big the bank gets.
+
+    Bitmaps are only written back once ``flush_every`` users have been asked new
+    questions, all of them in one transaction, and by :meth:`flush` on shutdown. A
+    crash forgets the questions that were picked since, which just means they can be
+    asked again.
+    """
+
+    def __init__(
+        self,
+        pool: asqlite.Pool,
+        *,
+        sample_size: int = 64,
+        attempts: int = 4,
+        cached_users: int = 1000,
+        flush_every: int = 32,
+    ) -> None:
+        self.pool = pool
+        self.sample_size = sample_size
+        self.attempts = attempts
+        self.cached_users = cached_users
+        self.flush_every = flush_every
+        self._seen: OrderedDict[int, SeenBitmap] = OrderedDict()
+        # Bitmaps that changed since they were last written, evicted ones included.
+        self._dirty: Dict[int, SeenBitmap] = {}
+
+    async def add(self, questions: Iterable[TriviaQuestion], category_id: Optional[int] = None) -> int:
+        """|coro|
+
+        Adds questions to the bank, skipping the ones that are already in it.
+
+        Returns how many were added.
+        """
+        rows = [
+            (
+                CATEGORY_IDS.get(q.category) if category_id is None else category_id,
+                q.category,
+                q.difficulty,
+                q.question,
+                q.correct_answer,
+                json.dumps(q.incorrect_answers),
+            )
+            for q in questions
+        ]
+        return await self._insert(rows)
+
+    async def _insert(self, rows: List[Tuple[Any, ...]]) -> int:
+        async with self.pool.acquire() as conn:
+            before = await conn.fetchone('SELECT total_changes() AS value')
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await conn.executemany(
+                    'INSERT OR IGNORE INTO trivia_questions'
+                    ' (category_id, category, difficulty, question, correct_answer, incorrect_answers)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    rows,
+                )
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+            after = await conn.fetchone('SELECT total_changes() AS value')
+        return after['value'] - before['value']
+
+    async def import_dump(self, data: bytes) -> int:
+        """|coro|
+
+        Imports a JSON dump of questions in OpenTDB's format, either the whole
+        API response or just its "results" list. Returns how many were added.
+        """
+        parsed = json.loads(data)
+        results: List[Dict[str, Any]] = parsed['results'] if isinstance(parsed, dict) else parsed
+        rows = [
+            (
+                CATEGORY_IDS.get(html.unescape(result['category'])),
+                html.unescape(result['category']),
+                html.unescape(result['difficulty']),
+                html.unescape(result['question']),
+                html.unescape(result['correct_answer']),
+                json.dumps([html.unescape(answer) for answer in result['incorrect_answers']]),
+            )
+            for result in results
+            # Only multiple choice questions fit in TriviaView
+            if len(result['incorrect_answers']) == 3
+        ]
+        added = await self._insert(rows)
+        # Questions imported before categories were mapped, or by ID-less fetches, can be picked by category too.
+        async with self.pool.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await conn.executemany(
+                    'UPDATE trivia_questions SET category_id = ? WHERE category = ? AND category_id IS NULL',
+                    [(category_id, category) for category, category_id in CATEGORY_IDS.items()],
+                )
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
+        return added
+
+    async def pick(
+        self, user_id: int, category_id: Optional[int] = None, difficulty: Optional[str] = None
+    ) -> Optional[sqlite3.Row]:
+        """|coro|
+
+        Picks a random question the user hasn't been asked yet, and marks it as seen.
+
+        Returns its row, or None if no such question was found.
+        """
+        filters, params = [], []
+        if category_id is not None:
+            filters.append('category_id = ?')
+            params.append(category_id)
+        if difficulty is not None:
+            filters.append('difficulty = ?')
+            params.append(difficulty)
+        where = ''.join(f'{f} AND ' for f in filters)
+
+        async with self.pool.acquire() as conn:
+            seen = await self._get_seen(conn, user_id)
+            bounds = await conn.fetchone(
+                f'SELECT MIN(question_id) AS lo, MAX(question_id) AS hi FROM trivia_questions WHERE {where}1', tuple(params)
+            )
+            if bounds['lo'] is None:
+                return None
+
+            for _ in range(self.attempts):
+                start = random.randint(bounds['lo'], bounds['hi'])
+                rows = await conn.fetchall(
+                    f'SELECT question_id FROM trivia_questions WHERE {where}question_id >= ? ORDER BY question_id LIMIT ?',
+                    (*params, start, self.sample_size),
+                )
+                if len(rows) < self.sample_size:
+                    # Wrap around to the start, so the last questions aren't less likely to be picked
+                    rows += await conn.fetchall(
+                        f'SELECT question_id FROM trivia_questions WHERE {where}question_id < ?'
+                        ' ORDER BY question_id LIMIT ?',
+                        (*params, start, self.sample_size - len(rows)),
+                    )
+                unseen = [row['question_id'] for row in rows if row['question_id'] not in seen]
+                if unseen:
+                    break
+            else:
+                return None
+
+            question_id = random.choice(unseen)
+            row = await conn.fetchone('SELECT * FROM trivia_questions WHERE question_id = ?', (question_id,))
+            self._mark(user_id, seen, question_id)
+
+        if len(self._dirty) >= self.flush_every:
+            await self.flush()
+        return row
+
+    async def mark_seen(self, user_id: int, question: TriviaQuestion) -> bool:
+        """|coro|
+
+        Marks a question that didn't come from :meth:`pick` as seen, adding it to the bank first
+        if it isn't in it yet.
+
+        Returns False if the user has been asked it before.
+        """
+        question_id = await self._question_id(question)
+        if question_id is None:
+            await self.add([question])
+            question_id = await self._question_id(question)
+        assert question_id is not None
+        async with self.pool.acquire() as conn:
+            seen = await self._get_seen(conn, user_id)
+        if question_id in seen:
+            return False
+        self._mark(user_id, seen, question_id)
+
+        if len(self._dirty) >= self.flush_every:
+            await self.flush()
+        return True
+
+    async def _question_id(self, question: TriviaQuestion) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchone('SELECT question_id FROM trivia_questions WHERE question = ?', (question.question,))
+        return None if row is None else row['question_id']
+
+    def _mark(self, user_id: int, seen: SeenBitmap, question_id: int) -> None:
+        seen.add(question_id)
+        self._dirty[user_id] = seen
+
+    async def flush(self) -> None:
+        """|coro|
+
+        Writes the seen bitmaps that changed since the last flush.
+        """
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                try:
+                    await conn.executemany(
+                        'INSERT INTO trivia_seen (user_id, seen) VALUES (?, ?) ON CONFLICT DO UPDATE SET seen = excluded.seen',
+                        [(user_id, bytes(seen.data)) for user_id, seen in dirty.items()],
+                    )
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                await conn.commit()
+        except BaseException:
+            # Try again with the next flush, keeping anything that changed in the meantime.
+            self._dirty = {**dirty, **self._dirty}
+            raise
+
+    async def stats(self) -> List[Tuple[str, int]]:
+        """|coro|
+
+        How many questions there are per difficulty.
+        """
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetchall('SELECT difficulty, COUNT(*) AS amount FROM trivia_questions GROUP BY difficulty')
+        return [(row['difficulty'], row['amount']) for row in rows]
+
+    async def _get_seen(self, conn: asqlite.Connection, user_id: int) -> SeenBitmap:
+        seen = self._seen.get(user_id)
+        if seen is None:
+            # Evicted before it was written back, the database has an older one.
+            seen = self._dirty.get(user_id)
+        if seen is None:
+            row = await conn.fetchone('SELECT seen FROM trivia_seen WHERE user_id = ?', (user_id,))
+            seen = SeenBitmap(row['seen'] if row else b'')
+        if user_id not in self._seen:
+            self._seen[user_id] = seen
+            if len(self._seen) > self.cached_users:
+                self._seen.popitem(last=False)
+        else:
+            self._seen.move_to_end(user_id)
+        return seen
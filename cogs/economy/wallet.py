@@ -1,6 +1,7 @@
 import asyncio
 import random
-from sqlite3 import Row
+import time
+from typing import Optional
 
 import discord
 from discord.ext import commands
@@ -8,6 +9,9 @@ from discord.ext import commands
 from components import embeds
 
 from .base_cog import BaseEconomyCog
+from .cooldowns import cooldown
+from .leaderboard import Leaderboard, LeaderboardView
+from .operations import bump_wallet_version
 
 
 class LeaderboardFlags(commands.FlagConverter, prefix='--', delimiter=' '):
@@ -28,10 +32,20 @@ class WalletManagement(BaseEconomyCog):
     @commands.command()
     async def start(self, ctx: commands.Context):
         """Opens a wallet for you"""
-        async with self.bot.pool.acquire() as conn:
-            await conn.execute('INSERT INTO wallets (user_id) VALUES (?) ON CONFLICT DO NOTHING', (ctx.author.id,))
+        async with self.user_locks.hold(ctx.author.id), self.bot.pool.acquire() as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                await conn.execute('INSERT INTO wallets (user_id) VALUES (?) ON CONFLICT DO NOTHING', (ctx.author.id,))
+                await bump_wallet_version(conn)
+            except BaseException:
+                await conn.rollback()
+                raise
             await conn.commit()
-            await ctx.send(embed=embeds.Embed.Success('Success', 'You have succesfully started :) welcome to the economy'))
+            self.registered_users.add(ctx.author.id)
+            if ctx.author.id not in self.ranking:
+                self.ranking.update(ctx.author.id, 0)
+                self.publish_wallet(ctx.author.id, 0)
+        await ctx.send(embed=embeds.Embed.Success('Success', 'You have succesfully started :) welcome to the economy'))
 
     @commands.command()
     async def quit(self, ctx: commands.Context):
@@ -46,10 +60,43 @@ class WalletManagement(BaseEconomyCog):
         if msg.content.lower() != 'y':
             return await ctx.send('Quitting cancelled.')
 
-        async with self.bot.pool.acquire() as conn:
-            await conn.execute('DELETE FROM wallets WHERE user_id = ?', (ctx.author.id,))
-            await conn.commit()
-            await ctx.send(embed=embeds.Embed.Success('Success', 'You have succesfully quit the economy :('))
+        async with self.user_locks.hold(ctx.author.id):
+            if self.balance_journal:
+                # Don't let journaled changes end up in a new wallet if they start again. It's flushed
+                # under the lock, so nothing can be journaled for them between this and the delete.
+                await self.balance_journal.flush()
+            async with self.bot.pool.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                try:
+                    await conn.execute('DELETE FROM wallets WHERE user_id = ?', (ctx.author.id,))
+                    await bump_wallet_version(conn)
+                except BaseException:
+                    await conn.rollback()
+                    raise
+                await conn.commit()
+            self.invalidate_wallet(ctx.author.id)
+            self.registered_users.discard(ctx.author.id)
+            self.ranking.remove(ctx.author.id)
+            self.publish_wallet(ctx.author.id, None)
+        await ctx.send(embed=embeds.Embed.Success('Success', 'You have succesfully quit the economy :('))
+
+    @commands.command(aliases=['cachestats'])
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context):
+        """Shows how well the wallet cache is doing"""
+        cache = self._wallets
+        stats = cache.stats
+        embed = discord.Embed(title='Wallet cache', color=discord.Color.blurple())
+        embed.add_field(name='Wallets', value=f'{len(cache)}/{cache.max_size}')
+        embed.add_field(name='Memory', value=f'~{cache.nbytes / 1024:.1f} KiB')
+        embed.add_field(name='Hit rate', value=f'{stats.hit_rate:.1%}')
+        embed.add_field(name='Hits', value=stats.hits)
+        embed.add_field(name='Misses', value=stats.misses)
+        embed.add_field(name='Evictions', value=f'{stats.evictions} (+{stats.expirations} expired)')
+        embed.add_field(name='Invalidations', value=stats.invalidations)
+        locks = self.user_locks
+        embed.add_field(name='Wallet lock waits', value=f'{locks.contended}/{locks.acquired} over {len(locks)} locks')
+        await ctx.send(embed=embed)
 
     @commands.command(aliases=['bal'])
     async def balance(self, ctx: commands.Context, user: discord.User = commands.Author):
@@ -57,36 +104,77 @@ class WalletManagement(BaseEconomyCog):
         wallet = await self.get_wallet(user)
         await ctx.send(f'`{user}` has `{self.currency_symbol}{wallet.balance}`')
 
+    @commands.command(aliases=['history'])
+    async def earnings(self, ctx: commands.Context):
+        """Shows what you earned and spent in the last 24 hours, and your latest transactions"""
+        if self.ledger is None:
+            raise commands.BadArgument('Transaction history is turned off.')
+        totals = await self.ledger.totals(ctx.author.id, int(time.time()) - 24 * 60 * 60)
+        entries = await self.ledger.history(ctx.author.id)
+        lines = [
+            f'<t:{entry.ts}:R> {entry.kind}: {"+" if entry.delta > 0 else "-"}{self.currency_symbol}{abs(entry.delta)}'
+            for entry in entries
+        ]
+        embed = discord.Embed(title='Earnings', color=discord.Color.blurple(), description='\n'.join(lines) or None)
+        embed.add_field(name='Earned (24h)', value=f'{self.currency_symbol}{totals.earned}')
+        embed.add_field(name='Spent (24h)', value=f'{self.currency_symbol}{totals.spent}')
+        await ctx.send(embed=embed)
+
     @commands.command()
     async def pay(self, ctx: commands.Context, user: discord.User, amount: int):
         """Transfers money to a user."""
-        other_wallet = await self.get_wallet(user)
-        your_wallet = await self.get_wallet(ctx.author)
-        await your_wallet.withdraw(amount)
-        await other_wallet.add(amount)
+        if amount <= 0:
+            raise commands.BadArgument('You need to pay at least 1.')
+        # Both in one go, they're taken in a fixed order so paying each other can't deadlock.
+        async with self.user_locks.hold(ctx.author.id, user.id):
+            other_wallet = await self.get_wallet(user)
+            your_wallet = await self.get_wallet(ctx.author)
+            await self.transaction('pay').transfer(your_wallet, other_wallet, amount).commit()
         await ctx.send(f"You gave them `{amount} {self.currency_name}`")
 
     @commands.command()
-    @commands.cooldown(1, 5 * 60, commands.BucketType.user)
+    @cooldown(5 * 60)
     async def work(self, ctx: commands.Context):
         """The simplest way to earn money.
 
         This command can be ran once every 5 minutes."""
-        money = random.randint(10, 100)
-        wallet = await self.get_wallet(ctx.author)
-        await wallet.add(money)
-        await ctx.send(random.choice(self.WORK_MESSAGES).format(self.currency_symbol + str(money)))
+        money = random.randint(10, 100) * self.bonus_multiplier
+        async with self.user_locks.hold(ctx.author.id):
+            wallet = await self.get_wallet(ctx.author)
+            await wallet.add(money, reason='work')
+        await ctx.send(random.choice(self.WORK_MESSAGES).format(self.currency_symbol + str(money)) + self._bonus_note())
 
     @commands.command()
-    @commands.cooldown(1, 24 * 60 * 60, commands.BucketType.user)
+    @cooldown(24 * 60 * 60)
     async def daily(self, ctx: commands.Context):
         """The simplest way to earn money.
 
         This command can be ran once every day."""
-        money = random.randint(1000, 5000)
-        wallet = await self.get_wallet(ctx.author)
-        await wallet.add(money)
-        await ctx.send(f"Today, you earned {self.currency_symbol}{money}")
+        money = random.randint(1000, 5000) * self.bonus_multiplier
+        async with self.user_locks.hold(ctx.author.id):
+            wallet = await self.get_wallet(ctx.author)
+            await wallet.add(money, reason='daily')
+        await ctx.send(f"Today, you earned {self.currency_symbol}{money}" + self._bonus_note())
+
+    def _bonus_note(self) -> str:
+        multiplier = self.bonus_multiplier
+        return f' ({multiplier}x, it\'s bonus hours!)' if multiplier > 1 else ''
+
+    async def _leaderboard(self, ctx: commands.Context, scope: LeaderboardFlags) -> Leaderboard:
+        if not scope.guild:
+            return Leaderboard(self.bot.pool, ranking=self.ranking)
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage('The guild leaderboard can only be used in a server.')
+        if ctx.guild.chunked:
+            member_ids = await self.guild_members.ids(ctx.guild)
+        else:
+            # Without the member cache, this has to ask Discord for the guild's members.
+            async with ctx.typing():
+                member_ids = await self.guild_members.ids(ctx.guild)
+        if self.registered_users.ready:
+            # No point in sending the database members that don't have a wallet.
+            member_ids = [member_id for member_id in member_ids if member_id in self.registered_users]
+        return Leaderboard(self.bot.pool, member_ids)
 
     @commands.command(aliases=['lb'])
     async def leaderboard(self, ctx: commands.Context, *, scope: LeaderboardFlags):
@@ -95,33 +183,28 @@ class WalletManagement(BaseEconomyCog):
         You can pass a scope flag for a more specific leaderboard.
         `guild` : only shows users from the current guild. Example: `--guild`
         """
+        view = LeaderboardView(
+            ctx,
+            await self._leaderboard(ctx, scope),
+            self.user_resolver,
+            title='Leaderboard',
+            footer=f"Scope: {'guild' if scope.guild else 'global'}",
+        )
+        view.message = await ctx.send(embed=await view.load(), view=view)
 
-        assert ctx.guild is not None
-        user_ids_current_guild = [user.id for user in ctx.guild.members]
-
-        if scope.guild is False:
-            async with self.bot.pool.acquire() as conn:
-                raw_users = await conn.fetchall('SELECT * FROM wallets')
-                await conn.commit()
-        else:
-            async with self.bot.pool.acquire() as conn:
-                raw_users = await conn.fetchall('SELECT * FROM wallets WHERE user_id in $1', (user_ids_current_guild))
-                await conn.commit()
-
-        def key(row: Row) -> int:
-            return row['balance']
-
-        raw_users.sort(key=key, reverse=True)
-
-        table: list[str] = []
-
-        for index, row in enumerate(raw_users):
-            user = self.bot.get_user(row['user_id'])
-            if not user:
-                user = await self.bot.fetch_user(row['user_id'])
-
-            table.append(f"{index + 1}) {self.currency_symbol}{row['balance']} - {f'{user} (ID: {user.id})'}")
+    @commands.command()
+    async def rank(self, ctx: commands.Context, user: Optional[discord.User], *, scope: LeaderboardFlags):
+        """Shows where you (or someone else) stand on the leaderboard.
 
-        em = discord.Embed(description='\n'.join(table), title='Leaderboard')
-        em.set_footer(text=f"Scope: {'guild' if scope.guild else 'global'}")
-        await ctx.send(embed=em)
+        Accepts the same scope flags as the leaderboard command.
+        """
+        user = user or ctx.author
+        entry = await (await self._leaderboard(ctx, scope)).rank_of(user.id)
+        if entry is None:
+            raise commands.BadArgument('Wallet not found.')
+        scope_name = 'guild' if scope.guild else 'global'
+        message = f'`{user}` is #{entry.rank} on the {scope_name} leaderboard with `{self.currency_symbol}{entry.balance}`'
+        percentile = None if scope.guild or not self.ranking.ready else self.ranking.percentile(user.id)
+        if percentile is not None:
+            message += f', richer than {percentile:.1f}% of players'
+        await ctx.send(message)
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import time
+from logging import getLogger
+from typing import TYPE_CHECKING, Any, Callable, Coroutine, Optional
+
+from discord.ext import commands
+
+from main import BotChallenge, getenv_int
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+log = getLogger('BotChallenge.instrumentation')
+
+Hook = Callable[[commands.Context], Coroutine[Any, Any, Any]]
+
+
+class Instrumentation(commands.Cog):
+    """Times every command, and serves the bot's metrics.
+
+    With ``METRICS_PORT`` set, ``/metrics`` (Prometheus' text format) and ``/metrics.json``
+    are served on ``127.0.0.1``, so they're only reachable from the machine the bot runs on.
+    """
+
+    def __init__(self, bot: BotChallenge) -> None:
+        self.bot = bot
+        self.port = getenv_int('METRICS_PORT', 0)
+        if self.port and bot.cluster is not None:
+            # Every process in the cluster serves its own metrics, on the ports after this one.
+            self.port += bot.cluster.cluster_id
+        self._runner: Optional[web.AppRunner] = None
+        self._previous_before: Optional[Hook] = None
+        self._previous_after: Optional[Hook] = None
+
+    async def cog_load(self) -> None:
+        # The bot only has one of each hook, so the ones that were there are called from ours.
+        self._previous_before = self.bot._before_invoke
+        self._previous_after = self.bot._after_invoke
+        self.bot.before_invoke(self.before_invoke)
+        self.bot.after_invoke(self.after_invoke)
+        if self.port:
+            # Only imported when it's used, it's a good chunk of startup time.
+            from aiohttp import web
+
+            app = web.Application()
+            app.router.add_get('/metrics', self.prometheus_endpoint)
+            app.router.add_get('/metrics.json', self.json_endpoint)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+            log.info('Serving metrics on http://127.0.0.1:%s/metrics', self.port)
+
+    async def cog_unload(self) -> None:
+        # discord.py has no way to remove the hooks other than this. Put the previous ones back,
+        # unless another hook replaced ours in the meantime.
+        if self.bot._before_invoke == self.before_invoke:
+            self.bot._before_invoke = self._previous_before
+        if self.bot._after_invoke == self.after_invoke:
+            self.bot._after_invoke = self._previous_after
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def before_invoke(self, ctx: commands.Context) -> None:
+        ctx.invoked_at = time.perf_counter()  # type: ignore
+        if self._previous_before is not None:
+            await self._previous_before(ctx)
+
+    async def after_invoke(self, ctx: commands.Context) -> None:
+        if self._previous_after is not None:
+            await self._previous_after(ctx)
+        started = getattr(ctx, 'invoked_at', None)
+        if started is None or ctx.command is None:
+            return
+        self.bot.metrics.observe(
+            'command_seconds',
+            time.perf_counter() - started,
+            command=ctx.command.qualified_name,
+            status='error' if ctx.command_failed else 'ok',
+        )
+
+    async def prometheus_endpoint(self, request: web.Request) -> web.Response:
+        from aiohttp import web
+
+        return web.Response(text=self.bot.metrics.to_prometheus(), content_type='text/plain')
+
+    async def json_endpoint(self, request: web.Request) -> web.Response:
+        from aiohttp import web
+
+        return web.json_response(self.bot.metrics.to_json())
+
+    @commands.command(name='metrics')
+    @commands.is_owner()
+    async def show_metrics(self, ctx: commands.Context, name: Optional[str] = None, limit: int = 15):
+        """Shows latency percentiles, slowest in total first
+
+        Pass a metric to only show that one: command_seconds, query_seconds,
+        pool_acquire_seconds or http_seconds. Pass "reset" to start over.
+        """
+        if name == 'reset':
+            self.bot.metrics.reset()
+            return await ctx.send('Metrics reset.')
+        rows = self.bot.metrics.summary(name)[:limit]
+        if not rows:
+            return await ctx.send('Nothing recorded yet.')
+        # Owner only and rarely used, so it's not worth importing on startup.
+        import tabulate
+
+        table = tabulate.tabulate(
+            [
+                (
+                    row['name'].removesuffix('_seconds'),
+                    ' '.join(f'{value}' for value in row['labels'].values())[:60],
+                    row['count'],
+                    *(f"{row[q] * 1000:.1f}" for q in ('p50', 'p95', 'p99')),
+                )
+                for row in rows
+            ],
+            headers=('Metric', 'Labels', 'Count', 'p50 ms', 'p95 ms', 'p99 ms'),
+        )
+        uptime = time.time() - self.bot.metrics.started_at
+        # Leave some room for the code block, like jishaku would paginate it.
+        await ctx.send(f'```\n{table[:1900]}\n```\nRecorded over the last {uptime / 60:.0f} minutes.')
+
+
+async def setup(bot: BotChallenge):
+    await bot.add_cog(Instrumentation(bot))
@@ -0,0 +1,370 @@
+"""Running the bot as several processes, each owning a range of shards.
+
+With ``CLUSTER_PROCESSES`` above 1, ``python main.py`` starts a :class:`Supervisor` instead
+of the bot. It works out the shard count, starts one worker process per shard range (each
+one a normal ``main.py`` with ``CLUSTER_ID`` set), and restarts workers that die.
+
+The workers share the SQLite database, and keep each other's caches up to date through a
+small message bus the supervisor runs on ``127.0.0.1`` (see :class:`ClusterLink`). Jobs that
+only one process should run, like drawing lotteries, are given to whichever worker holds a
+:class:`LeaderLease` in the database.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+from dataclasses import dataclass, field
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Set
+
+import aiohttp
+import asqlite
+import discord
+
+log = getLogger('BotChallenge.cluster')
+
+Handler = Callable[[Dict[str, Any]], None]
+
+# A worker that doesn't read its messages gets disconnected once this much is waiting for it.
+MAX_BUFFERED = 4 * 1024 * 1024
+
+
+def shard_ranges(shard_count: int, processes: int) -> List[List[int]]:
+    """Splits the shards into (at most) ``processes`` contiguous ranges of about the same size."""
+    processes = max(min(processes, shard_count), 1)
+    return [list(range(i * shard_count // processes, (i + 1) * shard_count // processes)) for i in range(processes)]
+
+
+async def recommended_shards(token: str) -> int:
+    """|coro|
+
+    Asks Discord how many shards the bot should use.
+    """
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f'{discord.http.Route.BASE}/gateway/bot', headers={'Authorization': f'Bot {token}'}
+        ) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return int(data['shards'])
+
+
+class LeaderLease:
+    """A named lease in the ``cluster_leases`` table, held by one process at a time.
+
+    The holder renews it every ``ttl / 3`` seconds. If it stops doing so (it crashed, or is
+    stuck), the lease expires after ``ttl`` seconds and another process takes over.
+    ``on_elected`` and ``on_deposed`` are called when this process gains or loses the lease.
+
+    Parameters
+    ----------
+    pool: asqlite.Pool
+    name: str
+        What the lease is for, like ``'lottery'``.
+    holder: str
+        Who this process is, unique across the cluster.
+    ttl: float
+        Seconds a lease lasts without being renewed.
+    """
+
+    def __init__(self, pool: asqlite.Pool, name: str, holder: str, *, ttl: float = 30.0) -> None:
+        self.pool = pool
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.held = False
+        self._task: Optional[asyncio.Task[None]] = None
+
+    async def try_acquire(self) -> bool:
+        """|coro|
+
+        Takes or renews the lease, returns whether this process holds it now.
+        """
+        now = time.time()
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchone(
+                'INSERT INTO cluster_leases (name, holder, expires_at) VALUES (:name, :holder, :expires_at)'
+                '\nON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at'
+                ' WHERE cluster_leases.holder = excluded.holder OR cluster_leases.expires_at < :now'
+                ' RETURNING holder',
+                {'name': self.name, 'holder': self.holder, 'expires_at': now + self.ttl, 'now': now},
+            )
+        return row is not None
+
+    async def release(self) -> None:
+        """|coro|
+
+        Gives the lease up, so another process doesn't have to wait for it to expire.
+        """
+        async with self.pool.acquire() as conn:
+            await conn.execute('DELETE FROM cluster_leases WHERE name = ? AND holder = ?', (self.name, self.holder))
+        self.held = False
+
+    def start(self, *, on_elected: Callable[[], Awaitable[object]], on_deposed: Callable[[], Awaitable[object]]) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(on_elected, on_deposed))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.held:
+            await self.release()
+
+    async def _run(self, on_elected: Callable[[], Awaitable[object]], on_deposed: Callable[[], Awaitable[object]]) -> None:
+        while True:
+            try:
+                held = await self.try_acquire()
+            except Exception:
+                log.exception('Could not renew the %r lease', self.name)
+                # Better to stop than to risk two processes doing the same job.
+                held = False
+            if held != self.held:
+                self.held = held
+                log.info('%s the %r lease', 'Took' if held else 'Lost', self.name)
+                try:
+                    await (on_elected() if held else on_deposed())
+                except Exception:
+                    log.exception('Handling the %r lease changing hands failed', self.name)
+            await asyncio.sleep(self.ttl / 3)
+
+
+class ClusterLink:
+    """A worker's place in the cluster: its shards, and its connection to the message bus.
+
+    Messages are JSON objects with a ``topic``. :meth:`publish` sends one to every other
+    worker, where the handlers subscribed to its topic are called with it. Delivery
+    is best effort: messages sent while the bus is unreachable are dropped, so they should
+    only be used to drop or refresh things that can be read from the database again.
+
+    Parameters
+    ----------
+    cluster_id: int
+        Which worker this is.
+    shard_ids: List[int]
+    shard_count: int
+    port: int
+        Where the supervisor's bus is listening.
+    secret: str
+        Proves to the bus that this is one of its workers.
+    """
+
+    def __init__(self, cluster_id: int, shard_ids: List[int], shard_count: int, port: int, secret: str) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.port = port
+        self.secret = secret
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{cluster_id}'
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task[None]] = None
+
+    @classmethod
+    def from_env(cls, environ: Mapping[str, str] = os.environ) -> Optional[ClusterLink]:
+        """The link the supervisor set up for this worker, or None if this isn't a cluster worker."""
+        if not environ.get('CLUSTER_ID'):
+            return None
+        return cls(
+            int(environ['CLUSTER_ID']),
+            [int(shard_id) for shard_id in environ['CLUSTER_SHARDS'].split(',')],
+            int(environ['SHARD_COUNT']),
+            int(environ['CLUSTER_PORT']),
+            environ['CLUSTER_SECRET'],
+        )
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def lease(self, pool: asqlite.Pool, name: str, *, ttl: float = 30.0) -> LeaderLease:
+        return LeaderLease(pool, name, self.holder, ttl=ttl)
+
+    def subscribe(self, topic: str, handler: Handler) -> None:
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def unsubscribe(self, topic: str, handler: Handler) -> None:
+        handlers = self._handlers.get(topic, [])
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def publish(self, topic: str, **data: Any) -> None:
+        """Sends a message to the other workers, without waiting for it to be sent."""
+        if self._writer is None:
+            return
+        self._writer.write(json.dumps({'topic': topic, 'from': self.cluster_id, **data}).encode() + b'\n')
+
+    def _dispatch(self, message: Dict[str, Any]) -> None:
+        for handler in self._handlers.get(message.get('topic', ''), ()):
+            try:
+                handler(message)
+            except Exception:
+                log.exception('Handling cluster message %r failed', message)
+
+    async def _run(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+                writer.write(json.dumps({'cluster_id': self.cluster_id, 'secret': self.secret}).encode() + b'\n')
+                self._writer = writer
+                delay = 1.0
+                log.info('Cluster %s connected to the bus', self.cluster_id)
+                while line := await reader.readline():
+                    self._dispatch(json.loads(line))
+            except (OSError, ValueError) as e:
+                log.warning('Cluster bus connection failed: %s', e)
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+@dataclass
+class Worker:
+    cluster_id: int
+    shard_ids: List[int]
+    process: Optional[asyncio.subprocess.Process] = field(default=None, repr=False)
+    restarts: int = 0
+
+
+class Supervisor:
+    """Starts a worker process per shard range, restarts the ones that exit, and runs the message bus.
+
+    Parameters
+    ----------
+    shard_count: int
+    processes: int
+        How many workers to run, at most one per shard.
+    command: Optional[List[str]]
+        How to start a worker, ``python main.py`` by default.
+    """
+
+    def __init__(self, shard_count: int, processes: int, *, command: Optional[List[str]] = None) -> None:
+        self.shard_count = shard_count
+        self.workers = [Worker(i, shard_ids) for i, shard_ids in enumerate(shard_ranges(shard_count, processes))]
+        self.command = command or [sys.executable, os.path.abspath(sys.argv[0])]
+        self.secret = secrets.token_hex(16)
+        self.port = 0
+        self._peers: Set[asyncio.StreamWriter] = set()
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def run(self) -> None:
+        server = await asyncio.start_server(self._serve_bus, '127.0.0.1', 0)
+        self.port = server.sockets[0].getsockname()[1]
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows, Ctrl+C still raises KeyboardInterrupt there
+
+        log.info(
+            'Starting %s workers for %s shards: %s',
+            len(self.workers),
+            self.shard_count,
+            ', '.join(f'{w.shard_ids[0]}-{w.shard_ids[-1]}' for w in self.workers),
+        )
+        async with server:
+            keepers = [asyncio.create_task(self._keep_alive(worker)) for worker in self.workers]
+            try:
+                await self._stopping.wait()
+            finally:
+                self._stopping.set()
+                await asyncio.gather(*(self._terminate(worker) for worker in self.workers))
+                for task in keepers:
+                    task.cancel()
+                for peer in self._peers:
+                    peer.close()
+
+    def _env(self, worker: Worker) -> Dict[str, str]:
+        return {
+            **os.environ,
+            'CLUSTER_ID': str(worker.cluster_id),
+            'CLUSTER_SHARDS': ','.join(map(str, worker.shard_ids)),
+            'SHARD_COUNT': str(self.shard_count),
+            'CLUSTER_PORT': str(self.port),
+            'CLUSTER_SECRET': self.secret,
+        }
+
+    async def _keep_alive(self, worker: Worker) -> None:
+        delay = 1.0
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            worker.process = await asyncio.create_subprocess_exec(*self.command, env=self._env(worker))
+            code = await worker.process.wait()
+            if self._stopping.is_set():
+                return
+            # Only back off for workers that keep dying right away.
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            worker.restarts += 1
+            log.warning('Cluster %s exited with %s, restarting it in %.0fs', worker.cluster_id, code, delay)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, 60.0)
+
+    async def _terminate(self, worker: Worker, timeout: float = 30.0) -> None:
+        process = worker.process
+        if process is None or process.returncode is not None:
+            return
+        # Like Ctrl+C, so the worker closes the bot and the database properly.
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log.warning('Cluster %s did not stop in time, killing it', worker.cluster_id)
+            process.kill()
+            await process.wait()
+
+    async def _serve_bus(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            hello = json.loads(await reader.readline() or b'{}')
+        except ValueError:
+            hello = {}
+        if not secrets.compare_digest(str(hello.get('secret', '')), self.secret):
+            writer.close()
+            return
+        self._peers.add(writer)
+        try:
+            while line := await reader.readline():
+                for peer in list(self._peers):
+                    if peer is writer:
+                        continue
+                    if peer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                        log.warning('A cluster worker is not reading its messages, disconnecting it')
+                        self._peers.discard(peer)
+                        peer.close()
+                        continue
+                    peer.write(line)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import resource
+import sys
+from array import array
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Dict, Iterable, Optional
+
+import discord
+
+log = getLogger('BotChallenge.gateway')
+
+# Member attributes that point at objects shared with the rest of the cache, which
+# a member doesn't add to the bill.
+_SHARED = frozenset(('guild', '_state'))
+
+
+@dataclass
+class GatewayProfile:
+    """What the bot asks Discord to send it, and how much of that it keeps.
+
+    By default everything is requested and cached, and every guild is chunked on startup.
+    In a big guild, members and their presences are most of the bot's memory, and chunking
+    them is most of its startup time.
+
+    A *lean* profile only asks for what commands need: guilds, messages (for the prefix)
+    and members. Members aren't cached and guilds aren't chunked, the guild leaderboard
+    requests a guild's members when it needs them instead (see ``GuildMembers``).
+
+    Attributes
+    ----------
+    lean: bool
+    max_messages: Optional[int]
+        How many messages to cache, None or 0 disables the message cache.
+    """
+
+    lean: bool = False
+    max_messages: Optional[int] = 1000
+
+    @property
+    def intents(self) -> discord.Intents:
+        if not self.lean:
+            return discord.Intents.all()
+        # Members is needed to request a guild's members at all.
+        return discord.Intents(guilds=True, guild_messages=True, dm_messages=True, message_content=True, members=True)
+
+    @property
+    def member_cache_flags(self) -> discord.MemberCacheFlags:
+        return discord.MemberCacheFlags.none() if self.lean else discord.MemberCacheFlags.from_intents(self.intents)
+
+    def client_options(self) -> Dict[str, Any]:
+        """The keyword arguments to pass to the bot's constructor."""
+        return {
+            'intents': self.intents,
+            'member_cache_flags': self.member_cache_flags,
+            'chunk_guilds_at_startup': not self.lean,
+            # discord.py turns 0 into its default of 1000.
+            'max_messages': self.max_messages or None,
+        }
+
+    def report(self, bot: discord.Client) -> Dict[str, Any]:
+        """Logs how much of the gateway's data is being kept, and roughly how much memory not keeping the rest saves.
+
+        Meant to be called once the bot is ready. The savings are estimated from the size of
+        the members that are cached, presences and the message cache aren't counted.
+        """
+        members = sum(guild.member_count or 0 for guild in bot.guilds)
+        cached = sum(len(guild.members) for guild in bot.guilds)
+        per_member = _mean(_member_size(member) for guild in bot.guilds for member in guild.members[:100])
+        stats: Dict[str, Any] = {
+            'lean': self.lean,
+            'guilds': len(bot.guilds),
+            'members': members,
+            'cached_members': cached,
+            'cached_users': len(bot.users),
+            'max_messages': self.max_messages or None,
+            'bytes_per_member': per_member,
+            'saved_bytes': max(members - cached, 0) * per_member,
+            'peak_rss_kib': peak_rss_kib(),
+        }
+        log.info(
+            'Gateway: %s profile, caching %s of %s members in %s guilds, message cache %s. '
+            'Not caching the rest saves ~%.1f MiB (%s B per member). Peak RSS %.1f MiB.',
+            'lean' if self.lean else 'full',
+            cached,
+            members,
+            stats['guilds'],
+            self.max_messages or 'off',
+            stats['saved_bytes'] / 1024**2,
+            per_member,
+            stats['peak_rss_kib'] / 1024,
+        )
+        return stats
+
+
+def _member_size(member: discord.Member) -> int:
+    """Roughly how many bytes a cached member takes, its user and their attributes included."""
+    size = 0
+    for obj in (member, member._user):
+        size += sys.getsizeof(obj)
+        for cls in type(obj).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                if slot in _SHARED:
+                    continue
+                value = getattr(obj, slot, None)
+                if isinstance(value, (str, bytes, int, tuple, list, dict, array)) and not isinstance(value, bool):
+                    size += sys.getsizeof(value)
+    return size
+
+
+def _mean(values: Iterable[int]) -> int:
+    total = count = 0
+    for value in values:
+        total += value
+        count += 1
+    return total // count if count else 0
+
+
+def peak_rss_kib() -> int:
+    """The most memory this process has used so far, in KiB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return usage // 1024 if sys.platform == 'darwin' else usage
@@ -0,0 +1,254 @@
+"""Latency histograms for commands, the database and Discord's API.
+
+Everything is recorded in one :class:`Metrics` registry on the bot (``bot.metrics``):
+
+- ``command_seconds``: how long commands take, from the invoke hooks in ``cogs/instrumentation.py``
+- ``pool_acquire_seconds``: how long we wait for a connection from the pool
+- ``query_seconds``: how long each query takes, keyed by its normalized SQL
+- ``http_seconds``: requests to Discord's API, by route
+
+If a command is slow but its queries aren't, it's either waiting on the pool or on Discord.
+"""
+
+from __future__ import annotations
+
+import bisect
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import aiohttp
+import asqlite
+
+# Upper bounds in seconds, every bucket is ~19% wider than the one before it,
+# from 0.1ms up to about 100 seconds. That keeps percentiles within ~19% of the truth.
+BUCKETS: Tuple[float, ...] = tuple(0.0001 * 2 ** (i / 4) for i in range(81))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observed durations, in :data:`BUCKETS`."""
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self) -> None:
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)  # the last one is everything above the biggest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        """Estimates the ``q``-th percentile (0-100), as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, amount in enumerate(self.counts):
+            seen += amount
+            if seen >= rank and amount:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics:
+    """A registry of histograms, keyed by name and labels."""
+
+    QUANTILES = (50, 95, 99)
+
+    def __init__(self, *, prefix: str = 'botchallenge') -> None:
+        self.prefix = prefix
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.started_at = time.time()
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self) -> None:
+        self.histograms.clear()
+        self.started_at = time.time()
+
+    def summary(self, name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Every histogram (or the ones called ``name``) as a dict, the slowest in total first."""
+        rows: List[Dict[str, Any]] = []
+        for (metric, labels), histogram in self.histograms.items():
+            if name is not None and metric != name:
+                continue
+            row: Dict[str, Any] = {'name': metric, 'labels': dict(labels), 'count': histogram.count}
+            row['sum'] = histogram.sum
+            row['mean'] = histogram.mean
+            row['max'] = histogram.max
+            for q in self.QUANTILES:
+                row[f'p{q}'] = histogram.percentile(q)
+            rows.append(row)
+        rows.sort(key=lambda row: row['sum'], reverse=True)
+        return rows
+
+    def to_json(self) -> Dict[str, Any]:
+        return {'started_at': self.started_at, 'metrics': self.summary()}
+
+    def to_prometheus(self) -> str:
+        """The metrics in Prometheus' text format, as summaries."""
+        lines: List[str] = []
+        by_name: Dict[str, List[Tuple[Labels, Histogram]]] = {}
+        for (name, labels), histogram in self.histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name, series in sorted(by_name.items()):
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {metric} summary')
+            for labels, histogram in series:
+                for q in self.QUANTILES:
+                    quantile = _format_labels(labels + (('quantile', str(q / 100)),))
+                    lines.append(f'{metric}{quantile} {histogram.percentile(q)}')
+                lines.append(f'{metric}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{metric}_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """A trace config for an aiohttp session (like discord.py's ``http_trace``) that times every request."""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+            ctx.started = time.perf_counter()
+
+        async def on_request_done(session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+            status = str(params.response.status) if hasattr(params, 'response') else 'error'
+            self.observe(
+                'http_seconds',
+                time.perf_counter() - ctx.started,
+                method=params.method,
+                route=normalize_route(params.url.path),
+                status=status,
+            )
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_done)
+        trace.on_request_exception.append(on_request_done)
+        return trace
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """Makes queries that only differ in their values look the same, so they share a histogram."""
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('(?, ...)', sql)
+    return sql[:200]
+
+
+_SNOWFLAKE = re.compile(r'/\d{15,21}(?=/|$)')
+_TOKEN = re.compile(r'/[\w-]{40,}(?=/|$)')
+
+
+def normalize_route(path: str) -> str:
+    return _TOKEN.sub('/{token}', _SNOWFLAKE.sub('/{id}', path))
+
+
+class InstrumentedConnection:
+    """Times the queries run on a pooled connection, everything else is passed through."""
+
+    _TIMED = ('execute', 'executemany', 'executescript', 'fetchone', 'fetchall', 'fetchmany')
+
+    def __init__(self, connection: asqlite.ProxiedConnection, metrics: Metrics) -> None:
+        self._connection = connection
+        self._metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._connection, name)
+        if name not in self._TIMED:
+            return attribute
+
+        async def timed(sql: str, *args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return await attribute(sql, *args, **kwargs)
+            finally:
+                self._metrics.observe('query_seconds', time.perf_counter() - started, query=normalize_sql(sql))
+
+        return timed
+
+
+class _InstrumentedAcquire:
+    def __init__(self, pool: InstrumentedPool) -> None:
+        self._pool = pool
+        self._connection: Optional[InstrumentedConnection] = None
+
+    async def _acquire(self) -> InstrumentedConnection:
+        started = time.perf_counter()
+        connection = await self._pool._pool.acquire()
+        self._pool._metrics.observe('pool_acquire_seconds', time.perf_counter() - started)
+        return InstrumentedConnection(connection, self._pool._metrics)
+
+    async def __aenter__(self) -> InstrumentedConnection:
+        self._connection = await self._acquire()
+        return self._connection
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        if self._connection is not None:
+            await self._pool.release(self._connection)
+            self._connection = None
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+
+class InstrumentedPool:
+    """Wraps an :class:`asqlite.Pool` to time how long acquiring takes, and every query.
+
+    Works like the pool it wraps, ``async with pool.acquire() as conn`` and all.
+    """
+
+    def __init__(self, pool: asqlite.Pool, metrics: Metrics) -> None:
+        self._pool = pool
+        self._metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+    def acquire(self) -> _InstrumentedAcquire:
+        return _InstrumentedAcquire(self)
+
+    async def release(self, connection: Any) -> None:
+        if isinstance(connection, InstrumentedConnection):
+            connection = connection._connection
+        await self._pool.release(connection)
@@ -0,0 +1,227 @@
+"""Versioned schema migrations.
+
+Migrations live in the ``migrations`` folder, and are named ``<version>_<name>.sql`` or
+``<version>_<name>.py``. They're applied in order of their version, each one in its own
+transaction together with its row in the ``schema_version`` table, so a migration is either
+applied completely or not at all.
+
+SQL migrations are run with ``executescript``, so they can contain anything, triggers included.
+Python migrations have an ``async def migrate(conn)`` for things SQL can't do on its own,
+like checking if a column exists. They must not commit, or use ``executescript`` (which commits).
+
+To add a table or an index, add a new migration with the next version number. Never edit
+one that's already been released, databases that already ran it won't run it again.
+
+Check what would be applied to a database without touching it::
+
+    python -m components.migrations --dry-run database.db
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+import asqlite
+
+log = getLogger('BotChallenge.migrations')
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'migrations'
+
+SCHEMA_VERSION = '''
+CREATE TABLE IF NOT EXISTS schema_version (
+  version    INTEGER PRIMARY KEY,
+  name       TEXT    NOT NULL,
+  applied_at INTEGER NOT NULL
+);
+'''
+
+_FILENAME = re.compile(r'^(?P<version>\d+)_(?P<name>\w+)\.(?P<kind>sql|py)$')
+
+
+class MigrationError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    path: Path
+
+    def __str__(self) -> str:
+        return f'{self.version:04d}_{self.name}'
+
+    @property
+    def kind(self) -> str:
+        return self.path.suffix[1:]
+
+    async def apply(self, conn: asqlite.Connection) -> bool:
+        """|coro|
+
+        Applies the migration in a transaction.
+
+        Returns False if it turned out someone else (like another shard of the bot)
+        applied it first.
+        """
+        # Claiming the version first means a second process trying the same migration
+        # fails on the primary key, before it gets to change anything.
+        claim = 'INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)'
+        params = (self.version, self.name, int(time.time()))
+        try:
+            if self.kind == 'sql':
+                # executescript commits anything that's pending before it starts, so the
+                # transaction has to be part of the script.
+                sql = self.path.read_text(encoding='utf-8')
+                await conn.executescript(
+                    'BEGIN IMMEDIATE;\n'
+                    f'INSERT INTO schema_version (version, name, applied_at) VALUES {params!r};\n'
+                    f'{sql}\n;\n'
+                    'COMMIT;'
+                )
+            else:
+                await conn.execute('BEGIN IMMEDIATE')
+                await conn.execute(claim, params)
+                await self._load().migrate(conn)
+                await conn.commit()
+        except BaseException as e:
+            await conn.rollback()
+            if isinstance(e, sqlite3.IntegrityError) and self.version in await applied_versions(conn):
+                return False
+            raise
+        return True
+
+    def _load(self):
+        spec = importlib.util.spec_from_file_location(f'migrations.{self}', self.path)
+        if spec is None or spec.loader is None:
+            raise MigrationError(f'Could not load migration {self}')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if not hasattr(module, 'migrate'):
+            raise MigrationError(f'Migration {self} has no migrate function')
+        return module
+
+
+def discover(directory: Path = MIGRATIONS_DIR) -> List[Migration]:
+    """Finds the migrations in a folder, ordered by version."""
+    migrations: List[Migration] = []
+    for path in directory.iterdir():
+        match = _FILENAME.match(path.name)
+        if match:
+            migrations.append(Migration(int(match['version']), match['name'], path))
+        elif path.suffix in ('.sql', '.py'):
+            raise MigrationError(f'{path.name} is not named like <version>_<name>{path.suffix}')
+    migrations.sort(key=lambda m: m.version)
+    for previous, migration in zip(migrations, migrations[1:]):
+        if previous.version == migration.version:
+            raise MigrationError(f'{previous} and {migration} have the same version')
+    return migrations
+
+
+async def applied_versions(conn: asqlite.Connection) -> Set[int]:
+    """|coro|
+
+    Gets the versions of the migrations that were applied to the database.
+    """
+    await conn.execute(SCHEMA_VERSION)
+    return {row['version'] for row in await conn.fetchall('SELECT version FROM schema_version')}
+
+
+async def migrate_connection(
+    conn: asqlite.Connection, *, directory: Path = MIGRATIONS_DIR, target: Optional[int] = None
+) -> List[Migration]:
+    """|coro|
+
+    Applies every migration that hasn't been applied yet, up to and including ``target``.
+
+    Returns the migrations that were applied.
+    """
+    applied = await applied_versions(conn)
+    done: List[Migration] = []
+    for migration in discover(directory):
+        if migration.version in applied or (target is not None and migration.version > target):
+            continue
+        started = time.perf_counter()
+        if await migration.apply(conn):
+            log.info('Applied migration %s in %.0fms', migration, (time.perf_counter() - started) * 1000)
+            done.append(migration)
+    return done
+
+
+async def migrate(pool: asqlite.Pool, *, directory: Path = MIGRATIONS_DIR, target: Optional[int] = None) -> List[Migration]:
+    """|coro|
+
+    Brings the database up to date, see :func:`migrate_connection`.
+    """
+    async with pool.acquire() as conn:
+        return await migrate_connection(conn, directory=directory, target=target)
+
+
+async def dry_run(
+    database: str, *, directory: Path = MIGRATIONS_DIR, target: Optional[int] = None
+) -> Tuple[List[Migration], List[str]]:
+    """|coro|
+
+    Applies the pending migrations to a copy of the database, and leaves the database itself alone.
+
+    Returns the migrations that would be applied, and the tables, indexes etc. they would add.
+    Errors are raised like they would be for the real thing.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, 'dry-run.db')
+        if os.path.exists(database):
+            # The backup API also picks up anything that's still in the WAL.
+            source, destination = sqlite3.connect(database), sqlite3.connect(copy)
+            try:
+                source.backup(destination)
+            finally:
+                source.close()
+                destination.close()
+
+        async with asqlite.connect(copy) as conn:
+            before = await _schema_objects(conn)
+            migrations = await migrate_connection(conn, directory=directory, target=target)
+            added = sorted((await _schema_objects(conn)) - before)
+    return migrations, added
+
+
+async def _schema_objects(conn: asqlite.Connection) -> Set[str]:
+    rows = await conn.fetchall('SELECT type, name FROM sqlite_master')
+    return {f"{row['type']} {row['name']}" for row in rows}
+
+
+async def _main() -> None:
+    parser = argparse.ArgumentParser(description='Applies schema migrations to the database.')
+    parser.add_argument('database', nargs='?', default='database.db')
+    parser.add_argument('--dry-run', action='store_true', help='only show what would be applied')
+    parser.add_argument('--target', type=int, help='stop after this version')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        migrations, added = await dry_run(args.database, target=args.target)
+        print(f'{len(migrations)} migration(s) would be applied to {args.database}:')
+        for migration in migrations:
+            print(f'  {migration} ({migration.kind})')
+        if added:
+            print('Adding:')
+            for name in added:
+                print(f'  {name}')
+        return
+
+    async with asqlite.connect(args.database) as conn:
+        migrations = await migrate_connection(conn, target=args.target)
+    print(f'Applied {len(migrations)} migration(s): {", ".join(map(str, migrations)) or "none"}')
+
+
+if __name__ == '__main__':
+    asyncio.run(_main())
@@ -0,0 +1,102 @@
+"""Timings of the phases of starting the bot.
+
+Every phase is always timed, it's a couple of ``perf_counter`` calls. With ``STARTUP_PROFILE``
+set, the bot logs them all once it's ready, like::
+
+    Startup profile, ready 2.91s after the process started:
+      phase                    start      took
+      imports                  0.000s    0.412s
+      database open            0.415s    0.006s
+      ...
+
+For which imports are slow, run the bot with ``python -X importtime main.py``.
+"""
+
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Awaitable, Iterator, List, Optional, TypeVar
+
+log = getLogger('BotChallenge.startup')
+
+T = TypeVar('T')
+
+
+@dataclass(frozen=True)
+class Phase:
+    name: str
+    # Seconds since the profile started.
+    start: float
+    duration: float
+    background: bool = False
+
+
+class StartupProfile:
+    """Records how long each phase of starting up took.
+
+    Parameters
+    ----------
+    started: float
+        The ``time.perf_counter()`` the process started at, or as close to it as we know.
+    enabled: bool
+        Whether :meth:`report` logs anything.
+    """
+
+    def __init__(self, started: Optional[float] = None, *, enabled: bool = False) -> None:
+        self.started = time.perf_counter() if started is None else started
+        self.enabled = enabled
+        self.phases: List[Phase] = []
+        self.ready_after: Optional[float] = None
+
+    def record(self, name: str, started: float, ended: Optional[float] = None, *, background: bool = False) -> None:
+        """Records a phase that ran from ``started`` to ``ended`` (now, if not passed), both ``perf_counter`` values."""
+        ended = time.perf_counter() if ended is None else ended
+        self.phases.append(Phase(name, started - self.started, ended - started, background))
+        if self.enabled and self.ready_after is not None:
+            # Finished after the report, so it wasn't in it.
+            log.info(
+                'Startup: %s took %.3fs, done %.3fs after the process started', name, ended - started, ended - self.started
+            )
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the code in the ``with`` block as a phase."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    async def background(self, name: str, coro: Awaitable[T]) -> Optional[T]:
+        """|coro|
+
+        Runs startup work that nothing has to wait for, and times it. Errors are logged
+        rather than raised, there's usually nobody left to raise them to.
+        """
+        started = time.perf_counter()
+        try:
+            return await coro
+        except Exception:
+            log.exception('Startup: %s failed', name)
+            return None
+        finally:
+            self.record(name, started, background=True)
+
+    def ready(self) -> None:
+        """Marks the bot as ready, and logs the phases if profiling is on."""
+        if self.ready_after is not None:
+            return
+        self.ready_after = time.perf_counter() - self.started
+        if self.enabled:
+            log.info('%s', self.format())
+
+    def format(self) -> str:
+        lines = [f'Startup profile, ready {self.ready_after or 0:.3f}s after the process started:']
+        lines.append(f"  {'phase':<32} {'start':>8} {'took':>8}")
+        for phase in sorted(self.phases, key=lambda phase: phase.start):
+            name = f'{phase.name} (background)' if phase.background else phase.name
+            lines.append(f'  {name:<32} {phase.start:>7.3f}s {phase.duration:>7.3f}s')
+        return '\n'.join(lines)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asqlite
+
+log = getLogger('BotChallenge.storage')
+
+
+@dataclass
+class StorageProfile:
+    """How every pooled SQLite connection is set up.
+
+    WAL lets the leaderboard and other reads run while something is being written,
+    and with ``synchronous=NORMAL`` a commit only has to wait for the WAL to be written,
+    not for it to be synced. The rest is there to keep more of the database in memory.
+
+    Attributes
+    ----------
+    pool_size: int
+        How many connections the pool opens. Each one is a thread.
+    journal_mode: str
+    synchronous: str
+    mmap_size: int
+        In bytes, 0 disables memory mapping.
+    cache_size: int
+        Like the pragma: pages if positive, KiB if negative.
+    temp_store: str
+    busy_timeout: int
+        How long to wait for a lock before giving up, in milliseconds.
+    foreign_keys: bool
+    checkpoint_interval: int
+        Seconds between WAL checkpoints, 0 leaves it to SQLite's automatic checkpoints.
+    optimize_interval: int
+        Seconds between ``PRAGMA optimize`` runs, 0 disables them.
+    """
+
+    pool_size: int = 10
+    journal_mode: str = 'wal'
+    synchronous: str = 'normal'
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size: int = -64 * 1024
+    temp_store: str = 'memory'
+    busy_timeout: int = 5000
+    foreign_keys: bool = True
+    checkpoint_interval: int = 5 * 60
+    optimize_interval: int = 60 * 60
+
+    @property
+    def pragmas(self) -> Dict[str, Any]:
+        return {
+            'journal_mode': self.journal_mode,
+            'synchronous': self.synchronous,
+            'mmap_size': self.mmap_size,
+            'cache_size': self.cache_size,
+            'temp_store': self.temp_store,
+            'busy_timeout': self.busy_timeout,
+            'foreign_keys': 'on' if self.foreign_keys else 'off',
+        }
+
+    def apply(self, connection: sqlite3.Connection) -> None:
+        """Sets the pragmas on a connection, this is passed to ``asqlite.create_pool`` as ``init``."""
+        for name, value in self.pragmas.items():
+            connection.execute(f'PRAGMA {name} = {value}')
+
+    def create_pool(self, database: str) -> asqlite.PoolContextManager:
+        return asqlite.create_pool(database, init=self.apply, size=self.pool_size)
+
+    async def report(self, pool: asqlite.Pool) -> Dict[str, Any]:
+        """|coro|
+
+        Reads back the settings a pooled connection actually ended up with, and logs them.
+
+        SQLite silently ignores values it can't use (like mmap_size past its compile time
+        limit), so this can differ from the profile.
+        """
+        effective: Dict[str, Any] = {'pool_size': self.pool_size}
+        async with pool.acquire() as conn:
+            for name in self.pragmas:
+                row = await conn.fetchone(f'PRAGMA {name}')
+                effective[name] = row[0] if row else None
+        log.info('SQLite settings: %s', ', '.join(f'{name}={value}' for name, value in effective.items()))
+        if str(effective['journal_mode']).lower() != self.journal_mode.lower():
+            log.warning('Asked for journal_mode=%s but got %s', self.journal_mode, effective['journal_mode'])
+        return effective
+
+
+class StorageMaintenance:
+    """Checkpoints the WAL and runs ``PRAGMA optimize`` every now and then.
+
+    A long running reader can keep SQLite's automatic checkpoints from catching up, so
+    the WAL file keeps growing. A ``TRUNCATE`` checkpoint during a quiet moment resets it.
+    """
+
+    def __init__(self, pool: asqlite.Pool, profile: StorageProfile) -> None:
+        self.pool = pool
+        self.profile = profile
+        self._tasks: List[asyncio.Task[None]] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        if self.profile.checkpoint_interval > 0 and self.profile.journal_mode.lower() == 'wal':
+            self._tasks.append(asyncio.create_task(self._every(self.profile.checkpoint_interval, self.checkpoint)))
+        if self.profile.optimize_interval > 0:
+            self._tasks.append(asyncio.create_task(self._every(self.profile.optimize_interval, self.optimize)))
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def checkpoint(self) -> Optional[sqlite3.Row]:
+        """|coro|
+
+        Copies the WAL back into the database, and truncates it if no one is reading it.
+        Returns SQLite's (busy, log pages, checkpointed pages) row.
+        """
+        async with self.pool.acquire() as conn:
+            result = await conn.fetchone('PRAGMA wal_checkpoint(TRUNCATE)')
+        if result is not None and result[0]:
+            log.debug('WAL checkpoint was blocked, %s of %s pages done', result[2], result[1])
+        return result
+
+    async def optimize(self) -> None:
+        """|coro|
+
+        Lets SQLite update the statistics its query planner uses, where it thinks that's needed.
+        """
+        async with self.pool.acquire() as conn:
+            await conn.execute('PRAGMA optimize')
+
+    async def _every(self, interval: int, job: Callable[[], Awaitable[object]]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except Exception:
+                log.exception('SQLite maintenance failed')
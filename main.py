@@ -1,16 +1,34 @@
-import asyncio
-import os
-from logging import getLogger
+import time
 
-import asqlite
-import discord
-from discord.ext import commands
-from dotenv import load_dotenv
+# Before everything else, so the startup profile can time the imports.
+PROCESS_STARTED = time.perf_counter()
+
+import asyncio  # noqa: E402
+import os  # noqa: E402
+from logging import getLogger  # noqa: E402
+from typing import Any, Dict, Optional  # noqa: E402
+
+import aiohttp  # noqa: E402
+import asqlite  # noqa: E402
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+from dotenv import load_dotenv  # noqa: E402
+
+from components.cluster import ClusterLink, Supervisor, recommended_shards  # noqa: E402
+from components.gateway import GatewayProfile  # noqa: E402
+from components.metrics import InstrumentedPool, Metrics  # noqa: E402
+from components.migrations import migrate  # noqa: E402
+from components.startup import StartupProfile  # noqa: E402
+from components.storage import StorageMaintenance, StorageProfile  # noqa: E402
+
+IMPORTS_DONE = time.perf_counter()
 
 load_dotenv()
 log = getLogger('BotChallenge.main')
 
-INITIAL_EXTENSIONS = ['jishaku', 'cogs.economy', 'cogs.error_handling']
+INITIAL_EXTENSIONS = ['cogs.instrumentation', 'cogs.economy', 'cogs.error_handling']
+# Not needed to serve commands, so these are loaded once the bot is ready.
+DEFERRED_EXTENSIONS = ['jishaku']
 
 
 def getenv(key: str) -> str:
@@ -20,52 +38,163 @@ def getenv(key: str) -> str:
     raise RuntimeError(f'{key} not set in .env file')
 
 
-class BotChallenge(commands.Bot):
-    user: discord.ClientUser
+def getenv_flag(key: str, default: bool = False) -> bool:
+    """Reads an optional true/false setting from the .env file."""
+    value = os.getenv(key)
+    if not value:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 
-    def __init__(self, db: asqlite.Pool) -> None:
+def getenv_int(key: str, default: int) -> int:
+    """Reads an optional integer setting from the .env file."""
+    value = os.getenv(key)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise RuntimeError(f'{key} in .env file must be a whole number, not {value!r}') from None
+
+
+def storage_profile() -> StorageProfile:
+    """The SQLite settings from the .env file, see :class:`StorageProfile` for the defaults."""
+    defaults = StorageProfile()
+    return StorageProfile(
+        pool_size=getenv_int('POOL_SIZE', defaults.pool_size),
+        journal_mode=os.getenv('SQLITE_JOURNAL_MODE') or defaults.journal_mode,
+        synchronous=os.getenv('SQLITE_SYNCHRONOUS') or defaults.synchronous,
+        mmap_size=getenv_int('SQLITE_MMAP_SIZE', defaults.mmap_size),
+        cache_size=getenv_int('SQLITE_CACHE_SIZE', defaults.cache_size),
+        temp_store=os.getenv('SQLITE_TEMP_STORE') or defaults.temp_store,
+        busy_timeout=getenv_int('SQLITE_BUSY_TIMEOUT_MS', defaults.busy_timeout),
+        foreign_keys=getenv_flag('SQLITE_FOREIGN_KEYS', defaults.foreign_keys),
+        checkpoint_interval=getenv_int('SQLITE_CHECKPOINT_INTERVAL', defaults.checkpoint_interval),
+        optimize_interval=getenv_int('SQLITE_OPTIMIZE_INTERVAL', defaults.optimize_interval),
+    )
+
+
+def gateway_profile() -> GatewayProfile:
+    """The intents and caching from the .env file, see :class:`GatewayProfile` for the defaults."""
+    lean = getenv_flag('LEAN_GATEWAY')
+    return GatewayProfile(lean=lean, max_messages=getenv_int('MAX_MESSAGES', 100 if lean else 1000))
+
+
+class BotChallenge(commands.AutoShardedBot):
+    user: discord.ClientUser
+    session: aiohttp.ClientSession
+
+    def __init__(
+        self,
+        db: asqlite.Pool,
+        storage: Optional[StorageProfile] = None,
+        gateway: Optional[GatewayProfile] = None,
+        cluster: Optional[ClusterLink] = None,
+        startup: Optional[StartupProfile] = None,
+    ) -> None:
+        self.metrics = Metrics()
+        self.startup = startup or StartupProfile()
+        self._connecting_since: Optional[float] = None
+        self.gateway = gateway or GatewayProfile()
+        self.gateway_stats: Optional[Dict[str, Any]] = None
+        # Set when this is one of several processes, see components/cluster.py
+        self.cluster = cluster
+        if cluster is not None:
+            shards: Dict[str, Any] = {'shard_ids': cluster.shard_ids, 'shard_count': cluster.shard_count}
+        else:
+            shards = {'shard_count': getenv_int('SHARD_COUNT', 0) or None}
+        instrumented = getenv_flag('METRICS', True)
         super().__init__(
             command_prefix=commands.when_mentioned_or(getenv('PREFIX')),
-            intents=discord.Intents.all(),
             description='6 devs made this bot together, what will happen? Dun dun dun...',
+            http_trace=self.metrics.trace_config() if instrumented else None,
+            **shards,
+            **self.gateway.client_options(),
         )
-        self.pool = db
+        # Quacks like an asqlite.Pool, but times acquires and queries.
+        self.pool: asqlite.Pool = InstrumentedPool(db, self.metrics) if instrumented else db  # type: ignore
+        self.storage_maintenance = StorageMaintenance(db, storage or StorageProfile())
 
     async def setup_hook(self) -> None:
+        # One pooled session for every HTTP request the bot makes, besides discord.py's own.
+        self.session = aiohttp.ClientSession()
+        self.storage_maintenance.start()
+        if self.cluster is not None:
+            self.cluster.start()
         for ext in INITIAL_EXTENSIONS:
-            await self.load_extension(ext)
+            with self.startup.phase(f'extension {ext}'):
+                await self.load_extension(ext)
+
+    async def login(self, token: str) -> None:
+        # Includes setup_hook, so the extensions are timed again on their own.
+        with self.startup.phase('login'):
+            await super().login(token)
+        self._connecting_since = time.perf_counter()
+
+    async def load_deferred_extensions(self) -> None:
+        for ext in DEFERRED_EXTENSIONS:
+            await self.startup.background(f'extension {ext}', self.load_extension(ext))
+
+    async def close(self) -> None:
+        await super().close()
+        self.storage_maintenance.stop()
+        if self.cluster is not None:
+            self.cluster.close()
+        if hasattr(self, 'session'):
+            await self.session.close()
 
     async def on_ready(self) -> None:
         print(f"Logged in as {self.user} (ID: {self.user.id})")
+        # on_ready fires again after reconnects, the first one is the startup.
+        if self.gateway_stats is None:
+            if self._connecting_since is not None:
+                self.startup.record('gateway connect', self._connecting_since)
+            self.startup.ready()
+            self.gateway_stats = self.gateway.report(self)
+            await self.load_deferred_extensions()
 
 
 async def runner():
-    populated = os.path.exists('database.db')
-
-    async with asqlite.create_pool('database.db') as pool, BotChallenge(pool) as bot:
+    startup = StartupProfile(PROCESS_STARTED, enabled=getenv_flag('STARTUP_PROFILE'))
+    startup.record('imports', PROCESS_STARTED, IMPORTS_DONE)
+    storage = storage_profile()
+    cluster = ClusterLink.from_env()
+
+    opening = time.perf_counter()
+    async with storage.create_pool('database.db') as pool, BotChallenge(
+        pool, storage, gateway_profile(), cluster, startup
+    ) as bot:
         discord.utils.setup_logging()
-
-        # Creating a database so you don't need to!
-        if not populated:
-            with open('schema.sql') as f:
-                data = f.readlines()
-            async with pool.acquire() as conn:
-                ret = []
-                for line in data:
-                    ret.append(line)
-                    if ';' in line:
-                        query = ''.join(ret)
-                        if query.strip():
-                            await conn.execute(query)
-                        ret = []
-                if ret:
-                    query = ''.join(ret)
-                    if query.strip():
-                        await conn.execute(query)
-                await conn.commit()
-            log.warning('Automatically created a database file! Operation succseful.')
+        if cluster is not None:
+            log.info(f'Cluster {cluster.cluster_id}, shards {cluster.shard_ids} of {cluster.shard_count}')
+        await storage.report(pool)
+        startup.record('database open', opening)
+
+        # Creates the database if it doesn't exist, and brings it up to date if it does.
+        with startup.phase('migrations'):
+            applied = await migrate(pool)
+        if applied:
+            log.warning(f'Applied {len(applied)} database migration(s), now at version {applied[-1].version}.')
         await bot.start(getenv('TOKEN'))
 
 
+async def supervise(processes: int):
+    """Runs the bot as ``processes`` worker processes, see :class:`Supervisor`."""
+    discord.utils.setup_logging()
+    storage = storage_profile()
+    # Migrate once up front, rather than having every worker race to do it.
+    async with storage.create_pool('database.db') as pool:
+        applied = await migrate(pool)
+    if applied:
+        log.warning(f'Applied {len(applied)} database migration(s), now at version {applied[-1].version}.')
+
+    shard_count = getenv_int('SHARD_COUNT', 0) or await recommended_shards(getenv('TOKEN'))
+    await Supervisor(shard_count, processes).run()
+
+
 if __name__ == '__main__':
-    asyncio.run(runner())
+    processes = getenv_int('CLUSTER_PROCESSES', 1)
+    if processes > 1 and ClusterLink.from_env() is None:
+        asyncio.run(supervise(processes))
+    else:
+        asyncio.run(runner())
@@ -1,19 +1,18 @@
--- NOTE: the script will attempt to create a database if no
--- 'database.db' file is found, so do not worry about this.
--- Only update with new table definitions when adding them.
+-- The tables the bot started out with, this used to be schema.sql.
+-- Databases made before migrations existed already have these.
 
-CREATE TABLE wallets (
+CREATE TABLE IF NOT EXISTS wallets (
   user_id INT PRIMARY KEY,
   balance INT DEFAULT 0
-); -- PLEASE! CLOSE ALL QUERIES
+);
 
-CREATE TABLE items (
+CREATE TABLE IF NOT EXISTS items (
   item_id   INTEGER PRIMARY KEY AUTOINCREMENT,
   item_name TEXT    UNIQUE,
   price     INT     NOT NULL
 );
 
-CREATE TABLE inventory (
+CREATE TABLE IF NOT EXISTS inventory (
   user_id INTEGER NOT NULL,
   item_id INTEGER NOT NULL,
   amount  INTEGER NOT NULL,
@@ -22,10 +21,10 @@ CREATE TABLE inventory (
     ON DELETE CASCADE ON UPDATE CASCADE
 );
 
-CREATE TABLE lottery (
+CREATE TABLE IF NOT EXISTS lottery (
   lot_id INTEGER PRIMARY KEY AUTOINCREMENT,
   bal   INTEGER NOT NULL,
-  -- entries as list of user_ids
+  -- entries as list of user_ids, replaced by lottery_entries
   entries TEXT NULL,
   winner INTEGER NULL,
   start_time INTEGER NOT NULL,
@@ -36,7 +35,7 @@ CREATE TABLE lottery (
 
 -- ITEMS -- Feel free to add more!
 -- I had to simplify this, sorry
-INSERT INTO items
+INSERT OR IGNORE INTO items
   (item_name, price)
 VALUES
   ('Rubber Duck', 1000),
@@ -49,4 +48,4 @@ VALUES
   ('Personal Robot', 1000),
   ('Rock', 5),
   ('Air', 1),
-  ('Nothing', 10);
\ No newline at end of file
+  ('Nothing', 10);
@@ -0,0 +1,5 @@
+-- The leaderboard, ordered by balance.
+CREATE INDEX IF NOT EXISTS wallets_balance_idx ON wallets (balance DESC, user_id);
+
+-- Finding running lotteries, and the ones that still need to be drawn.
+CREATE INDEX IF NOT EXISTS lottery_end_time_idx ON lottery (end_time, winner);
@@ -0,0 +1,7 @@
+-- Last journal entry that made it into wallets, see cogs/economy/journal.py
+CREATE TABLE IF NOT EXISTS balance_journal (
+  id       INTEGER PRIMARY KEY CHECK (id = 1),
+  last_seq INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO balance_journal (id, last_seq) VALUES (1, 0);
@@ -0,0 +1,6 @@
+-- Names of users the bot doesn't have cached, see cogs/economy/resolver.py
+CREATE TABLE IF NOT EXISTS user_names (
+  user_id    INTEGER PRIMARY KEY,
+  name       TEXT    NULL, -- NULL if the user doesn't exist anymore
+  fetched_at INTEGER NOT NULL
+);
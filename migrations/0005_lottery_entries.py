@@ -0,0 +1,50 @@
+"""Moves lottery entries from the comma separated lottery.entries column to their own table.
+
+Every entry owns the tickets numbered [first_ticket, first_ticket + tickets) of its lottery,
+so drawing ticket N is a lookup for the entry with the biggest first_ticket <= N.
+"""
+
+from logging import getLogger
+from typing import Dict
+
+import asqlite
+
+log = getLogger('BotChallenge.migrations')
+
+
+async def migrate(conn: asqlite.Connection) -> None:
+    await conn.execute('''CREATE TABLE IF NOT EXISTS lottery_entries (
+  entry_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+  lot_id       INTEGER NOT NULL,
+  user_id      INTEGER NOT NULL,
+  tickets      INTEGER NOT NULL,
+  first_ticket INTEGER NOT NULL,
+  FOREIGN KEY (lot_id) REFERENCES lottery(lot_id)
+    ON DELETE CASCADE ON UPDATE CASCADE
+)''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS lottery_entries_ticket_idx ON lottery_entries (lot_id, first_ticket)')
+    await conn.execute('CREATE INDEX IF NOT EXISTS lottery_entries_user_idx ON lottery_entries (lot_id, user_id)')
+
+    columns = {row['name'] for row in await conn.fetchall('PRAGMA table_info(lottery)')}
+    # Databases that ran the bot before migrations existed might have this one already.
+    if 'tickets' not in columns:
+        # total amount of tickets in lottery_entries
+        await conn.execute('ALTER TABLE lottery ADD COLUMN tickets INTEGER NOT NULL DEFAULT 0')
+
+    legacy = await conn.fetchall('SELECT lot_id, entries FROM lottery WHERE entries IS NOT NULL')
+    for lottery in legacy:
+        tickets: Dict[int, int] = {}
+        for user_id in lottery['entries'].split(','):
+            # The old enter command could leave a 'None' in there.
+            if user_id.isdigit():
+                tickets[int(user_id)] = tickets.get(int(user_id), 0) + 1
+        rows, total = [], 0
+        for user_id, amount in tickets.items():
+            rows.append((lottery['lot_id'], user_id, amount, total))
+            total += amount
+        await conn.executemany(
+            'INSERT INTO lottery_entries (lot_id, user_id, tickets, first_ticket) VALUES (?, ?, ?, ?)', rows
+        )
+        await conn.execute('UPDATE lottery SET tickets = ?, entries = NULL WHERE lot_id = ?', (total, lottery['lot_id']))
+    if legacy:
+        log.warning(f'Moved the entries of {len(legacy)} lotteries to the lottery_entries table')
@@ -0,0 +1,19 @@
+-- Offline trivia questions, see cogs/economy/trivia_bank.py
+CREATE TABLE IF NOT EXISTS trivia_questions (
+  question_id       INTEGER PRIMARY KEY,
+  category_id       INTEGER NULL, -- OpenTDB category, if we know it
+  category          TEXT    NOT NULL,
+  difficulty        TEXT    NOT NULL,
+  question          TEXT    NOT NULL UNIQUE,
+  correct_answer    TEXT    NOT NULL,
+  incorrect_answers TEXT    NOT NULL -- JSON list
+);
+
+CREATE INDEX IF NOT EXISTS trivia_questions_difficulty_idx ON trivia_questions (difficulty);
+CREATE INDEX IF NOT EXISTS trivia_questions_category_idx ON trivia_questions (category_id, difficulty);
+
+-- Bit N is set if the user has been asked question N
+CREATE TABLE IF NOT EXISTS trivia_seen (
+  user_id INTEGER PRIMARY KEY,
+  seen    BLOB    NOT NULL
+);
@@ -0,0 +1,14 @@
+-- Bumped by the triggers below whenever the items change, see cogs/economy/catalog.py
+CREATE TABLE IF NOT EXISTS catalog_version (
+  id      INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0);
+
+CREATE TRIGGER IF NOT EXISTS items_insert_version AFTER INSERT ON items
+BEGIN UPDATE catalog_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS items_update_version AFTER UPDATE ON items
+BEGIN UPDATE catalog_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS items_delete_version AFTER DELETE ON items
+BEGIN UPDATE catalog_version SET version = version + 1; END;
@@ -0,0 +1,15 @@
+-- DMs that still have to be sent, see cogs/economy/notifications.py
+CREATE TABLE IF NOT EXISTS notification_outbox (
+  notification_id INTEGER PRIMARY KEY,
+  user_id         INTEGER NOT NULL,
+  content         TEXT    NOT NULL,
+  -- notifications with the same key for the same user replace each other
+  coalesce_key    TEXT    NULL,
+  attempts        INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at INTEGER NOT NULL,
+  created_at      INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS notification_outbox_due_idx ON notification_outbox (next_attempt_at);
+CREATE UNIQUE INDEX IF NOT EXISTS notification_outbox_key_idx ON notification_outbox (user_id, coalesce_key)
+  WHERE coalesce_key IS NOT NULL;
@@ -0,0 +1,6 @@
+-- Which process runs the jobs that only one process should, see components/cluster.py
+CREATE TABLE IF NOT EXISTS cluster_leases (
+  name       TEXT    PRIMARY KEY,
+  holder     TEXT    NOT NULL,
+  expires_at REAL    NOT NULL
+);
@@ -0,0 +1,23 @@
+-- Every balance change, see cogs/economy/ledger.py
+CREATE TABLE IF NOT EXISTS ledger (
+  entry_id INTEGER PRIMARY KEY,
+  user_id  INTEGER NOT NULL,
+  ts       INTEGER NOT NULL,
+  delta    INTEGER NOT NULL,
+  -- what it was for: pay, work, daily, buy, sell, lottery, robbery, trivia...
+  kind     TEXT    NOT NULL
+);
+
+-- Covers "what did this user earn/spend since then" without touching the table itself.
+CREATE INDEX IF NOT EXISTS ledger_user_ts_idx ON ledger (user_id, ts, delta);
+CREATE INDEX IF NOT EXISTS ledger_ts_idx ON ledger (ts);
+
+-- Every balance every now and then, so old ledger entries can be deleted.
+CREATE TABLE IF NOT EXISTS ledger_snapshots (
+  taken_at INTEGER NOT NULL,
+  user_id  INTEGER NOT NULL,
+  balance  INTEGER NOT NULL,
+  PRIMARY KEY (user_id, taken_at)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS ledger_snapshots_taken_at_idx ON ledger_snapshots (taken_at);
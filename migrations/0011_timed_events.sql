@@ -0,0 +1,6 @@
+-- Timed events that last a while, like bonus hours, so restarts and other processes know they're on.
+CREATE TABLE IF NOT EXISTS timed_events (
+  name       TEXT    PRIMARY KEY,
+  ends_at    INTEGER NOT NULL,
+  multiplier INTEGER NOT NULL
+);
@@ -0,0 +1,9 @@
+-- Command cooldowns that outlive restarts, see cogs/economy/cooldowns.py
+CREATE TABLE IF NOT EXISTS cooldowns (
+  command    TEXT    NOT NULL,
+  user_id    INTEGER NOT NULL,
+  expires_at REAL    NOT NULL,
+  PRIMARY KEY (command, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS cooldowns_expires_at_idx ON cooldowns (expires_at);
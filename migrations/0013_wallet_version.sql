@@ -0,0 +1,9 @@
+-- Bumped once by every transaction that writes to wallets or inventory (see bump_wallet_version
+-- in cogs/economy/operations.py), so a snapshot of the wallets can tell if the database changed
+-- since it was taken, see cogs/economy/snapshot.py
+CREATE TABLE IF NOT EXISTS wallet_version (
+  id      INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO wallet_version (id, version) VALUES (1, 0);
@@ -0,0 +1,43 @@
+-- lottery.winner referenced wallets ON DELETE CASCADE, so with foreign keys on, quitting
+-- deleted every lottery someone won, and their lottery_entries with it. The winner is
+-- history, it stays after they quit. (ON DELETE SET NULL would make a drawn lottery look
+-- like it still has to be drawn.)
+--
+-- SQLite can't change a foreign key in place. lottery can't just be dropped either, that
+-- would cascade to lottery_entries, so both are copied to new tables that reference each
+-- other, and renamed back. Renaming lottery_new updates lottery_entries_new's reference.
+CREATE TABLE lottery_new (
+  lot_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+  bal        INTEGER NOT NULL,
+  -- entries as list of user_ids, replaced by lottery_entries
+  entries    TEXT    NULL,
+  -- user ID of the winner, they might not have a wallet anymore
+  winner     INTEGER NULL,
+  start_time INTEGER NOT NULL,
+  end_time   INTEGER NOT NULL,
+  -- total amount of tickets in lottery_entries
+  tickets    INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO lottery_new (lot_id, bal, entries, winner, start_time, end_time, tickets)
+  SELECT lot_id, bal, entries, winner, start_time, end_time, tickets FROM lottery;
+
+CREATE TABLE lottery_entries_new (
+  entry_id     INTEGER PRIMARY KEY AUTOINCREMENT,
+  lot_id       INTEGER NOT NULL,
+  user_id      INTEGER NOT NULL,
+  tickets      INTEGER NOT NULL,
+  first_ticket INTEGER NOT NULL,
+  FOREIGN KEY (lot_id) REFERENCES lottery_new(lot_id)
+    ON DELETE CASCADE ON UPDATE CASCADE
+);
+INSERT INTO lottery_entries_new (entry_id, lot_id, user_id, tickets, first_ticket)
+  SELECT entry_id, lot_id, user_id, tickets, first_ticket FROM lottery_entries;
+
+DROP TABLE lottery_entries;
+DROP TABLE lottery;
+ALTER TABLE lottery_new RENAME TO lottery;
+ALTER TABLE lottery_entries_new RENAME TO lottery_entries;
+
+CREATE INDEX IF NOT EXISTS lottery_end_time_idx ON lottery (end_time, winner);
+CREATE INDEX IF NOT EXISTS lottery_entries_ticket_idx ON lottery_entries (lot_id, first_ticket);
+CREATE INDEX IF NOT EXISTS lottery_entries_user_idx ON lottery_entries (lot_id, user_id);
@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+# Sets up the environment main.py needs, so it has to come first.
+from benchmarks.harness import Harness  # isort: skip
+
+from cogs.economy import Economy
+
+
+async def _quit_after_winning() -> None:
+    async with Harness(users=2, balance=100) as harness:
+        winner, other = (harness.users[user_id] for user_id in harness.user_ids)
+        async with harness.bot.pool.acquire() as conn:
+            lottery = await conn.fetchone(
+                'INSERT INTO lottery (bal, winner, start_time, end_time, tickets) VALUES (50, ?, 0, 1, 2) RETURNING lot_id',
+                (winner.id,),
+            )
+            await conn.executemany(
+                'INSERT INTO lottery_entries (lot_id, user_id, tickets, first_ticket) VALUES (?, ?, 1, ?)',
+                [(lottery['lot_id'], winner.id, 0), (lottery['lot_id'], other.id, 1)],
+            )
+            await conn.commit()
+
+        cog = await harness.add_cog(Economy)
+
+        async def confirm(*args, **kwargs):
+            return SimpleNamespace(author=winner, content='y')
+
+        harness.bot.wait_for = confirm
+        await cog.quit.callback(cog, harness.context(winner, cog))
+
+        async with harness.bot.pool.acquire() as conn:
+            wallet = await conn.fetchone('SELECT 1 FROM wallets WHERE user_id = ?', (winner.id,))
+            row = await conn.fetchone('SELECT winner FROM lottery WHERE lot_id = ?', (lottery['lot_id'],))
+            entries = await conn.fetchone(
+                'SELECT COUNT(*) AS value FROM lottery_entries WHERE lot_id = ?', (lottery['lot_id'],)
+            )
+        assert wallet is None
+        assert row is not None and row['winner'] == winner.id
+        assert entries['value'] == 2
+        await harness.bot.remove_cog(cog.qualified_name)
+
+
+def test_quit_keeps_won_lotteries() -> None:
+    asyncio.run(_quit_after_winning())